@@ -0,0 +1,163 @@
+from utils.data_loading import *
+from utils.scgpt_config import *
+from utils.evaluation import *
+from utils.context_genes import *
+from utils.checkpoint import load_scgenept_checkpoint
+
+from models.scGenePT import *
+from train import set_seed, load_dataloader
+import argparse
+import pandas as pd
+
+
+def get_args():
+    """
+    Parses command line arguments
+
+    Returns:
+        list of args
+    """
+    parser = argparse.ArgumentParser(description='Arguments for reporting the accuracy and latency of context-budget inference ...')
+    parser.add_argument(
+        '--model-type',
+        type=str,
+        help='Type of the trained model. For full list of possible models, please visit https://github.com/czi-ai/scGenePT. Defaults to the model-type stored in --model-location for self-describing checkpoints.',
+        default = None
+    )
+    parser.add_argument(
+        '--model-location',
+        type=str,
+        help='location of the trained model weights',
+        required = True
+    )
+    parser.add_argument(
+        '--dataset',
+        type=str,
+        help='dataset the model has been trained on; the report is computed on its test split',
+        default = 'norman'
+    )
+    parser.add_argument(
+        '--budgets',
+        type=int,
+        nargs='+',
+        help='context budgets to report, in number of genes; the report always includes all genes as a baseline',
+        default = [128, 256, 512, 1024, 2048]
+    )
+    parser.add_argument(
+        '--context-genes',
+        type=str,
+        help='how the context is filled after the perturbed and readout genes: with the most variable genes (hvg) or the most correlated genes (correlation)',
+        choices = CONTEXT_GENE_METHODS,
+        default = 'hvg'
+    )
+    parser.add_argument(
+        '--readout-genes',
+        type=str,
+        nargs='*',
+        help='names of genes that are always in the context, eg the genes that are read out downstream',
+        default = None
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        help='test batch_size',
+        default = 64
+    )
+    parser.add_argument(
+        '--device',
+        type=str,
+        help='device',
+        default = 'cuda:0'
+    )
+    parser.add_argument(
+        '--rnd-seed',
+        type=int,
+        help='random seed',
+        default = 42
+    )
+    parser.add_argument(
+        '--models-dir',
+        type=str,
+        help='directory the pretrained scGPT model and gene embeddings are in',
+        default = 'models/'
+    )
+    parser.add_argument(
+        '--outputs_dir',
+        type=str,
+        help='directory where the report is saved',
+        default = 'outputs/'
+    )
+    args = parser.parse_args()
+    return args
+
+
+def time_eval_perturb(test_loader, model, device, gene_ids, context_budget = None):
+    """
+    Runs eval_perturb on the test loader and times it, after a warmup batch
+
+    Returns:
+        test_res: results of eval_perturb
+        elapsed: time eval_perturb took, in seconds
+    """
+    warmup_batch = next(iter(test_loader))
+    model.pred_perturb(warmup_batch, 'all', gene_ids, context_budget=context_budget)
+    if torch.cuda.is_available() and torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+    start_time = time.time()
+    test_res = eval_perturb(test_loader, model, device, 'all', gene_ids, context_budget)
+    if torch.cuda.is_available() and torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+    return test_res, time.time() - start_time
+
+
+if __name__ == "__main__":
+
+    args = get_args()
+    set_seed(args.rnd_seed)
+    device = args.device
+
+    # Load data
+    pert_data = load_dataloader(args.dataset, args.batch_size, args.batch_size, split = 'simulation')
+    pert_adata = pert_data.adata
+    gene_names = pert_data.gene_names.to_list()
+    test_loader = pert_data.dataloader['test_loader']
+    n_test_cells = len(test_loader.dataset)
+
+    model_type = args.model_type
+    if model_type is None:
+        _, checkpoint_info = load_scgenept_checkpoint(args.model_location)
+        model_type = checkpoint_info["config"]["model_type"] if checkpoint_info is not None else "scgpt"
+    model, gene_ids = load_trained_scgenept_model_from_config(args.model_location, device, pert_adata, model_type, args.models_dir)
+
+    # The informative genes are ranked once and shared by all budgets, on the cells of the train split (including the
+    # control cells), so that the context isn't chosen with the responses to the test perturbations the report scores
+    train_conditions = set(pert_data.set2conditions['train']) | {'ctrl'}
+    ranked_genes = rank_context_genes(pert_adata, args.context_genes, conditions = train_conditions)
+    readout_gene_ids = None
+    if args.readout_genes:
+        readout_gene_ids = [gene_names.index(gene) for gene in args.readout_genes]
+
+    report = []
+    budgets = [None] + sorted(budget for budget in args.budgets if budget < len(gene_names))
+    for budget in budgets:
+        context_budget = ContextBudget(ranked_genes, budget, readout_gene_ids) if budget is not None else None
+        test_res, elapsed = time_eval_perturb(test_loader, model, device, gene_ids, context_budget)
+        test_metrics, _ = compute_metrics(test_res)
+        report.append({
+            'budget': budget if budget is not None else len(gene_names),
+            'context_genes': args.context_genes if budget is not None else 'all',
+            'ms_per_cell': 1000 * elapsed / n_test_cells,
+            **{metric: test_metrics[metric] for metric in ['mse', 'pearson', 'mse_de', 'pearson_de']},
+        })
+        print(report[-1])
+
+    report = pd.DataFrame(report)
+    report['speedup'] = report['ms_per_cell'].iloc[0] / report['ms_per_cell']
+
+    # Location where the report will be saved to
+    save_dir = Path(args.outputs_dir + args.dataset + "/" + model_type + "/seed_" + str(args.rnd_seed) + "/")
+    save_dir.mkdir(parents=True, exist_ok=True)
+    report_location = save_dir / f"context_budget_report_{args.context_genes}.csv"
+    report.to_csv(report_location, index=False)
+    print(report.to_string(index=False))
+    print(f"Saved the context budget report to {report_location}")
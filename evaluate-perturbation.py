@@ -1,12 +1,16 @@
+# with --num-workers, the test set is evaluated in forked processes, see utils/numba_threading.py
+import utils.numba_threading
+
 from utils.data_loading import *
 from utils.scgpt_config import *
 from utils.evaluation import *
+from utils.checkpoint import load_scgenept_checkpoint
 
 from models.scGenePT import *
+from utils.pert_data_cache import load_pert_data
 import argparse
 import random
 import numpy as np
-import os
 from sklearn.model_selection import train_test_split
 from torch.utils.data import Dataset
 import pickle as pkl
@@ -41,24 +45,23 @@ def make_output_dirs(save_dir):
     print(f"saving to {save_dir}")
 
     
-def load_dataloader(dataset_name, batch_size, val_batch_size, split = 'simulation'):
+def load_dataloader(dataset_name, batch_size, val_batch_size, split = 'simulation', dense_dataset_layout = None):
     """
     Loads data in a PertData format. Uses GEARS dataloaders implementation as described under https://github.com/snap-stanford/GEARS
+    The prepared split and dataloader datasets are cached under data/, so that only the first run prepares them (see utils/pert_data_cache.py).
     
     Args:
         dataset_name: name of the dataset to load. Example: 'adamson', 'norman'.
         batch_size: batch_size for the train datalaoder
-        val_batch_size: batch_size for the validation dataloader
+        val_batch_size: batch_size for the validation dataloader; note that GEARS uses batch_size for all dataloaders of a split
         split: split to use; tested with 'simulation'
+        dense_dataset_layout: if not None, the GEARS dataloaders are replaced by DenseDataLoaders over dense datasets 
+            with this layout, one of 'csr', 'dense' (see utils/dense_dataset.py)
         
     Returns:
         pert_data: PertData object
     """
-    pert_data = PertData("data/")
-    pert_data.load(data_name=dataset_name)
-    pert_data.prepare_split(split=split, seed=1)
-    pert_data.get_dataloader(batch_size=batch_size, test_batch_size=val_batch_size)
-    return pert_data
+    return load_pert_data(dataset_name, batch_size, split = split, seed = 1, dense_dataset_layout = dense_dataset_layout)
 
     
 def get_args():
@@ -72,8 +75,23 @@ def get_args():
     parser.add_argument(
         '--model-type', 
         type=str, 
-        help='Type of model to train. One of: [scgpt, scgenept_ncbi_gpt, scgenept_ncbi+uniprot_gpt, scgenept_go_c_gpt_concat, scgenept_go_f_gpt_concat, scgenept_go_p_gpt_concat, scgenept_go_all_gpt_concat, genept_ncbi_gpt, genept_ncbi+uniprot_gpt, go_c_gpt_concat, go_f_gpt_concat, go_p_gpt_concat, go_all_gpt_concat ...]. For full list of possible models, please visit https://github.com/czi-ai/scGenePT.', 
-        default = "scgpt"
+        nargs='+',
+        help='Types of the models to evaluate, one per --model-location if it is set. One of: [scgpt, scgenept_ncbi_gpt, scgenept_ncbi+uniprot_gpt, scgenept_go_c_gpt_concat, scgenept_go_f_gpt_concat, scgenept_go_p_gpt_concat, scgenept_go_all_gpt_concat, genept_ncbi_gpt, genept_ncbi+uniprot_gpt, go_c_gpt_concat, go_f_gpt_concat, go_p_gpt_concat, go_all_gpt_concat ...]. For full list of possible models, please visit https://github.com/czi-ai/scGenePT. Defaults to the model-type stored in each --model-location for self-describing checkpoints, and to scgpt otherwise. Several models are evaluated in one pass over the test data, and the metrics of each model are saved under outputs_dir/dataset/<model_type or model name>/seed_<rnd-seed>/.', 
+        default = None
+    )
+    parser.add_argument(
+        '--model-location', 
+        type=str, 
+        nargs='+',
+        help='locations of the trained models; if not set, the locations are derived from --trained-model-dir, --model-type and --dataset using the file names of the released models', 
+        default = None
+    )
+    parser.add_argument(
+        '--model-names', 
+        type=str, 
+        nargs='+',
+        help='names of the models to evaluate, one per model, used instead of the model types in the directories the metrics are saved under, eg to compare several models of the same type', 
+        default = None
     )
     parser.add_argument(
         '--batch-size', 
@@ -117,49 +135,113 @@ def get_args():
         help='directory where model outputs and metrics are saved', 
         default = 'outputs/'
     )
+    parser.add_argument(
+        '--dense-datasets', 
+        type=str, 
+        help='if set, the dataloaders read the cells from dense datasets with this layout instead of collating GEARS cell graphs; the dense datasets are materialized under data/ on first use (see utils/dense_dataset.py)', 
+        choices = ['csr', 'dense'],
+        default = None
+    )
+    parser.add_argument(
+        '--num-workers', 
+        type=int, 
+        help='number of processes the test batches are sharded across, each with its own model replicas and an equal share of the cores; the metrics of the shards are merged in shard order (see eval_perturb_sharded in utils/evaluation.py)', 
+        default = 1
+    )
     args = parser.parse_args()
     return args
 
-if __name__ == "__main__":    
-       
-    args = get_args()    
-    device = args.device
-    dataset_name = args.dataset
-    model_type = args.model_type
-    use_fast_transformer = True  # whether to use fast transformer
-    amp = True
-    
-    # Location of pretrained scGPT model
-    if args.model_type != 'scgpt':
-        dir_model = args.model_type.split('_gpt')[0]
-        trained_model_location = f'{args.trained_model_dir}/{dir_model}/{args.dataset}/'
+def get_trained_model_location(trained_model_dir, model_type, dataset_name):
+    """
+    Returns the location of a released trained model under trained_model_dir
+    """
+    if model_type != 'scgpt':
+        dir_model = model_type.split('_gpt')[0]
+        trained_model_location = f'{trained_model_dir}/{dir_model}/{dataset_name}/'
         
         # Note that these are the extensions that will be available by default if you downloaded
         # all the models from AWS s3 bucket. If they models were renamed, these suffixes need to be changed
-        if args.model_type == 'scgenept_ncbi+uniprot_gpt' and args.dataset == 'norman':
+        if model_type == 'scgenept_ncbi+uniprot_gpt' and dataset_name == 'norman':
             trained_model_location += 'best_model_gpt3.5_ada_rnd_seed_42.pt'
         else:
             trained_model_location += 'best_model_gpt3.5_ada_rnd_seed_42_concat.pt'
     else:
-        trained_model_location = f'{args.trained_model_dir}/{args.model_type}/{args.dataset}/'
+        trained_model_location = f'{trained_model_dir}/{model_type}/{dataset_name}/'
         trained_model_location += 'best_model_seed_42.pt'
+    return trained_model_location
+
+
+def get_models_to_evaluate(args):
+    """
+    Pairs the names of the models to evaluate with their model types and locations
+
+    Args:
+        args: command line arguments, see get_args
+
+    Returns:
+        dict mapping model names to (model_type, model_location) tuples
+    """
+    if args.model_location is None:
+        model_types = args.model_type if args.model_type is not None else ['scgpt']
+        model_locations = [get_trained_model_location(args.trained_model_dir, model_type, args.dataset) for model_type in model_types]
+    else:
+        model_locations = args.model_location
+        if args.model_type is not None:
+            model_types = args.model_type
+        else:
+            model_types = []
+            for model_location in model_locations:
+                _, checkpoint_info = load_scgenept_checkpoint(model_location)
+                model_types.append(checkpoint_info["config"]["model_type"] if checkpoint_info is not None else "scgpt")
+        if len(model_types) != len(model_locations):
+            raise ValueError(f"Got {len(model_types)} model types for {len(model_locations)} model locations")
+    model_names = args.model_names if args.model_names is not None else model_types
+    if len(model_names) != len(model_types):
+        raise ValueError(f"Got {len(model_names)} model names for {len(model_types)} models")
+    if len(set(model_names)) != len(model_names):
+        raise ValueError(f"The metrics of each model are saved under its own directory, got duplicate model names: {model_names}; set --model-names")
+    return dict(zip(model_names, zip(model_types, model_locations)))
+
+
+if __name__ == "__main__":    
+       
+    args = get_args()    
+    device = args.device
+    dataset_name = args.dataset
+    use_fast_transformer = True  # whether to use fast transformer
+    amp = True
+    
+    models_to_evaluate = get_models_to_evaluate(args)
+    trained_model_locations = [trained_model_location for _, trained_model_location in models_to_evaluate.values()]
     
-    # Location where the model outputs will be saved to 
-    save_dir = Path(args.outputs_dir + dataset_name + "/" + model_type + "/seed_" + str(args.rnd_seed) + "/")
-    make_output_dirs(save_dir)
+    # Locations where the model outputs will be saved to 
+    save_dirs = {}
+    for model_name in models_to_evaluate:
+        save_dirs[model_name] = Path(args.outputs_dir + dataset_name + "/" + model_name + "/seed_" + str(args.rnd_seed) + "/")
+        make_output_dirs(save_dirs[model_name])
     
     # Load data
-    pert_data = load_dataloader(args.dataset, args.batch_size, args.eval_batch_size, split = 'simulation')
+    pert_data = load_dataloader(args.dataset, args.batch_size, args.eval_batch_size, split = 'simulation', dense_dataset_layout = args.dense_datasets)
     pert_adata = pert_data.adata
+    test_loader = pert_data.dataloader['test_loader']
     
-    model, gene_ids =  load_trained_scgenept_model(pert_adata, model_type, 'models/', trained_model_location, device, verbose = False)
-    model.to(device)
-    print(model)
-   
-    print(f"Loaded best model from {trained_model_location}")
+    load_models = lambda: {model_name: load_trained_scgenept_model_from_config(trained_model_location, device, pert_adata, model_type, 'models/', verbose = False)
+                           for model_name, (model_type, trained_model_location) in models_to_evaluate.items()}
+    if args.num_workers > 1:
+        # Each worker loads its own model replicas, so that the models are not loaded in the parent process
+        print(f"Evaluating best models from {trained_model_locations} on test data with {args.num_workers} workers:")
+        streaming_metrics = eval_perturb_sharded(test_loader, load_models, device, INCLUDE_ZERO_GENE, args.num_workers)
+    else:
+        models = load_models()
+        print(f"Loaded best models from {trained_model_locations}")
+        
+        # Evaluate the best models on test data, reading each test batch once for all models
+        print(f"Evaluating best models on test data:")
+        streaming_metrics = eval_perturb_streaming_many(test_loader, models, device, INCLUDE_ZERO_GENE)
     
-    # Evaluate best model on test data  
-    print(f"Evaluating best model on test data:")
-    test_metrics = compute_test_metrics(pert_data, model, 'test', save_dir, device, INCLUDE_ZERO_GENE, gene_ids)
-    with open(save_dir / "metrics/test/test_metrics_detailed.json", "w") as outfile:
-        outfile.write(json.dumps(test_metrics))
\ No newline at end of file
+    for model_name, save_dir in save_dirs.items():
+        print(f"Test metrics of {model_name}:")
+        test_metrics = compute_test_metrics(pert_data, None, 'test', save_dir, device, INCLUDE_ZERO_GENE, None, 
+                                            streaming_metrics = streaming_metrics[model_name])
+        with open(save_dir / "metrics/test/test_metrics_detailed.json", "w") as outfile:
+            outfile.write(json.dumps(test_metrics))
@@ -6,17 +6,22 @@ import gc
 import pickle as pkl
 import matplotlib.pyplot as plt
 from utils.scgpt_config import *
+from utils.dense_dataset import DenseBatch
+from utils.batch_prefetcher import BatchPrefetcher
+from utils.distributed import all_reduce_sum, is_main_process
 
 import json
 import os
 import sys
 import time
 import copy
+import contextlib
 from pathlib import Path
 from typing import Iterable, List, Tuple, Dict, Union, Optional
 import warnings
 
 import torch
+import torch.utils.checkpoint
 import numpy as np
 import matplotlib
 from torch import nn, Tensor
@@ -100,7 +105,8 @@ class scGenePT(nn.Module):
         go_embs_to_include = None,
         go_emb_type = None,
         go_emb_size = 1536,
-        proj_layer = None
+        proj_layer = None,
+        compact_gene_ids = None
     ):
         super().__init__()
         self.model_type = "Transformer"
@@ -117,6 +123,7 @@ class scGenePT(nn.Module):
         self.embs_to_include = embs_to_include
         self.go_embs_to_include = go_embs_to_include
         self.go_emb_type = go_emb_type
+        self.ntoken = ntoken
         
         if cell_emb_style not in ["cls", "avg-pool", "w-pool"]:
             raise ValueError(f"Unknown cell_emb_style: {cell_emb_style}")
@@ -147,21 +154,26 @@ class scGenePT(nn.Module):
         # genePT gene token encoder
         if 'genePT_token_embs_gpt' in self.embs_to_include:
             self.genept_encoder = GenePTEncoder(ntoken, d_model, padding_idx=vocab[pad_token], genept_lookup_embed=genept_embs, 
-                                                genept_embs_size=genept_emb_size, proj_layer = proj_layer)
+                                                genept_embs_size=genept_emb_size, proj_layer = proj_layer, 
+                                                compact_gene_ids=compact_gene_ids)
         # GO Annotations gene token encoder
         if 'GO_token_embs_gpt_concat' in self.embs_to_include or 'GO_token_embs_gpt_avg' in self.embs_to_include:
             if go_emb_type == 'c':
                 self.gopt_encoder_c = GOPTEncoder(ntoken, d_model, padding_idx=vocab[pad_token], 
-                                          gopt_lookup_embed=go_embs_to_include[go_emb_type], gopt_embs_size=go_emb_size)
+                                          gopt_lookup_embed=go_embs_to_include[go_emb_type], gopt_embs_size=go_emb_size, 
+                                          compact_gene_ids=compact_gene_ids)
             elif go_emb_type == 'f':
                 self.gopt_encoder_f = GOPTEncoder(ntoken, d_model, padding_idx=vocab[pad_token], 
-                                          gopt_lookup_embed=go_embs_to_include[go_emb_type], gopt_embs_size=go_emb_size)
+                                          gopt_lookup_embed=go_embs_to_include[go_emb_type], gopt_embs_size=go_emb_size, 
+                                          compact_gene_ids=compact_gene_ids)
             elif go_emb_type == 'p':
                 self.gopt_encoder_p = GOPTEncoder(ntoken, d_model, padding_idx=vocab[pad_token], 
-                                          gopt_lookup_embed=go_embs_to_include[go_emb_type], gopt_embs_size=go_emb_size)
+                                          gopt_lookup_embed=go_embs_to_include[go_emb_type], gopt_embs_size=go_emb_size, 
+                                          compact_gene_ids=compact_gene_ids)
             elif go_emb_type == 'all':
                 self.gopt_encoder_f = GOPTEncoder(ntoken, d_model, padding_idx=vocab[pad_token], 
-                                          gopt_lookup_embed=go_embs_to_include[go_emb_type], gopt_embs_size=go_emb_size)
+                                          gopt_lookup_embed=go_embs_to_include[go_emb_type], gopt_embs_size=go_emb_size, 
+                                          compact_gene_ids=compact_gene_ids)
         # Perturbation flags encoder 
         self.pert_encoder = nn.Embedding(n_perturbagens + 1, d_model, padding_idx=pert_pad_id)
 
@@ -203,6 +215,12 @@ class scGenePT(nn.Module):
             )
         if 'scGPT_token_embs' in self.embs_to_include:
             self.init_weights()
+            
+        # Fused gene identity embeddings used at inference; set by freeze_gene_embeddings
+        self.register_buffer("fused_gene_embs", None, persistent=False)
+        self.register_buffer("fused_gene_index", None, persistent=False)
+        # Every k-th transformer layer is checkpointed during training if set; set by set_activation_checkpointing
+        self.checkpoint_every_k_layers = None
 
     def init_weights(self) -> None:
         initrange = 0.1
@@ -219,7 +237,9 @@ class scGenePT(nn.Module):
         Encodes a sequence of src gene tokens and count values
         
         Args: 
-            src: gene indices corresponding to the gene tokens to encode
+            src: gene indices corresponding to the gene tokens to encode; shape (batch, seq_len), or (1, seq_len) 
+                if all cells share the same gene tokens, in which case the gene token embeddings are computed once
+                and broadcast over the batch
             values: gene counts corresponding to the gene tokens in src
             input_pert_flags: perturbation flags corresponding to the genes in src; 1 if a gene is perturbed, 0 if not
             src_key_padding_mask: mask used during training for gene src tokens 
@@ -228,13 +248,90 @@ class scGenePT(nn.Module):
         # Mapping from embedding types 2 values
         embs2values = {}
         
+        # Encode the gene tokens, either with the fused lookup table at inference or with each gene token encoder
+        if self.fused_gene_embs is not None and not self.training:
+            fused_rows = self.fused_gene_index[src]
+            if (fused_rows < 0).any():
+                raise ValueError("src contains gene tokens that are not in the fused gene embeddings; "
+                                 "call freeze_gene_embeddings with these genes or unfreeze_gene_embeddings")
+            embs2values['fused_gene_token_embs'] = F.embedding(fused_rows, self.fused_gene_embs)
+        else:
+            embs2values.update(self._encode_gene_tokens(src))
+        # Encode the counts using scGPT counts encoder
+        if 'scGPT_counts_embs' in self.embs_to_include:
+            embs2values['scGPT_counts_embs']  = self.value_encoder(values)  # (batch, seq_len, embsize)
+        
+        # Encode the perturbation flags
+        embs2values['pert_embs'] = self.pert_encoder(input_pert_flags)
+             
+        # Add all embeddings together; gene token embeddings shared by the batch are broadcast
+        seen_embs = False
+        for emb, emb_value in embs2values.items():
+            if not seen_embs:
+                total_embs = emb_value
+                seen_embs = True
+            else:
+                total_embs = total_embs + emb_value
+        total_embs = total_embs.type(torch.float32)
+        total_embs = self.ln(total_embs)
+
+        # Feed embeddings into transformer_encoder
+        if self.checkpoint_every_k_layers and self.training and torch.is_grad_enabled():
+            output = self._checkpointed_transformer_encoder(total_embs, src_key_padding_mask)
+        else:
+            output = self.transformer_encoder(
+                total_embs, src_key_padding_mask=src_key_padding_mask
+            )
+        return output  # (batch, seq_len, embsize)
+
+    def _checkpointed_transformer_encoder(self, src: Tensor, src_key_padding_mask: Tensor) -> Tensor:
+        """
+        Runs the layers of transformer_encoder one after the other, as its forward does during training, checkpointing 
+        the activations of the layers returned by get_checkpointed_layers
+        """
+        checkpointed_layers = set(self.get_checkpointed_layers())
+        output = src
+        for i, layer in enumerate(self.transformer_encoder.layers):
+            if i in checkpointed_layers:
+                # the non-reentrant checkpoint restores the RNG state, so the recomputed dropout masks are the same
+                output = torch.utils.checkpoint.checkpoint(layer, output, src_key_padding_mask=src_key_padding_mask, 
+                                                           use_reentrant=False)
+            else:
+                output = layer(output, src_key_padding_mask=src_key_padding_mask)
+        if self.transformer_encoder.norm is not None:
+            output = self.transformer_encoder.norm(output)
+        return output
+
+    def full_vocab_state_dict(self) -> Dict[str, Tensor]:
+        """
+        Returns the state dict of the model in the full-vocab layout, ie with compact genePT/GO embedding tables 
+        expanded to one row per vocab gene, so that it can be loaded by models that don't use compact embeddings.
+        Rows of genes that are not in the compact tables are filled with zeros.
+        """
+        state_dict = self.state_dict()
+        for name, module in self.named_modules():
+            if isinstance(module, CompactGeneEmbedding):
+                state_dict[name + '.weight'] = module.full_vocab_weight()
+                del state_dict[name + '.compact_gene_ids']
+        return state_dict
+
+    def _encode_gene_tokens(self, src: Tensor) -> Dict[str, Tensor]:
+        """
+        Encodes a sequence of src gene tokens with the encoders that only depend on the gene identity, ie
+        the scGPT gene token encoder, the genePT encoder and the GO embeddings encoder
+        
+        Args: 
+            src: gene indices corresponding to the gene tokens to encode
+            
+        Returns:
+            mapping from embedding type to the encoded gene tokens, each of shape (batch, seq_len, embsize)
+        """
+        embs2values = {}
+        
         # Encode the gene tokens using scGPT gene token encoder
         if 'scGPT_token_embs' in self.embs_to_include:
             src_scgpt = self.encoder(src)  # (batch, seq_len, embsize)
             embs2values['scGPT_token_embs'] = src_scgpt
-        # Encode the counts using scGPT counts encoder
-        if 'scGPT_counts_embs' in self.embs_to_include:
-            embs2values['scGPT_counts_embs']  = self.value_encoder(values)  # (batch, seq_len, embsize)
         # Encode the gene tokens using the genePT encoder
         if 'genePT_token_embs_gpt' in self.embs_to_include or 'genePT_token_embs_llama' in self.embs_to_include:
             src_genept = self.genept_encoder(src)  # (batch, seq_len, embsize)
@@ -250,26 +347,87 @@ class scGenePT(nn.Module):
             elif self.go_emb_type == 'all':
                 src_go_embs = self.gopt_encoder_f(src)
             embs2values['GO_token_embs_' + self.go_emb_type] = src_go_embs
+        return embs2values
+
+    @torch.no_grad()
+    def freeze_gene_embeddings(self, gene_ids=None, check=True, atol=1e-5, chunk_size=4096) -> None:
+        """
+        Precomputes the sum of the gene identity embeddings (scGPT gene token, genePT and GO encoders) into a single
+        [n_genes, d_model] lookup table, so that inference does a single gather instead of running every gene token 
+        encoder, including the genePT/GO projections, for every token of every batch. The table is only used in eval mode 
+        and has to be recomputed if the model weights change.
         
-        # Encode the perturbation flags
-        embs2values['pert_embs'] = self.pert_encoder(input_pert_flags)
-             
-        # Add all embeddings together
-        seen_embs = False
-        for emb, emb_value in embs2values.items():
-            if not seen_embs:
-                total_embs = emb_value
-                seen_embs = True
-            else:
-                total_embs += emb_value
-        total_embs = total_embs.type(torch.float32)
-        total_embs = self.ln(total_embs)
+        Args:
+            gene_ids: vocab indices of the genes to precompute, eg the dataset genes; if None, the whole vocab is precomputed
+            check: if True, checks that the fused embeddings match the unfused encoders
+            atol: absolute tolerance of the check
+            chunk_size: number of genes to encode at once
+        """
+        self.unfreeze_gene_embeddings()
+        device = next(self.parameters()).device
+        if gene_ids is None:
+            fused_ids = torch.arange(self.ntoken, device=device)
+        else:
+            fused_ids = torch.as_tensor(np.asarray(gene_ids), device=device).long().flatten()
+            fused_ids = torch.cat([fused_ids, torch.tensor([self.pad_token_id], device=device)]).unique()
 
-        # Feed embeddings into transformer_encoder
-        output = self.transformer_encoder(
-            total_embs, src_key_padding_mask=src_key_padding_mask
-        )
-        return output  # (batch, seq_len, embsize)
+        was_training = self.training
+        self.eval()
+        fused_gene_embs = []
+        for i in range(0, len(fused_ids), chunk_size):
+            embs2values = self._encode_gene_tokens(fused_ids[i : i + chunk_size].unsqueeze(0))
+            if len(embs2values) == 0:
+                # None of the gene token encoders are used by this model, so there is nothing to fuse
+                self.train(was_training)
+                return
+            fused_gene_embs.append(sum(embs2values.values())[0].float())
+        self.train(was_training)
+
+        self.fused_gene_embs = torch.cat(fused_gene_embs)
+        self.fused_gene_index = torch.full((self.ntoken,), -1, dtype=torch.long, device=device)
+        self.fused_gene_index[fused_ids] = torch.arange(len(fused_ids), device=device)
+
+        if check:
+            for i in range(0, len(fused_ids), chunk_size):
+                src = fused_ids[i : i + chunk_size].unsqueeze(0)
+                unfused = sum(self._encode_gene_tokens(src).values()).float()
+                fused = F.embedding(self.fused_gene_index[src], self.fused_gene_embs)
+                max_diff = (fused - unfused).abs().max().item()
+                if max_diff > atol:
+                    self.unfreeze_gene_embeddings()
+                    raise ValueError(f"Fused gene embeddings differ from the unfused encoders by {max_diff} > {atol}")
+
+    def unfreeze_gene_embeddings(self) -> None:
+        """
+        Removes the fused gene embeddings created by freeze_gene_embeddings; the gene token encoders are used again.
+        """
+        self.fused_gene_embs = None
+        self.fused_gene_index = None
+
+    def set_activation_checkpointing(self, every_k_layers = 1) -> None:
+        """
+        Checkpoints the activations of every k-th layer of transformer_encoder during training: the checkpointed layers
+        only keep their inputs for the backward pass and recompute their activations, including the dropout masks, 
+        instead of storing them. This trades about one extra forward pass of these layers for the memory of their 
+        activations, which grows with max_seq_len. Works with both the PyTorch and the flash encoder layers; only the
+        setting is stored on the model, so the layers and the state dict of the model are unchanged, and calling it again
+        replaces the previous setting.
+        
+        Args:
+            every_k_layers: layers 0, k, 2k, ... are checkpointed; 1 checkpoints every layer, 0 or None disables checkpointing
+        """
+        if not hasattr(self.transformer_encoder, "layers"):
+            raise ValueError(f"Activation checkpointing is not supported for {type(self.transformer_encoder).__name__}")
+        self.checkpoint_every_k_layers = every_k_layers or None
+
+    def get_checkpointed_layers(self) -> List[int]:
+        """
+        Returns the indices of the layers of transformer_encoder whose activations are checkpointed during training, 
+        see set_activation_checkpointing
+        """
+        if not self.checkpoint_every_k_layers:
+            return []
+        return list(range(0, len(self.transformer_encoder.layers), self.checkpoint_every_k_layers))
 
     # Not modified from original scGPT architecture
     def _get_cell_emb_from_layer(
@@ -314,7 +472,7 @@ class scGenePT(nn.Module):
         Forward pass through the model 
         
         Args:
-            src (:obj:`Tensor`): token ids, shape [batch_size, seq_len]
+            src (:obj:`Tensor`): token ids, shape [batch_size, seq_len], or [1, seq_len] if shared by all cells in the batch
             values (:obj:`Tensor`): token values, shape [batch_size, seq_len]
             src_key_padding_mask (:obj:`Tensor`): mask for src, shape [batch_size,
                 seq_len]
@@ -400,7 +558,9 @@ class scGenePT(nn.Module):
         gene_ids=None,
         amp=True,
         pool_size = None, 
-        return_mean = True
+        return_mean = True,
+        batch_size = 8,
+        pool_seed = None
     ) -> Tensor:
         """
         Perturbation prediction from a control sample
@@ -413,6 +573,9 @@ class scGenePT(nn.Module):
             gene_ids: gene_ids to predict for 
             pool_size: number of control samples to predict for; if None, predicts over all; otherwise, samples randomly for pool_size
             return_mean: if True, returns mean of prediction over control samples; else returns a list of all predictions
+            batch_size: number of control samples to run through the model at once; larger values increase 
+                throughput at the cost of memory
+            pool_seed: if not None, seed of the sampling of the control samples, see get_ctrl_pool
 
         Returns:
             output Tensor of shape [N, seq_len]
@@ -420,44 +583,110 @@ class scGenePT(nn.Module):
         self.eval()
         gene_ids = torch.tensor(gene_ids).long().unsqueeze(0).to(device)
 
-        if pool_size == None:
-            pool_size = len(adata_ctrl)
-
-        ctrls = np.array(adata_ctrl[np.random.randint(0, len(adata_ctrl), pool_size)].X.toarray())
-        src_key_padding_mask = torch.zeros_like(
-            gene_ids, dtype=torch.bool, device=device
-        )
+        ctrls = get_ctrl_pool(adata_ctrl, pool_size, pool_seed)
+        pool_size = len(ctrls)
+        
+        # The perturbation flags are the same for every control cell, so they only need to be built once
+        pert_flags = get_pert_flags(perturbation, gene_names, ctrls.shape[1]).to(device)
 
         all_pred_gene_values = []
-        for ori_gene_values in ctrls:
-            pert_flags = np.zeros(len(ori_gene_values))
-
-            if perturbation != 'ctrl':
-                for x in perturbation.split('+'):
-                    if x != 'ctrl':
-                        pert_flags[gene_names.index(x)] = 1
-            pert_flags = torch.from_numpy(pert_flags).long().to(device).unsqueeze(0)
-            ori_gene_values = torch.from_numpy(np.expand_dims(ori_gene_values, 0)).to(dtype = torch.float32).to(device)
-            # model = model.to(torch.float32)
-            with torch.cuda.amp.autocast(enabled=amp):
-                with torch.no_grad():
-                    output_dict = self(
-                        gene_ids,
-                        ori_gene_values,
-                        pert_flags,
-                        src_key_padding_mask=src_key_padding_mask,
-                        CLS=False,
-                        CCE=False,
-                        MVC=False,
-                        ECS=False,
-                        do_sample=True,
-                    )
-                pred_gene_values = output_dict["mlm_output"].float().detach().cpu().numpy()
-                all_pred_gene_values.append(pred_gene_values)
+        for i in range(0, pool_size, batch_size):
+            ori_gene_values = ctrls[i : i + batch_size].to(device)
+            pred_gene_values = self._pred_from_ctrl_values(gene_ids, ori_gene_values, pert_flags, amp)
+            all_pred_gene_values.append(pred_gene_values.detach().cpu().numpy())
+        all_pred_gene_values = np.concatenate(all_pred_gene_values, axis = 0)
         if return_mean:
-            return np.mean(all_pred_gene_values, axis = 0)
+            return np.mean(all_pred_gene_values, axis = 0, keepdims = True)
         else:
-            return np.array(all_pred_gene_values)
+            return np.expand_dims(all_pred_gene_values, 1)
+
+    def pred_perturb_many(
+        self,
+        adata_ctrl,
+        perturbations,
+        gene_names,
+        device,
+        gene_ids=None,
+        amp=True,
+        pool_size = None,
+        batch_size = 8,
+        ctrl_pool = None,
+        out = None
+    ) -> np.ndarray:
+        """
+        Mean perturbation prediction over a shared control pool for many perturbations at once. 
+        The control pool is densified once and (control cell, perturbation) pairs are packed into 
+        batches of batch_size, so the cost scales with the number of batches rather than the number of calls.
+        
+        Args:
+            adata_ctrl: adata control sample to predict from; ignored if ctrl_pool is given
+            perturbations: list of perturbations, in str form; eg ['FOSB+ctrl', 'SAMD1+ZBTB1']
+            gene_names: list of gene names in the dataset the model has been trained on
+            gene_ids: gene_ids to predict for 
+            pool_size: number of control samples to predict for; if None, predicts over all; otherwise, samples randomly for pool_size
+            batch_size: number of (control cell, perturbation) pairs to run through the model at once
+            ctrl_pool: optional pre-built control pool tensor of shape [pool_size, n_genes], eg from get_ctrl_pool
+            out: optional preallocated array of shape [len(perturbations), n_genes] to write the predictions to
+
+        Returns:
+            array of shape [len(perturbations), n_genes] with the mean prediction over the control pool for each perturbation
+        """
+        self.eval()
+        gene_ids = torch.tensor(gene_ids).long().unsqueeze(0).to(device)
+
+        if ctrl_pool is None:
+            ctrl_pool = get_ctrl_pool(adata_ctrl, pool_size)
+        ctrl_pool = ctrl_pool.to(device)
+        n_ctrls, n_genes = ctrl_pool.shape
+        n_perts = len(perturbations)
+
+        pert_flags = torch.cat(
+            [get_pert_flags(perturbation, gene_names, n_genes) for perturbation in perturbations]
+        ).to(device)
+        pred_sums = torch.zeros(n_perts, n_genes, dtype=torch.float64, device=device)
+
+        n_pairs = n_perts * n_ctrls
+        for start in range(0, n_pairs, batch_size):
+            pair_idx = torch.arange(start, min(start + batch_size, n_pairs), device=device)
+            pert_idx = pair_idx // n_ctrls
+            ctrl_idx = pair_idx % n_ctrls
+            pred_gene_values = self._pred_from_ctrl_values(gene_ids, ctrl_pool[ctrl_idx], pert_flags[pert_idx], amp)
+            pred_sums.index_add_(0, pert_idx, pred_gene_values.double())
+
+        if out is None:
+            out = np.empty((n_perts, n_genes), dtype=np.float32)
+        out[:] = (pred_sums / n_ctrls).cpu().numpy()
+        return out
+
+    def _pred_from_ctrl_values(self, gene_ids, ori_gene_values, pert_flags, amp=True) -> Tensor:
+        """
+        Runs a batch of control cells through the model
+        
+        Args:
+            gene_ids: vocab indices of the genes in the control cells, shape [1, n_genes]; shared by all cells
+            ori_gene_values: control cell gene counts, shape [batch_size, n_genes]
+            pert_flags: perturbation flags, shape [1, n_genes] if shared by all cells or [batch_size, n_genes]
+            
+        Returns:
+            predicted post-perturbation gene counts, shape [batch_size, n_genes]
+        """
+        src_key_padding_mask = torch.zeros_like(
+            ori_gene_values, dtype=torch.bool, device=ori_gene_values.device
+        )
+        with torch.cuda.amp.autocast(enabled=amp):
+            with torch.no_grad():
+                output_dict = self(
+                    gene_ids,
+                    ori_gene_values,
+                    pert_flags,
+                    src_key_padding_mask=src_key_padding_mask,
+                    CLS=False,
+                    CCE=False,
+                    MVC=False,
+                    ECS=False,
+                    do_sample=True,
+                )
+        return output_dict["mlm_output"].float()
     
     def pred_perturb(
         self,
@@ -465,23 +694,31 @@ class scGenePT(nn.Module):
         include_zero_gene="batch-wise",
         gene_ids=None,
         amp=True,
-        pert_type = 'intrinsic'
+        pert_type = 'intrinsic',
+        context_budget = None
     ) -> Tensor:
         """
         Perturbation prediction for a given batch of data
         
         Args:
-            batch_data: a dictionary of input data with keys
+            batch_data: a dictionary of input data with keys, a PertData batch object or a DenseBatch
             include_zero_gene: True if to include zero genes
             gene_ids: gene_ids to predict for 
             pert_type: intrinsic or extrinsic, depending on perturbation type
+            context_budget: if not None, a ContextBudget (see utils/context_genes.py) limiting the genes input to the 
+                model, in which case include_zero_gene is ignored and the genes outside of the context keep their 
+                control value
 
         Returns:
             output Tensor of shape [N, seq_len]
         """
         self.eval()
         device = next(self.parameters()).device
-        if pert_type == 'intrinsic':
+        if pert_type == 'intrinsic' and isinstance(batch_data, DenseBatch):
+            batch_data.to(device)
+            ori_gene_values = batch_data.ctrl  # (batch_size, n_genes)
+            pert_flags = batch_data.pert_flags
+        elif pert_type == 'intrinsic':
             batch_data.to(device)
             batch_size = len(batch_data.pert)
             x: torch.Tensor = batch_data.x
@@ -495,9 +732,11 @@ class scGenePT(nn.Module):
         ori_gene_values = ori_gene_values.to(device)
         pert_flags = pert_flags.to(device)
 
-        if include_zero_gene in ["all", "batch-wise"]:
-            assert gene_ids is not None
-            if include_zero_gene == "all":
+        assert gene_ids is not None
+        if context_budget is not None or include_zero_gene in ["all", "batch-wise"]:
+            if context_budget is not None:
+                input_gene_ids = context_budget.get_context_gene_ids(pert_flags)
+            elif include_zero_gene == "all":
                 input_gene_ids = torch.arange(ori_gene_values.size(1), device=device)
             else:  # batch-wise
                 input_gene_ids = (
@@ -506,27 +745,46 @@ class scGenePT(nn.Module):
             input_values = ori_gene_values[:, input_gene_ids]
             input_pert_flags = pert_flags[:, input_gene_ids]
 
-            mapped_input_gene_ids = map_raw_id_to_vocab_id(input_gene_ids, gene_ids)
-            mapped_input_gene_ids = mapped_input_gene_ids.repeat(batch_size, 1)
+            # gene tokens are shared by all cells in the batch, so they are encoded once and broadcast
+            mapped_input_gene_ids = map_raw_id_to_vocab_id(input_gene_ids, gene_ids).unsqueeze(0)
 
             src_key_padding_mask = torch.zeros_like(
                 input_values, dtype=torch.bool, device=device
             )
-            with torch.cuda.amp.autocast(enabled=amp):
-                with torch.no_grad():
-                    output_dict = self(
-                        mapped_input_gene_ids,
-                        input_values,
-                        input_pert_flags,
-                        src_key_padding_mask=src_key_padding_mask,
-                        CLS=False,
-                        CCE=False,
-                        MVC=False,
-                        ECS=False,
-                        do_sample=True,
-                    )
-            output_values = output_dict["mlm_output"].float()
+        elif include_zero_gene == "row-wise":
+            # each cell only keeps its own genes, so the prediction covers all of them and no gene needs to be sampled
+            input_gene_ids, src_key_padding_mask = get_row_wise_gene_ids(ori_gene_values, pert_flags, ori_gene_values.size(1))
+            input_values = ori_gene_values.gather(1, input_gene_ids).masked_fill(src_key_padding_mask, self.pad_value)
+            input_pert_flags = pert_flags.gather(1, input_gene_ids).masked_fill(src_key_padding_mask, self.pert_pad_id)
+            mapped_input_gene_ids = torch.as_tensor(gene_ids, device=device)[input_gene_ids].masked_fill(
+                src_key_padding_mask, self.pad_token_id)
+        else:
+            raise ValueError(f"Unknown include_zero_gene: {include_zero_gene}")
+
+        with torch.cuda.amp.autocast(enabled=amp):
+            with torch.no_grad():
+                output_dict = self(
+                    mapped_input_gene_ids,
+                    input_values,
+                    input_pert_flags,
+                    src_key_padding_mask=src_key_padding_mask,
+                    CLS=False,
+                    CCE=False,
+                    MVC=False,
+                    ECS=False,
+                    do_sample=True,
+                )
+        output_values = output_dict["mlm_output"].float()
+        if context_budget is not None:
+            pred_gene_values = ori_gene_values.clone()
+        else:
             pred_gene_values = torch.zeros_like(ori_gene_values)
+        if context_budget is None and include_zero_gene == "row-wise":
+            # padded positions point to gene 0, so only the unpadded predictions are scattered back
+            cell_idx = torch.arange(len(input_gene_ids), device=device).unsqueeze(1).expand_as(input_gene_ids)
+            unpadded = ~src_key_padding_mask
+            pred_gene_values[cell_idx[unpadded], input_gene_ids[unpadded]] = output_values[unpadded]
+        else:
             pred_gene_values[:, input_gene_ids] = output_values
         return pred_gene_values
 
@@ -557,6 +815,83 @@ class GeneEncoder(nn.Module):
         x = self.enc_norm(x)
         return x
                 
+class CompactGeneEmbedding(nn.Embedding):
+    def __init__(
+        self,
+        embeddings: Tensor,
+        compact_gene_ids,
+        num_embeddings: int,
+        padding_idx: Optional[int] = None,
+    ):
+        """
+        Embedding layer that only stores the rows of a subset of the vocab, eg the dataset genes and the pad token, 
+        instead of one row per vocab gene. Vocab indices are mapped to compact rows on lookup.
+        
+        Args: 
+            embeddings: pre-trained embeddings for the compact rows, of shape [len(compact_gene_ids), embedding_dim]
+            compact_gene_ids: sorted vocab indices of the genes stored in the compact rows
+            num_embeddings: number of genes in the full vocab
+            padding_idx: vocab index of the padding token; must be in compact_gene_ids
+        """
+        compact_gene_ids = np.asarray(compact_gene_ids)
+        compact_padding_idx = None
+        if padding_idx is not None:
+            compact_padding_idx = int(np.where(compact_gene_ids == padding_idx)[0][0])
+        super().__init__(len(compact_gene_ids), embeddings.shape[1], padding_idx=compact_padding_idx, _weight=embeddings)
+        self.num_vocab_embeddings = num_embeddings
+        self.register_buffer("compact_gene_ids", torch.as_tensor(compact_gene_ids).long())
+        self.register_buffer("vocab2compact", None, persistent=False)
+        self._build_vocab2compact()
+
+    def _build_vocab2compact(self) -> None:
+        """
+        Builds the mapping from vocab indices to compact rows; genes outside of the compact rows are mapped to the padding row
+        """
+        device = self.compact_gene_ids.device
+        vocab2compact = torch.full((self.num_vocab_embeddings,), self.padding_idx or 0, dtype=torch.long, device=device)
+        vocab2compact[self.compact_gene_ids] = torch.arange(len(self.compact_gene_ids), device=device)
+        self.vocab2compact = vocab2compact
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super()._load_from_state_dict(*args, **kwargs)
+        # compact_gene_ids may have been replaced, eg when loading into a model created on the meta device
+        self._build_vocab2compact()
+
+    def forward(self, x: Tensor) -> Tensor:
+        return super().forward(self.vocab2compact[x])
+
+    def full_vocab_weight(self) -> Tensor:
+        """
+        Returns the embedding weights in the full-vocab layout, with zeros for genes outside of the compact rows.
+        """
+        weight = torch.zeros(self.num_vocab_embeddings, self.embedding_dim, dtype=self.weight.dtype, device=self.weight.device)
+        weight[self.compact_gene_ids] = self.weight.detach()
+        return weight
+
+
+def load_compact_embedding_hook(module, state_dict, prefix, *args):
+    """
+    Load state dict pre-hook for the genePT/GO encoders that converts between the full-vocab and the compact 
+    embedding layouts, so that checkpoints saved in either layout can be loaded by models using either layout.
+    """
+    weight_key = prefix + 'embedding.weight'
+    compact_gene_ids_key = prefix + 'embedding.compact_gene_ids'
+    if weight_key not in state_dict:
+        return
+    weight = state_dict[weight_key]
+    if isinstance(module.embedding, CompactGeneEmbedding):
+        # full-vocab checkpoint -> compact model
+        if compact_gene_ids_key not in state_dict and weight.shape[0] == module.embedding.num_vocab_embeddings:
+            state_dict[weight_key] = weight[module.embedding.compact_gene_ids.to(weight.device)]
+            state_dict[compact_gene_ids_key] = module.embedding.compact_gene_ids
+    elif compact_gene_ids_key in state_dict:
+        # compact checkpoint -> full-vocab model
+        compact_gene_ids = state_dict.pop(compact_gene_ids_key).to(weight.device)
+        full_weight = module.embedding.weight.detach().clone().to(device=weight.device, dtype=weight.dtype)
+        full_weight[compact_gene_ids] = weight
+        state_dict[weight_key] = full_weight
+
+
 class GenePTEncoder(nn.Module):
     def __init__(
         self,
@@ -565,7 +900,8 @@ class GenePTEncoder(nn.Module):
         proj_layer = None,
         padding_idx: Optional[int] = None,
         genept_lookup_embed: Optional = [],
-        genept_embs_size = 1536
+        genept_embs_size = 1536,
+        compact_gene_ids = None
     ):
         """
         Encodes a gene token during training using textual genePT representations. 
@@ -575,11 +911,24 @@ class GenePTEncoder(nn.Module):
             num_embeddings: number of genes
             embedding_dim: dimension of the gene
             padding_idx: padding_idx for the Embedding
-            genept_lookup_embed: pre-trained embeddings used to initialize the Embedding layer
+            genept_lookup_embed: pre-trained embeddings used to initialize the Embedding layer; if None, the Embedding 
+                layer is left uninitialized, eg when loading a trained model
             genept_embs_size: size of the pre-trained embeddings
+            compact_gene_ids: if not None, genept_lookup_embed only holds the rows of these vocab indices 
+                (see CompactGeneEmbedding)
         """
         super().__init__()
-        self.embedding = nn.Embedding.from_pretrained(torch.from_numpy(genept_lookup_embed), freeze = False, padding_idx=padding_idx)
+        if genept_lookup_embed is None:
+            # the weights will be loaded from a trained checkpoint, so they don't need to be initialized
+            n_rows = num_embeddings if compact_gene_ids is None else len(compact_gene_ids)
+            genept_lookup_embed = torch.empty(n_rows, genept_embs_size)
+        else:
+            genept_lookup_embed = torch.from_numpy(genept_lookup_embed)
+        if compact_gene_ids is not None:
+            self.embedding = CompactGeneEmbedding(genept_lookup_embed, compact_gene_ids, num_embeddings, padding_idx=padding_idx)
+        else:
+            self.embedding = nn.Embedding.from_pretrained(genept_lookup_embed, freeze = False, padding_idx=padding_idx)
+        self._register_load_state_dict_pre_hook(load_compact_embedding_hook, with_module=True)
         self.enc_norm = nn.LayerNorm(genept_embs_size)
         if proj_layer:
             print("Using a learned projection layer")
@@ -602,7 +951,8 @@ class GOPTEncoder(nn.Module):
         embedding_dim: int,
         padding_idx: Optional[int] = None,
         gopt_lookup_embed: Optional = [],
-        gopt_embs_size = 1536
+        gopt_embs_size = 1536,
+        compact_gene_ids = None
     ):
         """
         Encodes a gene token during training using textual GO annotations. 
@@ -612,11 +962,24 @@ class GOPTEncoder(nn.Module):
             num_embeddings: number of genes
             embedding_dim: dimension of the gene
             padding_idx: padding_idx for the Embedding
-            genept_lookup_embed: pre-trained embeddings used to initialize the Embedding layer
+            genept_lookup_embed: pre-trained embeddings used to initialize the Embedding layer; if None, the Embedding 
+                layer is left uninitialized, eg when loading a trained model
             genept_embs_size: size of the pre-trained embeddings
+            compact_gene_ids: if not None, gopt_lookup_embed only holds the rows of these vocab indices 
+                (see CompactGeneEmbedding)
         """
         super().__init__()
-        self.embedding = nn.Embedding.from_pretrained(torch.from_numpy(gopt_lookup_embed), freeze = False, padding_idx=padding_idx)
+        if gopt_lookup_embed is None:
+            # the weights will be loaded from a trained checkpoint, so they don't need to be initialized
+            n_rows = num_embeddings if compact_gene_ids is None else len(compact_gene_ids)
+            gopt_lookup_embed = torch.empty(n_rows, gopt_embs_size)
+        else:
+            gopt_lookup_embed = torch.from_numpy(gopt_lookup_embed)
+        if compact_gene_ids is not None:
+            self.embedding = CompactGeneEmbedding(gopt_lookup_embed, compact_gene_ids, num_embeddings, padding_idx=padding_idx)
+        else:
+            self.embedding = nn.Embedding.from_pretrained(gopt_lookup_embed, freeze = False, padding_idx=padding_idx)
+        self._register_load_state_dict_pre_hook(load_compact_embedding_hook, with_module=True)
         self.fc = nn.Linear(gopt_embs_size, embedding_dim)
         self.enc_norm = nn.LayerNorm(embedding_dim)
 
@@ -658,28 +1021,138 @@ class ClsDecoder(nn.Module):
         return self.out_layer(x)
     
     
-def get_batch_data(batch_data, include_zero_gene, n_genes, max_seq_len, gene_ids, device):
+def get_ctrl_pool_idx(n_ctrl_cells, pool_size = None, pool_seed = None):
+    """
+    Randomly samples, with replacement, the indices of the control cells of a control pool, see get_ctrl_pool
+    
+    Args:
+        n_ctrl_cells: number of control cells to sample from
+        pool_size: number of control samples to sample; if None, samples n_ctrl_cells cells
+        pool_seed: if not None, the indices are sampled with their own generator seeded with pool_seed; otherwise, 
+            they are sampled with the global numpy RNG
+        
+    Returns:
+        ctrl_idx: array of pool_size indices
+    """
+    if pool_size == None:
+        pool_size = n_ctrl_cells
+    if pool_seed is not None:
+        return np.random.default_rng(pool_seed).integers(0, n_ctrl_cells, pool_size)
+    return np.random.randint(0, n_ctrl_cells, pool_size)
+
+
+def get_ctrl_pool(adata_ctrl, pool_size = None, pool_seed = None):
+    """
+    Randomly samples a pool of control cells and densifies it once, so that it can be reused across predictions.
+    
+    Args:
+        adata_ctrl: adata control sample to sample from
+        pool_size: number of control samples to sample; if None, samples len(adata_ctrl) cells
+        pool_seed: if not None, the pool is sampled with its own generator seeded with pool_seed, so that the same pool
+            is sampled for the same seed; otherwise, it is sampled with the global numpy RNG
+        
+    Returns:
+        ctrl_pool: float32 tensor of shape [pool_size, n_genes]
+    """
+    ctrl_idx = get_ctrl_pool_idx(len(adata_ctrl), pool_size, pool_seed)
+    ctrls = np.array(adata_ctrl[ctrl_idx].X.toarray())
+    return torch.from_numpy(ctrls).to(dtype = torch.float32)
+
+
+def get_pert_flags(perturbation, gene_names, n_genes):
+    """
+    Builds the perturbation flags vector for a perturbation.
+    
+    Args:
+        perturbation: perturbation type, in str form; eg 'FOSB+ctrl', 'SAMD1+ZBTB1'
+        gene_names: list of gene names in the dataset the model has been trained on
+        n_genes: number of total genes in the sequence
+        
+    Returns:
+        pert_flags: tensor of shape [1, n_genes]; 1 if gene is perturbed, 0 if not
     """
-    Parses a batch of data from a PertData batch object.
+    pert_flags = np.zeros(n_genes)
+    if perturbation != 'ctrl':
+        for x in perturbation.split('+'):
+            if x != 'ctrl':
+                pert_flags[gene_names.index(x)] = 1
+    return torch.from_numpy(pert_flags).long().unsqueeze(0)
+
+    
+def get_row_wise_gene_ids(gene_values, pert_flags, max_seq_len, generator = None):
+    """
+    Selects the genes of each cell for the "row-wise" include_zero_gene mode: its nonzero genes and its perturbed genes,
+    padded to the longest cell of the batch. Cells with more than max_seq_len genes keep a random subset of max_seq_len.
+    
+    Args:
+        gene_values: gene counts of the cells, shape [batch_size, n_genes]
+        pert_flags: perturbation flags of the cells, shape [batch_size, n_genes]
+        max_seq_len: max number of genes to keep per cell
+        generator: torch.Generator on the device of gene_values used to sample genes; if None, the global torch RNG is used
+        
+    Returns:
+        input_gene_ids: indices of the selected genes in the sequence, sorted within each cell, shape [batch_size, seq_len];
+            padded positions are set to 0
+        src_key_padding_mask: True on padded positions, shape [batch_size, seq_len]
+    """
+    keep = (gene_values != 0) | (pert_flags == 1)
+    # a cell without any selected gene would only attend to padding
+    keep[keep.sum(1) == 0, 0] = True
+    n_kept = keep.sum(1)
+    lengths = n_kept.clamp(max=max_seq_len)
+    seq_len = int(lengths.max())
+    
+    # the kept genes of each cell sort first; they are shuffled if some of them have to be dropped
+    if (n_kept > max_seq_len).any():
+        sort_keys = torch.rand(keep.shape, device=keep.device, generator=generator) + (~keep)
+    else:
+        sort_keys = (~keep).float()
+    input_gene_ids = sort_keys.sort(dim=1, stable=True)[1][:, :seq_len]
+    src_key_padding_mask = torch.arange(seq_len, device=keep.device).unsqueeze(0) >= lengths.unsqueeze(1)
+    
+    # sort the genes of each cell, keeping the padded positions last
+    input_gene_ids = input_gene_ids.masked_fill(src_key_padding_mask, keep.size(1)).sort(dim=1)[0]
+    input_gene_ids = input_gene_ids.masked_fill(src_key_padding_mask, 0)
+    return input_gene_ids, src_key_padding_mask
+
+    
+def get_batch_data(batch_data, include_zero_gene, n_genes, max_seq_len, gene_ids, device, generator = None, 
+                   pad_token_id = None, pad_value = PAD_VALUE, pert_pad_id = PERT_PAD_ID):
+    """
+    Parses a batch of data from a PertData batch object or a DenseBatch (see utils/dense_dataset.py).
     
     Args:
-        include_zero_gene: true if to include zero genes
+        batch_data: batch of data
+        include_zero_gene: which genes are input to the model; "all" for all genes, "batch-wise" for the genes that are 
+            nonzero in any cell of the batch, "row-wise" for the nonzero and perturbed genes of each cell, padded with 
+            src_key_padding_mask
         n_genes: number of total genes in the sequence
         max_seq_len: max sequence length to use during training
         gene_ids: vocab indices of the n_genes in the sequence
         device: device used for training
+        generator: torch.Generator on device used to sample genes when there are more than max_seq_len; 
+            if None, the global torch RNG is used
+        pad_token_id: vocab index of the padding token, used on padded positions in "row-wise" mode; 
+            required in "row-wise" mode
+        pad_value: count value used on padded positions in "row-wise" mode
+        pert_pad_id: perturbation flag used on padded positions in "row-wise" mode
         
     Returns:
-        mapped_input_gene_ids: src token indices corresponding to sampled gene tokens
+        mapped_input_gene_ids: src token indices corresponding to sampled gene tokens, shape [1, seq_len] if shared by 
+            all cells in the batch ("all", "batch-wise") or [batch_size, seq_len] ("row-wise")
         input_values: gene count values corresponding to mapped_input_gene_ids
         input_pert_flags: perturbation flags corresponding to mapped_input_gene_ids; 1 if gene is perturbed, 0 if not
-        src_key_padding_mask: mask for src token indices
+        src_key_padding_mask: mask for src token indices; True on padded positions
         target_values: target post-perturbation values for sampled gene tokens corresponding to mapped_input_genes_ids
     """
     batch_size = len(batch_data.y)
-    x: torch.Tensor = batch_data.x  # (batch_size * n_genes, 2)
-    ori_gene_values = x[:, 0].view(batch_size, n_genes)
-    pert_flags = x[:, 1].long().view(batch_size, n_genes)
+    if isinstance(batch_data, DenseBatch):
+        ori_gene_values = batch_data.ctrl  # (batch_size, n_genes)
+        pert_flags = batch_data.pert_flags
+    else:
+        x: torch.Tensor = batch_data.x  # (batch_size * n_genes, 2)
+        ori_gene_values = x[:, 0].view(batch_size, n_genes)
+        pert_flags = x[:, 1].long().view(batch_size, n_genes)
     target_gene_values = batch_data.y  # (batch_size, n_genes)
         
     
@@ -692,60 +1165,172 @@ def get_batch_data(batch_data, include_zero_gene, n_genes, max_seq_len, gene_ids
             )
         # sample input_gene_id
         if len(input_gene_ids) > max_seq_len:
-            input_gene_ids = torch.randperm(len(input_gene_ids), device=device)[
+            input_gene_ids = torch.randperm(len(input_gene_ids), device=device, generator=generator)[
                 :max_seq_len
             ]
         input_values = ori_gene_values[:, input_gene_ids]
         input_pert_flags = pert_flags[:, input_gene_ids]
         target_values = target_gene_values[:, input_gene_ids]
 
-        mapped_input_gene_ids = map_raw_id_to_vocab_id(input_gene_ids, gene_ids)
-        mapped_input_gene_ids = mapped_input_gene_ids.repeat(batch_size, 1)
+        # gene tokens are shared by all cells in the batch, so they are encoded once and broadcast
+        mapped_input_gene_ids = map_raw_id_to_vocab_id(input_gene_ids, gene_ids).unsqueeze(0)
         src_key_padding_mask = torch.zeros_like(
             input_values, dtype=torch.bool, device=device
         )
+    elif include_zero_gene == "row-wise":
+        if pad_token_id is None:
+            raise ValueError("pad_token_id is required when include_zero_gene is row-wise")
+        input_gene_ids, src_key_padding_mask = get_row_wise_gene_ids(ori_gene_values, pert_flags, max_seq_len, generator)
+        input_values = ori_gene_values.gather(1, input_gene_ids).masked_fill(src_key_padding_mask, pad_value)
+        input_pert_flags = pert_flags.gather(1, input_gene_ids).masked_fill(src_key_padding_mask, pert_pad_id)
+        target_values = target_gene_values.gather(1, input_gene_ids).masked_fill(src_key_padding_mask, pad_value)
+        mapped_input_gene_ids = torch.as_tensor(gene_ids, device=device)[input_gene_ids].masked_fill(
+            src_key_padding_mask, pad_token_id)
+    else:
+        raise ValueError(f"Unknown include_zero_gene: {include_zero_gene}")
     return mapped_input_gene_ids, input_values, input_pert_flags, src_key_padding_mask, target_values
 
     
         
+def split_batch_inputs(batch_inputs, micro_batch_size):
+    """
+    Splits the inputs of a batch returned by get_batch_data into micro-batches of micro_batch_size cells. 
+    Gene tokens shared by the batch stay shared; row-wise micro-batches are trimmed to their longest cell.
+    
+    Args:
+        batch_inputs: tuple returned by get_batch_data
+        micro_batch_size: number of cells per micro-batch
+        
+    Returns:
+        list of tuples with the same layout as batch_inputs
+    """
+    mapped_input_gene_ids, input_values, input_pert_flags, src_key_padding_mask, target_values = batch_inputs
+    micro_batches = []
+    for start in range(0, len(input_values), micro_batch_size):
+        cells = slice(start, start + micro_batch_size)
+        micro_batch = [mapped_input_gene_ids[cells] if mapped_input_gene_ids.size(0) > 1 else mapped_input_gene_ids, 
+                       input_values[cells], input_pert_flags[cells], src_key_padding_mask[cells], target_values[cells]]
+        if mapped_input_gene_ids.size(0) > 1:
+            # padded positions are at the end of each row
+            seq_len = int((~micro_batch[3]).sum(1).max())
+            micro_batch = [inputs[:, :seq_len] for inputs in micro_batch]
+        micro_batches.append(tuple(micro_batch))
+    return micro_batches
+
+
+def get_auto_micro_batch_size(model, seq_len, memory_budget_gb, amp = True):
+    """
+    Estimates the largest micro-batch size whose training fits in a memory budget, from the memory of the parameters, 
+    their gradients and Adam states, and an estimate of the activations each cell stores for the backward pass in 
+    the transformer layers (the attention scores grow with seq_len ** 2). Layers with activation checkpointing only
+    store their input (see scGenePT.set_activation_checkpointing). This is an estimate; leave some headroom in the budget.
+    
+    Args:
+        model: scGenePT model to train
+        seq_len: number of genes input per cell, eg min(n_genes, max_seq_len)
+        memory_budget_gb: memory available for training, in GB
+        amp: True if training with mixed precision, in which case activations are stored in half precision
+        
+    Returns:
+        micro_batch_size: estimated micro-batch size, at least 1
+    """
+    n_params = sum(p.numel() for p in model.parameters())
+    param_bytes = 4 * n_params * 4  # weights, gradients and the 2 Adam states, in float32
+    activation_bytes = 2 if amp else 4
+    
+    d_model = model.d_model
+    # gene token, count and perturbation embeddings, layer norm and expression decoder
+    cell_elements = seq_len * d_model * (len(model.embs_to_include) + 6)
+    checkpointed_layers = set(model.get_checkpointed_layers())
+    for i, layer in enumerate(getattr(model.transformer_encoder, "layers", [])):
+        if i in checkpointed_layers:
+            cell_elements += seq_len * d_model
+            continue
+        nhead = layer.self_attn.num_heads
+        d_hid = layer.linear1.out_features
+        # inputs, q/k/v, attention output and projection, residuals and norms, feed-forward activations
+        cell_elements += seq_len * (10 * d_model + 3 * d_hid)
+        if not isinstance(layer, FlashTransformerEncoderLayer):
+            # attention scores with their softmax and dropout; flash attention doesn't store them
+            cell_elements += 3 * nhead * seq_len ** 2
+    
+    budget_bytes = memory_budget_gb * 1024 ** 3 - param_bytes
+    return max(1, int(budget_bytes // (cell_elements * activation_bytes)))
+
+        
 def train_epoch(model, train_loader, loss_fn, optimizer, 
                 scheduler, logger, scaler, device, n_genes, gene_ids, 
                 num_epoch, include_zero_gene, amp, dataset_name, 
-                max_seq_len, log_interval, gene2idx = {}) -> None:
+                max_seq_len, log_interval, gene2idx = {}, prefetch_batches = 0, micro_batch_size = None) -> None:
     """
     Trains the model for one epoch on train_loader.
+    If prefetch_batches > 0, the next batches are decoded and moved to device in a background thread while the model 
+    trains, keeping up to prefetch_batches prepared batches (see utils/batch_prefetcher.py).
+    If micro_batch_size is smaller than the batch size, the gradients of each batch are accumulated over micro-batches
+    of micro_batch_size cells before the optimizer step. loss_fn averages over the masked positions, so the loss of each 
+    micro-batch is weighted by its share of the masked positions of the batch: the optimizer steps, gradient clipping, 
+    lr schedule and logged losses are the same as without micro-batches, only the peak memory changes.
+    The model can be wrapped in DistributedDataParallel, in which case the gradients are only synchronized across 
+    processes after the last micro-batch.
     """
     model.train()
+    # pad_token_id is read from the scGenePT model, also when wrapped in DistributedDataParallel
+    pad_token_id = getattr(model, "module", model).pad_token_id
     total_loss = 0.0
     start_time = time.time()
 
     num_batches = len(train_loader)
     
-    for batch, batch_data in enumerate(train_loader):
-        batch_data.to(device)
-        mapped_input_gene_ids, input_values, input_pert_flags, src_key_padding_mask, target_values = get_batch_data(batch_data, include_zero_gene,
-                                                                                                                    n_genes, max_seq_len, gene_ids, device)
+    if prefetch_batches > 0:
+        # genes are sampled with a generator derived from the global seed and the epoch, so that runs stay reproducible 
+        # without the background thread drawing from the global RNG
+        generator = torch.Generator(device=device)
+        generator.manual_seed((torch.initial_seed() + num_epoch) % 2 ** 63)
+        prepare_batch = lambda batch_data: get_batch_data(batch_data.to(device), include_zero_gene, n_genes, 
+                                                          max_seq_len, gene_ids, device, generator, pad_token_id)
+        batches = BatchPrefetcher(train_loader, prepare_batch, prefetch_batches, device)
+    else:
+        batches = (get_batch_data(batch_data.to(device), include_zero_gene, n_genes, max_seq_len, gene_ids, device, 
+                                  pad_token_id=pad_token_id) 
+                   for batch_data in train_loader)
+    
+    for batch, batch_inputs in enumerate(batches):
+        if micro_batch_size is not None and micro_batch_size < len(batch_inputs[1]):
+            micro_batches = split_batch_inputs(batch_inputs, micro_batch_size)
+        else:
+            micro_batches = [batch_inputs]
+        n_masked_positions = (~batch_inputs[3]).sum()
         
-        with torch.cuda.amp.autocast(enabled=amp):
-            output_dict = model(
-                mapped_input_gene_ids,
-                input_values,
-                input_pert_flags,
-                src_key_padding_mask=src_key_padding_mask,
-                CLS=CLS,
-                CCE=CCE,
-                MVC=MVC,
-                ECS=ECS,
-            )
-            output_values = output_dict["mlm_output"]
+        model.zero_grad()
+        loss = 0.0
+        for i, micro_batch_inputs in enumerate(micro_batches):
+            mapped_input_gene_ids, input_values, input_pert_flags, src_key_padding_mask, target_values = micro_batch_inputs
+            
+            # DistributedDataParallel synchronizes the gradients in the backward of the last micro-batch only
+            sync_context = contextlib.nullcontext()
+            if isinstance(model, nn.parallel.DistributedDataParallel) and i < len(micro_batches) - 1:
+                sync_context = model.no_sync()
+            with sync_context:
+                with torch.cuda.amp.autocast(enabled=amp):
+                    output_dict = model(
+                        mapped_input_gene_ids,
+                        input_values,
+                        input_pert_flags,
+                        src_key_padding_mask=src_key_padding_mask,
+                        CLS=CLS,
+                        CCE=CCE,
+                        MVC=MVC,
+                        ECS=ECS,
+                    )
+                    output_values = output_dict["mlm_output"]
 
-            masked_positions = torch.ones_like(
-                input_values, dtype=torch.bool
-            )  # Use all
-            loss = loss_fn(output_values, target_values, masked_positions)
+                    masked_positions = ~src_key_padding_mask  # Use all but the padded positions
+                    micro_batch_loss = loss_fn(output_values, target_values, masked_positions)
+                    if len(micro_batches) > 1:
+                        micro_batch_loss = micro_batch_loss * (masked_positions.sum() / n_masked_positions)
 
-        model.zero_grad()
-        scaler.scale(loss).backward()
+                scaler.scale(micro_batch_loss).backward()
+            loss += micro_batch_loss.detach()
         scaler.unscale_(optimizer)
         with warnings.catch_warnings(record=True) as w:
             warnings.filterwarnings("always")
@@ -782,14 +1367,17 @@ def evaluate_on_epoch(model, val_loader, loss_fn,
                       rnd_seed, loss_to_minimize, max_seq_len, log_interval, 
                       outputs_dir, gene2idx = {}) -> float:
     """
-    Evaluates the model on MSE loss on validation loader
+    Evaluates the model on MSE loss on validation loader.
+    In distributed training, each process evaluates its shard of val_loader and the losses are averaged across processes.
     """
     model.eval()
+    pad_token_id = getattr(model, "module", model).pad_token_id
     total_loss = 0.0
     with torch.no_grad():
         for batch, batch_data in enumerate(val_loader):
             batch_data.to(device)
-            mapped_input_gene_ids, input_values, input_pert_flags, src_key_padding_mask, target_values = get_batch_data(batch_data, include_zero_gene, n_genes, max_seq_len, gene_ids, device)
+            mapped_input_gene_ids, input_values, input_pert_flags, src_key_padding_mask, target_values = get_batch_data(
+                batch_data, include_zero_gene, n_genes, max_seq_len, gene_ids, device, pad_token_id=pad_token_id)
 
             with torch.cuda.amp.autocast(enabled=amp):
                 output_dict = model(
@@ -805,12 +1393,11 @@ def evaluate_on_epoch(model, val_loader, loss_fn,
                 )
                 output_values = output_dict["mlm_output"]
 
-                masked_positions = torch.ones_like(
-                    input_values, dtype=torch.bool, device=input_values.device
-                )
+                masked_positions = ~src_key_padding_mask
                 loss = loss_fn(output_values, target_values, masked_positions)
             total_loss += loss.item()
-    mse_loss = total_loss / len(val_loader)
+    total_loss, num_batches = all_reduce_sum([total_loss, len(val_loader)], device)
+    mse_loss = total_loss / num_batches
     metrics = {'val_mse' : mse_loss}    
     return metrics
 
@@ -820,9 +1407,13 @@ def train_model(model, pert_data, epochs, loss_fn,
                 gene_ids, logger, include_zero_gene, amp, 
                 dataset_name, model_type, rnd_seed, 
                 max_seq_len, log_interval, early_stop, gene2idx = {}, 
-                save_models_each_epoch = False, save_dir = "/tmp", loss_to_minimize = 'mse'):
+                save_models_each_epoch = False, save_dir = "/tmp", loss_to_minimize = 'mse', 
+                prefetch_batches = 0, micro_batch_size = None):
     """
     Trains the model for a given number of epochs.
+    If micro_batch_size is set, the gradients of each batch are accumulated over micro-batches (see train_epoch).
+    The model can be wrapped in DistributedDataParallel, with the dataloaders sharded across processes 
+    (see utils/distributed.py); only the main process saves models.
     """
    
     best_val_loss = float("inf")
@@ -836,12 +1427,17 @@ def train_model(model, pert_data, epochs, loss_fn,
         epoch_start_time = time.time()
         train_loader = pert_data.dataloader["train_loader"]
         val_loader = pert_data.dataloader["val_loader"]
+        for loader in [train_loader, val_loader]:
+            # sharded dataloaders are reshuffled at each epoch with the same seed in all processes
+            if hasattr(getattr(loader, "batch_sampler", None), "set_epoch"):
+                loader.batch_sampler.set_epoch(epoch)
 
         # Train model on train_loader
         train_epoch(model, train_loader, loss_fn, optimizer, 
                     scheduler, logger, scaler, device, n_genes, 
                     gene_ids, epoch, include_zero_gene, amp, 
-                    dataset_name, max_seq_len, log_interval, gene2idx)
+                    dataset_name, max_seq_len, log_interval, gene2idx, 
+                    prefetch_batches, micro_batch_size)
         
         # Validate on val_loader
         val_metrics = evaluate_on_epoch(model, val_loader, loss_fn, logger, 
@@ -862,7 +1458,7 @@ def train_model(model, pert_data, epochs, loss_fn,
 
         if val_loss < best_val_loss:
             best_val_loss = val_loss
-            best_model = copy.deepcopy(model)
+            best_model = copy.deepcopy(getattr(model, "module", model))
             logger.info(f"Best model with score {best_val_loss:5.7f}")
             patience = 0
         else:
@@ -871,9 +1467,9 @@ def train_model(model, pert_data, epochs, loss_fn,
                 logger.info(f"Early stop at epoch {epoch}")
                 break
 
-        if save_models_each_epoch:
+        if save_models_each_epoch and is_main_process():
             torch.save(
-                model.state_dict(),
+                getattr(model, "module", model).state_dict(),
                 save_dir / f"models/model_{epoch}.pt",
             )
 
@@ -0,0 +1,156 @@
+from utils.data_loading import *
+from utils.scgpt_config import *
+from utils.screening import *
+
+from models.scGenePT import *
+from train import set_seed, load_dataloader
+import argparse
+import anndata
+import numpy as np
+import torch.multiprocessing as mp
+
+    
+def get_args():
+    """
+    Parses command line arguments
+    
+    Returns:
+        list of args
+    """
+    parser = argparse.ArgumentParser(description='Arguments for running an in-silico perturbation screen ...')
+    parser.add_argument(
+        '--model-type', 
+        type=str, 
+        help='Type of model to screen with. For full list of possible models, please visit https://github.com/czi-ai/scGenePT.', 
+        default = "scgenept_go_c_gpt_concat"
+    )
+    parser.add_argument(
+        '--model-location', 
+        type=str, 
+        help='location of the trained model weights', 
+        required = True
+    )
+    parser.add_argument(
+        '--dataset', 
+        type=str, 
+        help='dataset the model has been trained on; its control cells and genes are used for the screen', 
+        default = 'norman'
+    )
+    parser.add_argument(
+        '--candidates', 
+        type=str, 
+        help='optional text file with one perturbation per line, eg FOSB+ctrl or SAMD1+ZBTB1; if not given, all gene pairs are screened', 
+        default = None
+    )
+    parser.add_argument(
+        '--include-singles', 
+        action='store_true', 
+        help='also screen all single gene perturbations when screening all gene pairs'
+    )
+    parser.add_argument(
+        '--pool-size', 
+        type=int, 
+        help='number of control cells to average the predictions over', 
+        default = 300
+    )
+    parser.add_argument(
+        '--batch-size', 
+        type=int, 
+        help='number of (control cell, perturbation) pairs to run through the model at once', 
+        default = 8
+    )
+    parser.add_argument(
+        '--shard-size', 
+        type=int, 
+        help='number of perturbations per shard; a shard is the unit of work that gets checkpointed', 
+        default = 256
+    )
+    parser.add_argument(
+        '--num-workers', 
+        type=int, 
+        help='number of worker processes; each worker owns its own copy of the model', 
+        default = 1
+    )
+    parser.add_argument(
+        '--threads-per-worker', 
+        type=int, 
+        help='number of torch threads per worker; defaults to the number of cores divided by the number of workers', 
+        default = None
+    )
+    parser.add_argument(
+        '--device', 
+        type=str, 
+        help='device', 
+        default = 'cpu'
+    )
+    parser.add_argument(
+        '--rnd-seed', 
+        type=int, 
+        help='random seed used to sample the control pool', 
+        default = 42
+    )
+    parser.add_argument(
+        '--models-dir', 
+        type=str, 
+        help='directory the pretrained scGPT model and gene embeddings are in', 
+        default = 'models/'
+    )
+    parser.add_argument(
+        '--outputs_dir', 
+        type=str, 
+        help='directory where the screen outputs are saved; a screen that was stopped resumes from here', 
+        default = 'outputs/'
+    )
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":    
+       
+    args = get_args()    
+    set_seed(args.rnd_seed)
+    device = args.device
+    amp = True
+    
+    # Load data
+    pert_data = load_dataloader(args.dataset, 64, 64, split = 'simulation')
+    pert_adata = pert_data.adata
+    gene_names = pert_data.gene_names.to_list()
+    adata_ctrl = pert_adata[pert_adata.obs['condition'] == 'ctrl']
+    
+    # The control pool is sampled once so that every shard is scored against the same cells, and with its own seed so 
+    # that a resumed screen samples the same cells; the manifest checks the hash of the cells on resume
+    ctrl_pool, ctrl_pool_hash = get_screen_ctrl_pool(adata_ctrl, args.pool_size, args.rnd_seed)
+    
+    perturbations = get_candidate_perturbations(gene_names, args.candidates, args.include_singles)
+    shards = shard_perturbations(perturbations, args.shard_size)
+    
+    # Location where the screen outputs will be saved to 
+    save_dir = Path(args.outputs_dir + args.dataset + "/" + args.model_type + "/screen_seed_" + str(args.rnd_seed) + "/")
+    manifest = init_screen_outputs(save_dir, perturbations, args.shard_size, len(gene_names), 
+                                   {"model_type": args.model_type, "model_location": args.model_location, 
+                                    "pool_size": args.pool_size, "rnd_seed": args.rnd_seed,
+                                    "ctrl_pool_sha256": ctrl_pool_hash})
+    pending_shards = get_pending_shards(save_dir, manifest["n_shards"])
+    print(f"Screening {len(perturbations)} perturbations in {len(shards)} shards; {len(pending_shards)} shards pending, saving to {save_dir}")
+    
+    threads_per_worker = args.threads_per_worker
+    if threads_per_worker is None:
+        threads_per_worker = max(1, os.cpu_count() // args.num_workers)
+    
+    # Workers only need the gene names of the dataset to load the model, not the expression data
+    var_adata = anndata.AnnData(var=pert_adata.var[["gene_name"]].copy())
+    worker_args = (var_adata, args.model_type, args.models_dir, args.model_location, device, 
+                   threads_per_worker, ctrl_pool, gene_names, args.batch_size, amp)
+    
+    start_time = time.time()
+    if args.num_workers == 1:
+        init_screen_worker(*worker_args)
+        for i, shard_id in enumerate(pending_shards):
+            run_screen_shard(save_dir, shard_id, shards[shard_id])
+            print(f"Finished shard {shard_id} ({i + 1}/{len(pending_shards)}) | elapsed {time.time() - start_time:5.2f}s")
+    else:
+        with mp.get_context("spawn").Pool(args.num_workers, initializer=init_screen_worker, initargs=worker_args) as pool:
+            shard_args = [(save_dir, shard_id, shards[shard_id]) for shard_id in pending_shards]
+            for i, shard_id in enumerate(pool.imap_unordered(run_screen_shard_from_args, shard_args)):
+                print(f"Finished shard {shard_id} ({i + 1}/{len(pending_shards)}) | elapsed {time.time() - start_time:5.2f}s")
+    print(f"Screen done! Results can be loaded with utils.screening.load_screen_results('{save_dir}')")
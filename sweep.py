@@ -0,0 +1,144 @@
+# jobs are started with a preexec_fn, which forks this process, see utils/numba_threading.py
+import utils.numba_threading
+
+from utils.data_loading import *
+from utils.embedding_store import convert_gene_embeddings_to_store, get_store_location, is_store
+from utils.sweep import *
+
+from train import get_arg_parser, get_save_dir, load_dataloader
+import argparse
+import sys
+
+
+def get_args():
+    """
+    Parses command line arguments; the arguments that aren't sweep arguments are passed to train.py
+
+    Returns:
+        args: sweep arguments
+        train_argv: train.py arguments shared by all the configs of the sweep
+        train_args: parsed train.py arguments
+    """
+    parser = argparse.ArgumentParser(description='Arguments for sweeping over model types and training hyperparameters; all other arguments are passed to train.py ...')
+    parser.add_argument(
+        '--model-types',
+        type=str,
+        nargs='+',
+        help='model types to train. For full list of possible models, please visit https://github.com/czi-ai/scGenePT',
+        required = True
+    )
+    parser.add_argument(
+        '--lrs',
+        type=float,
+        nargs='+',
+        help='learning rates to train with',
+        default = [1e-4]
+    )
+    parser.add_argument(
+        '--dropouts',
+        type=float,
+        nargs='+',
+        help='dropout probabilities to train with',
+        default = [0.2]
+    )
+    parser.add_argument(
+        '--seeds',
+        type=int,
+        nargs='+',
+        help='random seeds to train with',
+        default = [42]
+    )
+    parser.add_argument(
+        '--no-attention-variants',
+        action='store_true',
+        help='if set, the _no_attention variant of each model type is also trained',
+    )
+    parser.add_argument(
+        '--threads-per-job',
+        type=int,
+        help='number of cores of each job; jobs are pinned to disjoint sets of cores',
+        default = 4
+    )
+    parser.add_argument(
+        '--max-jobs',
+        type=int,
+        help='max number of concurrent jobs; defaults to as many jobs as the cores allow',
+        default = None
+    )
+    parser.add_argument(
+        '--memory-per-job-gb',
+        type=float,
+        help='limit of the virtual size of the data segment of each job (RLIMIT_DATA), in GB; it counts the memory a job reserves rather than the memory it uses, so leave some headroom above its resident memory. Also limits the number of concurrent jobs to the physical memory',
+        default = None
+    )
+    parser.add_argument(
+        '--outputs_dir',
+        type=str,
+        help='directory where the outputs of the sweep are saved; each config is saved under outputs_dir/lr_<lr>_dropout_<dropout>/<dataset>/<model_type>/seed_<seed>/',
+        default = 'outputs/sweep/'
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='if set, only prints the jobs of the sweep',
+    )
+    args, train_argv = parser.parse_known_args()
+    train_args = get_arg_parser().parse_args(train_argv)
+    return args, train_argv, train_args
+
+
+def prepare_shared_artefacts(train_args, model_types):
+    """
+    Prepares the artefacts the jobs of the sweep read before they run, so that the jobs don't prepare them concurrently
+    and share them through the page cache: the prepared split and dataloader datasets of the dataset
+    (see utils/pert_data_cache.py) and memory-mapped gene embedding stores of the gene embeddings of the model types
+    (see utils/embedding_store.py), from which each job only reads the rows of the dataset genes.
+
+    Args:
+        train_args: parsed train.py arguments
+        model_types: model types of the sweep
+    """
+    load_dataloader(train_args.dataset, train_args.batch_size, train_args.eval_batch_size, split = 'simulation',
+                    dense_dataset_layout = train_args.dense_datasets)
+    embeddings_locations = sorted(set(sum([get_gene_embeddings_locations(model_type, train_args.pretrained_model_dir)
+                                           for model_type in model_types], [])))
+    for embeddings_location in embeddings_locations:
+        if not is_store(get_store_location(embeddings_location)):
+            convert_gene_embeddings_to_store(embeddings_location)
+
+
+if __name__ == "__main__":
+
+    args, train_argv, train_args = get_args()
+    train_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'train.py')
+
+    # Configs whose test metrics, saved last by train.py, already exist are skipped
+    configs = get_sweep_configs(args.model_types, args.lrs, args.dropouts, args.seeds, args.no_attention_variants)
+    commands, log_locations = [], []
+    for config in configs:
+        outputs_dir = get_config_outputs_dir(args.outputs_dir, config)
+        save_dir = get_save_dir(outputs_dir, train_args.dataset, config['model_type'], config['rnd_seed'])
+        if (save_dir / "metrics/test/test_metrics_detailed.json").exists():
+            print(f"Skipping {config}, already trained under {save_dir}")
+            continue
+        commands.append([sys.executable, train_script, *train_argv,
+                         '--model-type', config['model_type'], '--lr', str(config['lr']), '--dropout', str(config['dropout']),
+                         '--rnd-seed', str(config['rnd_seed']), '--outputs_dir', outputs_dir, '--num-threads', str(args.threads_per_job)])
+        log_locations.append(save_dir / "sweep.log")
+
+    core_slots = get_core_slots(args.threads_per_job, args.max_jobs, args.memory_per_job_gb)
+    print(f"Running {len(commands)} of {len(configs)} configs, {len(core_slots)} at a time with {args.threads_per_job} cores each")
+    if args.dry_run:
+        for command in commands:
+            print(" ".join(command))
+        sys.exit(0)
+
+    for log_location in log_locations:
+        log_location.parent.mkdir(parents=True, exist_ok=True)
+    prepare_shared_artefacts(train_args, sorted(set(config['model_type'] for config in configs)))
+    returncodes = run_jobs(commands, core_slots, args.memory_per_job_gb, log_locations)
+    failed = [log_location for log_location, returncode in zip(log_locations, returncodes) if returncode != 0]
+    if failed:
+        print(f"{len(failed)} jobs failed, see: " + ", ".join(str(log_location) for log_location in failed))
+        sys.exit(1)
+    print("Sweep done!")
@@ -0,0 +1,2 @@
+# some tests fork the test process, see utils/numba_threading.py
+import utils.numba_threading
@@ -0,0 +1,53 @@
+import copy
+import torch
+from models.scGenePT import *
+
+def test_activation_checkpointing():
+    """
+    Tests that checkpointing the activations of transformer layers doesn't change the loss and gradients, including the
+    dropout masks, that it stores fewer activations, and that it can be changed or disabled by calling
+    set_activation_checkpointing again
+    """
+    torch.manual_seed(0)
+    n_genes = 12
+    vocab = {'<pad>': 0, **{f'G{i}': i + 1 for i in range(n_genes)}}
+    model = scGenePT(len(vocab), 16, 2, 32, 3, 3, 1, vocab, 2, dropout = 0.3, pad_value = PAD_VALUE,
+                     pert_pad_id = PERT_PAD_ID, embs_to_include = ['scGPT_counts_embs', 'scGPT_token_embs']).train()
+    src = torch.arange(1, n_genes + 1).unsqueeze(0)
+    values = torch.rand(4, n_genes)
+    pert_flags = torch.zeros(4, n_genes, dtype=torch.long)
+    pert_flags[:, 3] = 1
+    src_key_padding_mask = torch.zeros(4, n_genes, dtype=torch.bool)
+    src_key_padding_mask[0, -3:] = True
+    target_values = torch.rand(4, n_genes)
+    state_dict_keys = list(model.state_dict())
+
+    def get_loss_and_grads():
+        model.zero_grad()
+        torch.manual_seed(1)
+        saved_bytes = [0]
+        def pack(tensor):
+            saved_bytes[0] += tensor.numel() * tensor.element_size()
+            return tensor
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            output_values = model(src, values, pert_flags, src_key_padding_mask = src_key_padding_mask)["mlm_output"]
+            loss = masked_mse_loss(output_values, target_values, ~src_key_padding_mask)
+        loss.backward()
+        return loss.detach(), {name: param.grad.clone() for name, param in model.named_parameters() if param.grad is not None}, saved_bytes[0]
+
+    loss, grads, saved_bytes = get_loss_and_grads()
+    for every_k_layers, checkpointed_layers in [(1, [0, 1, 2]), (2, [0, 2])]:
+        model.set_activation_checkpointing(every_k_layers)
+        assert(model.get_checkpointed_layers() == checkpointed_layers)
+        checkpointed_loss, checkpointed_grads, checkpointed_saved_bytes = get_loss_and_grads()
+        assert(torch.equal(checkpointed_loss, loss))
+        assert(checkpointed_grads.keys() == grads.keys())
+        for name, grad in grads.items():
+            assert(torch.allclose(checkpointed_grads[name], grad, atol = 1e-6)), name
+        assert(checkpointed_saved_bytes < saved_bytes)
+    assert(copy.deepcopy(model).get_checkpointed_layers() == [0, 2])
+    assert(list(model.state_dict()) == state_dict_keys)
+
+    model.set_activation_checkpointing(0)
+    assert(model.get_checkpointed_layers() == [])
+    assert(get_loss_and_grads()[2] == saved_bytes)
@@ -0,0 +1,15 @@
+import pytest
+from utils.batch_prefetcher import *
+
+def test_batch_prefetcher():
+    """
+    Tests that prefetched batches keep the order of the dataloader and that errors in the background thread are raised
+    """
+    assert([batch for batch in BatchPrefetcher(range(7), lambda x: (x, x ** 2), num_prefetch = 2)] == [(x, x ** 2) for x in range(7)])
+    
+    def prepare_fn(x):
+        if x == 3:
+            raise ValueError("bad batch")
+        return (x,)
+    with pytest.raises(ValueError):
+        list(BatchPrefetcher(range(7), prepare_fn, num_prefetch = 1))
@@ -0,0 +1,66 @@
+import os
+import torch
+from utils.checkpoint import *
+
+def test_scgenept_checkpoint(tmp_path):
+    """
+    Tests that a self-describing checkpoint stores its config, compacts the gene embedding tables and restores the dtypes of fp16-stored weights
+    if asked to, and stores the weights unchanged by default
+    """
+    state_dict = {
+        'genept_encoder.embedding.weight': torch.arange(12, dtype=torch.float64).reshape(6, 2),
+        'transformer_encoder.layers.0.self_attn.Wqkv.weight': torch.ones(3, 2),
+    }
+    config = {'model_type': 'scgenept_ncbi_gpt', 'gene_ids': [3, 1], 'pad_token_id': 5, 'compact_gene_ids': None}
+    checkpoint_location = tmp_path / 'best_model.pt'
+    save_scgenept_checkpoint(checkpoint_location, state_dict, config, torch.float16, compact_gene_embs = True)
+    
+    loaded_state_dict, checkpoint_info = load_scgenept_checkpoint(checkpoint_location)
+    assert(checkpoint_info['config']['model_type'] == 'scgenept_ncbi_gpt')
+    assert(checkpoint_info['config']['compact_gene_ids'] == [1, 3, 5])
+    assert(checkpoint_info['attention_layout'] == 'flash')
+    assert(loaded_state_dict['genept_encoder.embedding.weight'].dtype == torch.float64)
+    assert(torch.equal(loaded_state_dict['genept_encoder.embedding.weight'], state_dict['genept_encoder.embedding.weight'][[1, 3, 5]]))
+    assert(torch.equal(loaded_state_dict['genept_encoder.embedding.compact_gene_ids'], torch.tensor([1, 3, 5])))
+
+    # by default, the weights are stored as they are
+    save_scgenept_checkpoint(checkpoint_location, state_dict, config)
+    loaded_state_dict, checkpoint_info = load_scgenept_checkpoint(checkpoint_location)
+    assert(checkpoint_info['config']['compact_gene_ids'] is None and checkpoint_info['stored_dtypes'] == {})
+    for k, v in state_dict.items():
+        assert(loaded_state_dict[k].dtype == v.dtype and torch.equal(loaded_state_dict[k], v))
+
+def test_attention_layout_cache(tmp_path):
+    """
+    Tests that flash-attn checkpoints are converted to the PyTorch attention layout and that the conversion is cached next to the checkpoint
+    """
+    state_dict = {'transformer_encoder.layers.0.self_attn.Wqkv.weight': torch.ones(3, 2)}
+    checkpoint_location = tmp_path / 'best_model.pt'
+    torch.save(state_dict, checkpoint_location)
+    assert(get_attention_layout(state_dict) == 'flash')
+    
+    loaded_state_dict, _ = load_scgenept_checkpoint(checkpoint_location, attention_layout='pytorch')
+    assert(list(loaded_state_dict) == ['transformer_encoder.layers.0.self_attn.in_proj_weight'])
+    converted_location = get_converted_checkpoint_location(checkpoint_location, 'pytorch', get_checkpoint_hash(checkpoint_location))
+    assert(os.path.exists(converted_location))
+    assert(convert_attention_layout(loaded_state_dict, 'flash').keys() == state_dict.keys())
+
+def test_memoised_checkpoint_hash(tmp_path):
+    """
+    Tests that the hash of a checkpoint is memoised next to it and recomputed when the checkpoint changes
+    """
+    checkpoint_location = tmp_path / 'best_model.pt'
+    checkpoint_location.write_bytes(b'weights')
+    assert(get_memoised_checkpoint_hash(checkpoint_location) == get_checkpoint_hash(checkpoint_location))
+    assert(os.path.exists(get_checkpoint_hash_location(checkpoint_location)))
+    
+    # a memoised hash is returned without reading the checkpoint
+    with open(get_checkpoint_hash_location(checkpoint_location)) as f:
+        memoised_hash = json.load(f)
+    memoised_hash['sha256'] = 'memoised'
+    with open(get_checkpoint_hash_location(checkpoint_location), 'w') as f:
+        json.dump(memoised_hash, f)
+    assert(get_memoised_checkpoint_hash(checkpoint_location) == 'memoised')
+    
+    checkpoint_location.write_bytes(b'new weights')
+    assert(get_memoised_checkpoint_hash(checkpoint_location) == get_checkpoint_hash(checkpoint_location))
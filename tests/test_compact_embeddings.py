@@ -0,0 +1,52 @@
+import pytest
+import torch
+from utils.data_loading import *
+
+@pytest.mark.parametrize('model_type', ['scgenept_ncbi_gpt', 'scgenept_go_c_gpt_concat'])
+def test_compact_embeddings_round_trip(model_type):
+    """
+    Tests that the state dicts of models with full-vocab and compact genePT/GO embedding tables load into each other,
+    and that the loaded models give the same outputs on the dataset genes, bit for bit
+    """
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+    vocab_size, emb_size = 50, 8
+    vocab = {PAD_TOKEN: 3}
+    gene_ids = np.array([5, 7, 9, 11])
+    compact_gene_ids = get_compact_gene_ids(gene_ids, vocab)
+    embs = rng.random((vocab_size, emb_size))
+    kwargs = dict(ntoken = vocab_size, d_model = 16, nhead = 2, d_hid = 32, nlayers = 2, nlayers_cls = 3, n_cls = 1,
+                  vocab = vocab, n_perturbagens = 2, dropout = 0.0, pad_token = PAD_TOKEN, pad_value = PAD_VALUE,
+                  pert_pad_id = PERT_PAD_ID, embs_to_include = get_embs_to_include(model_type), genept_emb_size = emb_size,
+                  go_emb_type = 'c' if 'go_c' in model_type else None, go_emb_size = emb_size)
+    create_model = lambda embs, compact_gene_ids = None: scGenePT(genept_embs = embs, go_embs_to_include = {'c': embs},
+                                                                  compact_gene_ids = compact_gene_ids, **kwargs).eval()
+    full_model = create_model(embs)
+    with torch.no_grad():
+        for param in full_model.parameters():
+            param.add_(torch.randn_like(param))
+
+    src = torch.as_tensor(gene_ids).unsqueeze(0)
+    values = torch.rand(3, len(gene_ids))
+    pert_flags = torch.zeros(3, len(gene_ids), dtype=torch.long)
+    pert_flags[:, 1] = 1
+    src_key_padding_mask = torch.zeros(3, len(gene_ids), dtype=torch.bool)
+    predict = lambda model: model(src, values, pert_flags, src_key_padding_mask)['mlm_output']
+    with torch.no_grad():
+        output = predict(full_model)
+
+        # full-vocab checkpoint -> compact model
+        compact_model = create_model(embs[compact_gene_ids], compact_gene_ids)
+        compact_model.load_state_dict(full_model.state_dict())
+        assert(any(isinstance(module, CompactGeneEmbedding) for module in compact_model.modules()))
+        assert(torch.equal(predict(compact_model), output))
+
+        # compact model -> full-vocab layout, with zeros for the genes outside of the compact tables
+        full_vocab_model = create_model(np.zeros_like(embs))
+        full_vocab_model.load_state_dict(compact_model.full_vocab_state_dict())
+        assert(torch.equal(predict(full_vocab_model), output))
+
+        # compact checkpoint -> full-vocab model
+        full_vocab_model = create_model(np.zeros_like(embs))
+        full_vocab_model.load_state_dict(compact_model.state_dict())
+        assert(torch.equal(predict(full_vocab_model), output))
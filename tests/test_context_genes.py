@@ -0,0 +1,30 @@
+import numpy as np
+import torch
+from utils.context_genes import *
+
+def test_context_budget():
+    """
+    Tests that the context holds the perturbed and readout genes first and is filled with the top ranked genes up to the budget
+    """
+    ranked_genes = np.array([5, 1, 7, 0, 2, 3, 4, 6])
+    pert_flags = torch.zeros(2, 8, dtype=torch.long)
+    pert_flags[0, 3] = 1
+    pert_flags[1, 4] = 1
+    assert(ContextBudget(ranked_genes, 5).get_context_gene_ids(pert_flags).tolist() == [1, 3, 4, 5, 7])
+    assert(ContextBudget(ranked_genes, 4, readout_gene_ids=[6]).get_context_gene_ids(pert_flags).tolist() == [3, 4, 5, 6])
+    # the perturbed and readout genes are kept even if they exceed the budget
+    assert(ContextBudget(ranked_genes, 1, readout_gene_ids=[6]).get_context_gene_ids(pert_flags).tolist() == [3, 4, 6])
+
+def test_rank_context_genes_conditions():
+    """
+    Tests that only the cells of the given conditions are used to rank the context genes
+    """
+    import anndata
+    import pandas as pd
+    X = np.zeros((6, 3), dtype=np.float32)
+    X[:3, 0] = [0, 1, 2]
+    X[3:, 2] = [0, 5, 10]
+    adata = anndata.AnnData(X, obs = pd.DataFrame({'condition': ['ctrl', 'A+ctrl', 'ctrl', 'B+ctrl', 'B+ctrl', 'B+ctrl']},
+                                                  index = [str(i) for i in range(6)]))
+    assert(rank_context_genes(adata)[0] == 2)
+    assert(rank_context_genes(adata, conditions = ['ctrl', 'A+ctrl'])[0] == 0)
@@ -0,0 +1,26 @@
+import numpy as np
+import torch
+from torch_geometric.data import Data
+from utils.dense_dataset import *
+
+def test_dense_dataset(tmp_path):
+    """
+    Tests that a materialized dense dataset returns the same cells as the GEARS cell graphs, in both layouts
+    """
+    rng = np.random.default_rng(0)
+    cells = []
+    for pert in ['FOSB+ctrl', 'ctrl', 'CEBPB+SAMD1']:
+        x = torch.Tensor(rng.poisson(1.0, (6, 2)).clip(max=1))
+        y = torch.Tensor(rng.poisson(1.0, (1, 6)))
+        de_idx = [-1] * 3 if pert == 'ctrl' else np.array([0, 2, 5])
+        cells.append(Data(x=x, y=y, de_idx=de_idx, pert=pert))
+    
+    for layout in ['csr', 'dense']:
+        dense_dataset = DenseDataset(materialize_dense_dataset(cells, tmp_path / layout, layout))
+        batch = dense_dataset.get_batch(np.array([2, 0]))
+        assert(torch.equal(batch.ctrl, torch.stack([cells[2].x[:, 0], cells[0].x[:, 0]])))
+        assert(torch.equal(batch.pert_flags, torch.stack([cells[2].x[:, 1], cells[0].x[:, 1]]).long()))
+        assert(torch.equal(batch.y, torch.cat([cells[2].y, cells[0].y])))
+        assert(batch.pert == ['CEBPB+SAMD1', 'FOSB+ctrl'])
+        assert(np.array_equal(dense_dataset.get_batch(np.array([1])).de_idx, [[-1, -1, -1]]))
+        assert([len(batch) for batch in DenseDataLoader(dense_dataset, 2)] == [2, 1])
@@ -0,0 +1,21 @@
+import torch
+from torch.utils.data import BatchSampler, RandomSampler
+from utils.distributed import *
+
+def test_sharded_batch_sampler():
+    """
+    Tests that the processes split the same global batches between them and run the same number of steps
+    """
+    shards = []
+    for rank in range(3):
+        generator = torch.Generator()
+        batch_sampler = BatchSampler(RandomSampler(range(22), generator=generator), 8, drop_last=False)
+        sharded_batch_sampler = ShardedBatchSampler(batch_sampler, generator, 3, rank, seed=4)
+        sharded_batch_sampler.set_epoch(2)
+        shards.append(list(sharded_batch_sampler))
+        # the last global batch has 6 cells, so it is kept
+        assert(len(sharded_batch_sampler) == len(shards[-1]) == 3)
+    generator = torch.Generator().manual_seed(6)
+    global_batches = list(BatchSampler(RandomSampler(range(22), generator=generator), 8, drop_last=False))
+    for batch, global_batch in enumerate(global_batches):
+        assert(sorted(sum([shard[batch] for shard in shards], [])) == sorted(global_batch))
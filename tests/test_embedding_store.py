@@ -0,0 +1,19 @@
+import pickle as pkl
+import numpy as np
+from utils.embedding_store import *
+
+def test_gene_embedding_store(tmp_path):
+    """
+    Tests that a converted gene embedding store returns the same embeddings as the pickled gene embeddings
+    """
+    gene_embeddings = {'FOSB': [1., 2.], 'CEBPB': [3., 4.], 'SAMD1': [5., 6.]}
+    precomputed_embs_location = tmp_path / 'embeddings.pickle'
+    with open(precomputed_embs_location, 'wb') as fp:
+        pkl.dump(gene_embeddings, fp)
+    
+    store_location = convert_gene_embeddings_to_store(precomputed_embs_location)
+    assert(is_store(store_location))
+    
+    embeds, mapped_genes = load_gene_embeddings_from_store(store_location, ['SAMD1', 'NOT_A_GENE', 'FOSB'])
+    assert(mapped_genes == ['SAMD1', 'FOSB'])
+    assert(np.array_equal(embeds, np.array([gene_embeddings['SAMD1'], gene_embeddings['FOSB']])))
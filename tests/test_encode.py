@@ -0,0 +1,59 @@
+import torch
+from models.scGenePT import *
+
+def make_model(n_genes = 12, emb_size = 8):
+    """
+    Builds a small scGenePT model with the scGPT gene token, genePT and GO gene token encoders
+    """
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+    vocab = {'<pad>': 0, **{f'G{i}': i + 1 for i in range(n_genes)}}
+    model = scGenePT(len(vocab), 16, 2, 32, 2, 3, 1, vocab, 2, dropout = 0.0, pad_value = PAD_VALUE,
+                     pert_pad_id = PERT_PAD_ID,
+                     embs_to_include = ['scGPT_counts_embs', 'scGPT_token_embs', 'genePT_token_embs_gpt', 'GO_token_embs_gpt_concat'],
+                     genept_embs = rng.random((len(vocab), emb_size)), genept_emb_size = emb_size,
+                     go_embs_to_include = {'c': rng.random((len(vocab), emb_size))}, go_emb_type = 'c', go_emb_size = emb_size)
+    return model.eval()
+
+def test_fused_gene_embeddings():
+    """
+    Tests that encoding with the fused gene embeddings gives the same outputs as encoding with each gene token encoder,
+    and that the fused gene embeddings are not used in train mode
+    """
+    model = make_model()
+    src = torch.tensor([[1, 3, 4, 7, 12]])
+    values = torch.rand(3, 5)
+    pert_flags = torch.zeros(3, 5, dtype=torch.long)
+    pert_flags[:, 2] = 1
+    src_key_padding_mask = torch.zeros(3, 5, dtype=torch.bool)
+    with torch.no_grad():
+        output = model._encode(src, values, pert_flags, src_key_padding_mask)
+        model.freeze_gene_embeddings(gene_ids = np.arange(1, 13))
+        assert(model.fused_gene_embs is not None)
+        assert(torch.allclose(model._encode(src, values, pert_flags, src_key_padding_mask), output, atol = 1e-5))
+
+        # the fused gene embeddings are only used in eval mode, as they aren't updated by training
+        model.fused_gene_embs.zero_()
+        model.train()
+        assert(torch.allclose(model._encode(src, values, pert_flags, src_key_padding_mask), output, atol = 1e-5))
+        model.eval()
+        assert(not torch.allclose(model._encode(src, values, pert_flags, src_key_padding_mask), output, atol = 1e-5))
+
+def test_shared_gene_tokens():
+    """
+    Tests that encoding gene tokens shared by the batch, of shape [1, seq_len], gives the same outputs as encoding them
+    for every cell, of shape [batch_size, seq_len]
+    """
+    model = make_model()
+    src = torch.tensor([[1, 3, 4, 7, 12]])
+    values = torch.rand(3, 5)
+    pert_flags = torch.zeros(3, 5, dtype=torch.long)
+    pert_flags[:, 2] = 1
+    src_key_padding_mask = torch.zeros(3, 5, dtype=torch.bool)
+    with torch.no_grad():
+        output = model._encode(src.expand(3, -1), values, pert_flags, src_key_padding_mask)
+        assert(output.shape == (3, 5, 16))
+        assert(torch.allclose(model._encode(src, values, pert_flags, src_key_padding_mask), output, atol = 1e-6))
+        model.freeze_gene_embeddings()
+        assert(torch.allclose(model._encode(src, values, pert_flags, src_key_padding_mask), output, atol = 1e-5))
+        assert(torch.allclose(model._encode(src.expand(3, -1), values, pert_flags, src_key_padding_mask), output, atol = 1e-5))
@@ -0,0 +1,116 @@
+import anndata
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import torch
+from utils.evaluation import *
+
+def test_streaming_perturbation_metrics():
+    """
+    Tests that the metrics computed from running sums per perturbation match the metrics GEARS computes from the 
+    predictions of every cell
+    """
+    rng = np.random.default_rng(0)
+    n_genes, n_de_genes = 30, 20
+    genes = [f'G{i}' for i in range(n_genes)]
+    perts = ['ctrl', 'G0+ctrl', 'G1+G2', 'G3+ctrl']
+    pert_cat = np.array([perts[i] for i in rng.integers(0, len(perts), 50)])
+    pred = rng.random((50, n_genes)).astype(np.float32)
+    truth = rng.random((50, n_genes)).astype(np.float32)
+    de_idx = {pert: rng.choice(n_genes, n_de_genes, replace = False) for pert in perts}
+    pred_de = np.stack([pred[i, de_idx[pert]] for i, pert in enumerate(pert_cat)])
+    truth_de = np.stack([truth[i, de_idx[pert]] for i, pert in enumerate(pert_cat)])
+    
+    streaming_metrics = StreamingPerturbationMetrics(n_genes, n_de_genes)
+    for start in range(0, 50, 16):
+        batch = slice(start, start + 16)
+        streaming_metrics.update(pert_cat[batch].tolist(), torch.from_numpy(pred[batch]), torch.from_numpy(truth[batch]),
+                                 torch.from_numpy(pred_de[batch]), torch.from_numpy(truth_de[batch]))
+    test_res = {'pert_cat': pert_cat, 'pred': pred.astype(np.float64), 'truth': truth.astype(np.float64),
+                'pred_de': pred_de.astype(np.float64), 'truth_de': truth_de.astype(np.float64)}
+    
+    metrics, metrics_pert = streaming_metrics.compute_metrics()
+    expected_metrics, expected_metrics_pert = compute_metrics(test_res)
+    assert(list(metrics_pert) == list(expected_metrics_pert))
+    for m in expected_metrics:
+        assert(np.isclose(metrics[m], expected_metrics[m], rtol = 1e-12))
+        for pert in perts:
+            assert(np.isclose(metrics_pert[pert][m], expected_metrics_pert[pert][m], rtol = 1e-12))
+    
+    conditions = perts + perts[1:]
+    adata = anndata.AnnData(sp.csr_matrix(rng.random((len(conditions), n_genes)).astype(np.float32)),
+                            obs = pd.DataFrame({'condition': conditions, 'condition_name': [f'K562_{c}' for c in conditions]}),
+                            var = pd.DataFrame({'gene_name': genes}, index = genes))
+    adata.uns['rank_genes_groups_cov_all'] = {f'K562_{pert}': [genes[i] for i in rng.permutation(n_genes)] for pert in perts}
+    adata.uns['top_non_dropout_de_20'] = {f'K562_{pert}': [genes[i] for i in de_idx[pert]] for pert in perts}
+    adata.uns['non_zeros_gene_idx'] = {f'K562_{pert}': np.arange(n_genes) for pert in perts}
+    adata.uns['non_dropout_gene_idx'] = {f'K562_{pert}': np.arange(n_genes) for pert in perts}
+    
+    delta_metrics = streaming_metrics.compute_delta_metrics(adata)
+    expected_deeper_res = deeper_analysis(adata, test_res)
+    expected_non_dropout_res = non_dropout_analysis(adata, test_res)
+    for pert in perts:
+        for m in ['pearson_delta', 'pearson_delta_de']:
+            assert(np.isclose(delta_metrics.loc[pert, m], expected_deeper_res[pert][m], rtol = 1e-12))
+        for m in ['pearson_delta_top20_de_non_dropout', 'pearson_top20_de_non_dropout']:
+            assert(np.isclose(delta_metrics.loc[pert, m], expected_non_dropout_res[pert][m], rtol = 1e-12))
+
+
+def test_merge_shards():
+    """
+    Tests that merging the running sums of the shards of a dataloader gives the running sums of the whole dataloader
+    """
+    from torch_geometric.data import Data
+    rng = np.random.default_rng(0)
+    n_genes, n_de_genes = 30, 20
+    pert_cat = [['ctrl', 'G0+ctrl', 'G1+G2'][i] for i in rng.integers(0, 3, 50)]
+    cells = [Data(pert = pert, y = torch.from_numpy(rng.random((1, n_genes)).astype(np.float32))) for pert in pert_cat]
+    loader = DataLoader(cells, batch_size = 8, shuffle = False)
+    
+    def accumulate(loader):
+        streaming_metrics = StreamingPerturbationMetrics(n_genes, n_de_genes)
+        for batch in loader:
+            streaming_metrics.update(batch.pert, 2 * batch.y, batch.y, batch.y[:, :n_de_genes], batch.y[:, :n_de_genes])
+        return streaming_metrics
+    
+    streaming_metrics = accumulate(loader)
+    shard_loaders = [get_shard_dataloader(loader, 3, rank) for rank in range(3)]
+    assert(sorted(sum([[i for batch in shard_loader.batch_sampler for i in batch] for shard_loader in shard_loaders], [])) == list(range(50)))
+    merged_metrics = accumulate(shard_loaders[0])
+    for shard_loader in shard_loaders[1:]:
+        merged_metrics.merge(accumulate(shard_loader))
+    mean_results, merged_mean_results = streaming_metrics.get_mean_results(), merged_metrics.get_mean_results()
+    assert(list(mean_results['pert_cat']) == list(merged_mean_results['pert_cat']))
+    for key in ['pred', 'truth', 'pred_de', 'truth_de']:
+        assert(np.allclose(mean_results[key], merged_mean_results[key], rtol = 1e-12))
+
+
+def test_eval_perturb_streaming_many():
+    """
+    Tests that evaluating several models in one pass over a dataloader gives the same running sums as evaluating each
+    model on its own
+    """
+    from torch_geometric.data import Data
+    
+    class ScaleModel(torch.nn.Module):
+        def __init__(self, scale):
+            super().__init__()
+            self.scale = scale
+        
+        def pred_perturb(self, batch, include_zero_gene, gene_ids, context_budget = None):
+            return self.scale * batch.y
+    
+    rng = np.random.default_rng(0)
+    n_genes = 30
+    pert_cat = [['ctrl', 'G0+ctrl', 'G1+G2'][i] for i in rng.integers(0, 3, 20)]
+    cells = [Data(pert = pert, y = torch.from_numpy(rng.random((1, n_genes)).astype(np.float32)), 
+                  de_idx = rng.choice(n_genes, 20, replace = False).tolist()) for pert in pert_cat]
+    loader = DataLoader(cells, batch_size = 8, shuffle = False)
+    models = {'a': (ScaleModel(2.0), None), 'b': (ScaleModel(3.0), None)}
+    
+    streaming_metrics = eval_perturb_streaming_many(loader, models, 'cpu', 'all')
+    for name, (model, gene_ids) in models.items():
+        expected_results = eval_perturb_streaming(loader, model, 'cpu', 'all', gene_ids).get_mean_results()
+        mean_results = streaming_metrics[name].get_mean_results()
+        for key in ['pred', 'truth', 'pred_de', 'truth_de']:
+            assert(np.array_equal(mean_results[key], expected_results[key]))
@@ -0,0 +1,15 @@
+import numpy as np
+from utils.length_bucketing import *
+
+def test_length_bucket_batch_sampler():
+    """
+    Tests that the length-bucketed batches cover every cell once and group cells of similar lengths
+    """
+    lengths = np.random.default_rng(0).integers(1, 100, 40)
+    batches = list(LengthBucketBatchSampler(lengths, 4, shuffle=True, drop_last=False, batches_per_bucket=10))
+    assert(len(batches) == 10)
+    assert(sorted(sum(batches, [])) == list(range(40)))
+    # with a single bucket, the batches split the sorted lengths
+    assert(sorted(lengths[batch].max() - lengths[batch].min() for batch in batches) == 
+           sorted(np.ptp(np.sort(lengths).reshape(10, 4), axis=1)))
+    assert(len(list(LengthBucketBatchSampler(lengths[:39], 4, drop_last=True))) == 9)
@@ -0,0 +1,44 @@
+import copy
+import logging
+import pytest
+import torch
+from torch_geometric.data import Data
+from models.scGenePT import *
+
+@pytest.mark.parametrize('include_zero_gene', ['batch-wise', 'row-wise'])
+def test_micro_batch_step(include_zero_gene):
+    """
+    Tests that an optimizer step on a batch accumulated over micro-batches gives the same parameters as a step on the
+    whole batch, with the gene tokens shared by the batch and with cells of different lengths
+    """
+    torch.manual_seed(0)
+    n_genes = 12
+    vocab = {'<pad>': 0, **{f'G{i}': i + 1 for i in range(n_genes)}}
+    gene_ids = np.arange(1, n_genes + 1)
+    model = scGenePT(len(vocab), 16, 2, 32, 2, 3, 1, vocab, 2, dropout = 0.0, pad_value = PAD_VALUE,
+                     pert_pad_id = PERT_PAD_ID, embs_to_include = ['scGPT_counts_embs', 'scGPT_token_embs'])
+    cells = []
+    for i in range(7):
+        # the cells have different numbers of nonzero genes, so row-wise micro-batches are trimmed to different lengths
+        ctrl = torch.rand(n_genes) * (torch.rand(n_genes) < 0.2 + 0.1 * i)
+        pert_flags = torch.zeros(n_genes)
+        pert_flags[i] = 1
+        cells.append(Data(x = torch.stack([ctrl, pert_flags], 1), y = torch.rand(1, n_genes)))
+    train_loader = DataLoader(cells, batch_size = 7, shuffle = False)
+
+    def train_step(micro_batch_size):
+        step_model = copy.deepcopy(model)
+        optimizer = torch.optim.SGD(step_model.parameters(), lr = 0.1)
+        scaler = torch.cuda.amp.GradScaler(enabled = False)
+        scheduler = torch.optim.lr_scheduler.StepLR(optimizer, 1)
+        train_epoch(step_model, train_loader, masked_mse_loss, optimizer, scheduler, logging.getLogger(__name__), scaler,
+                    'cpu', n_genes, gene_ids, 1, include_zero_gene, False, 'test', n_genes, 100,
+                    micro_batch_size = micro_batch_size)
+        return step_model.state_dict()
+
+    state_dict = train_step(None)
+    assert(not torch.equal(state_dict['decoder.fc.0.weight'], model.state_dict()['decoder.fc.0.weight']))
+    for micro_batch_size in [1, 3]:
+        micro_batch_state_dict = train_step(micro_batch_size)
+        for name, param in state_dict.items():
+            assert(torch.allclose(micro_batch_state_dict[name], param, atol = 1e-6)), name
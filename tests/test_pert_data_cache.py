@@ -0,0 +1,89 @@
+import os
+
+import anndata
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import torch
+from utils.pert_data_cache import *
+
+def make_gears_dataset(data_dir, dataset_name = 'adamson', n_genes = 20, n_cells_per_condition = 6):
+    """
+    Writes a small synthetic dataset in the GEARS format, with single and combo perturbations of the first 10 genes
+    """
+    rng = np.random.default_rng(0)
+    genes = [f'G{i}' for i in range(n_genes)]
+    conditions = ['ctrl'] + [f'G{i}+ctrl' for i in range(10)] + ['G0+G1', 'G1+G3', 'G2+G3', 'G4+G5', 'G6+G7', 'G8+G9']
+    obs_conditions = ['ctrl'] * 40 + sum([[c] * n_cells_per_condition for c in conditions[1:]], [])
+    condition_names = {c: f'K562_{c}_1+1' for c in conditions}
+    adata = anndata.AnnData(sp.csr_matrix(rng.random((len(obs_conditions), n_genes)).astype(np.float32)),
+                            obs = pd.DataFrame({'condition': obs_conditions,
+                                                'condition_name': [condition_names[c] for c in obs_conditions],
+                                                'cell_type': 'K562'}, index = [f'cell_{i}' for i in range(len(obs_conditions))]),
+                            var = pd.DataFrame({'gene_name': genes}, index = genes))
+    adata.uns['rank_genes_groups_cov_all'] = {name: np.array([genes[i] for i in rng.permutation(n_genes)], dtype=object)
+                                              for name in condition_names.values()}
+    adata.uns['top_non_dropout_de_20'] = adata.uns['rank_genes_groups_cov_all']
+    adata.uns['non_zeros_gene_idx'] = {name: np.arange(n_genes) for name in condition_names.values()}
+    adata.uns['non_dropout_gene_idx'] = {name: np.arange(n_genes) for name in condition_names.values()}
+    os.makedirs(os.path.join(data_dir, dataset_name))
+    adata.write_h5ad(os.path.join(data_dir, dataset_name, 'perturb_processed.h5ad'))
+
+def test_pert_data_cache(tmp_path):
+    """
+    Tests that a PertData loaded from the cache matches an uncached PertData, that a cache hit leaves the global numpy
+    RNG in the state the preparation of the split left it in, and that an invalid cache is rebuilt
+    """
+    data_dir = str(tmp_path) + '/'
+    make_gears_dataset(data_dir)
+    # the first load creates the cell graphs and the split, which reseeds the global numpy RNG, and the second load hits
+    # the cache
+    np.random.seed(0)
+    load_pert_data('adamson', 8, data_dir = data_dir)
+    rng_draw = np.random.rand()
+    np.random.seed(1234)
+    pert_data = load_pert_data('adamson', 8, data_dir = data_dir)
+    assert(np.random.rand() == rng_draw)
+    uncached_pert_data = load_pert_data('adamson', 8, data_dir = data_dir, use_cache = False)
+
+    assert(pert_data.set2conditions == uncached_pert_data.set2conditions)
+    assert(pert_data.subgroup == uncached_pert_data.subgroup)
+    assert(list(pert_data.gene_names) == list(uncached_pert_data.gene_names))
+    assert(pert_data.ctrl_adata.n_obs == 40)
+    for loader_name, loader in uncached_pert_data.dataloader.items():
+        cells, cached_cells = loader.dataset, pert_data.dataloader[loader_name].dataset
+        assert(len(cells) == len(cached_cells))
+        for cell, cached_cell in zip(cells, cached_cells):
+            assert(cell.pert == cached_cell.pert)
+            assert(torch.equal(cell.x, cached_cell.x) and torch.equal(cell.y, cached_cell.y))
+
+    cache_location = get_pert_data_cache_location(data_dir, 'adamson', get_pert_data_cache_inputs(data_dir, 'adamson', 'simulation', 1))
+    # the cell graphs are read from the GEARS cell graphs file rather than cached again
+    assert(sorted(os.listdir(cache_location)) == ['meta.json', 'pert_data.pkl'])
+    with open(os.path.join(cache_location, 'pert_data.pkl'), 'wb') as f:
+        f.write(b'invalid')
+    rebuilt_pert_data = load_pert_data('adamson', 8, data_dir = data_dir)
+    assert(rebuilt_pert_data.set2conditions == uncached_pert_data.set2conditions)
+    assert(load_pert_data_cache(cache_location, get_pert_data_cache_inputs(data_dir, 'adamson', 'simulation', 1))[0].set2conditions
+           == uncached_pert_data.set2conditions)
+
+def test_stale_dense_datasets(tmp_path):
+    """
+    Tests that dense datasets are materialized again when the dataset files they were materialized from change
+    """
+    data_dir = str(tmp_path) + '/'
+    make_gears_dataset(data_dir)
+    pert_data = load_pert_data('adamson', 8, data_dir = data_dir, dense_dataset_layout = 'csr')
+    n_train_cells = len(pert_data.dataloader['train_loader'].dataset)
+    train_location = get_dense_dataset_locations(data_dir, 'adamson', 'simulation', 1)['train']
+    assert(is_dense_dataset(train_location, get_pert_data_cache_inputs(data_dir, 'adamson', 'simulation', 1)))
+
+    # the dataset is processed again, with fewer cells
+    adata = anndata.read_h5ad(os.path.join(data_dir, 'adamson', 'perturb_processed.h5ad'))
+    adata = adata[(adata.obs['condition'] == 'ctrl').values | ~adata.obs_names.str.endswith(('0', '5'))].copy()
+    adata.write_h5ad(os.path.join(data_dir, 'adamson', 'perturb_processed.h5ad'))
+    os.remove(os.path.join(data_dir, 'adamson', 'data_pyg', 'cell_graphs.pkl'))
+    assert(not is_dense_dataset(train_location, get_pert_data_cache_inputs(data_dir, 'adamson', 'simulation', 1)))
+    pert_data = load_pert_data('adamson', 8, data_dir = data_dir, dense_dataset_layout = 'csr')
+    assert(len(pert_data.dataloader['train_loader'].dataset) < n_train_cells)
+    assert(is_dense_dataset(train_location, get_pert_data_cache_inputs(data_dir, 'adamson', 'simulation', 1)))
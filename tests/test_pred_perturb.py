@@ -0,0 +1,59 @@
+import anndata
+import pytest
+import scipy.sparse as sp
+import torch
+from models.scGenePT import *
+
+def pred_perturb_per_cell(model, ctrl_pool, perturbation, gene_names, gene_ids):
+    """
+    Predicts a perturbation one control cell at a time, as pred_perturb_from_ctrl did before control cells were batched
+    """
+    gene_ids = torch.tensor(gene_ids).long().unsqueeze(0)
+    all_pred_gene_values = []
+    for ori_gene_values in ctrl_pool:
+        pert_flags = get_pert_flags(perturbation, gene_names, len(ori_gene_values))
+        with torch.no_grad():
+            output_dict = model(gene_ids, ori_gene_values.unsqueeze(0), pert_flags,
+                                src_key_padding_mask=torch.zeros_like(gene_ids, dtype=torch.bool), do_sample=True)
+        all_pred_gene_values.append(output_dict["mlm_output"].float().numpy())
+    return np.array(all_pred_gene_values)
+
+@pytest.mark.parametrize('return_mean', [True, False])
+def test_batched_pred_perturb(return_mean):
+    """
+    Tests that the predictions of batched control cells, and of (control cell, perturbation) pairs packed into batches,
+    match the predictions of one control cell at a time
+    """
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+    n_genes = 12
+    gene_names = [f'G{i}' for i in range(n_genes)]
+    vocab = {'<pad>': 0, **{gene: i + 1 for i, gene in enumerate(gene_names)}}
+    gene_ids = np.arange(1, n_genes + 1)
+    model = scGenePT(len(vocab), 16, 2, 32, 2, 3, 1, vocab, 2, dropout = 0.0, pad_value = PAD_VALUE,
+                     pert_pad_id = PERT_PAD_ID, embs_to_include = ['scGPT_counts_embs', 'scGPT_token_embs'])
+    adata_ctrl = anndata.AnnData(sp.csr_matrix(rng.random((10, n_genes)) * (rng.random((10, n_genes)) < 0.5)).astype(np.float32))
+    perturbations = ['G1+ctrl', 'G2+G5', 'ctrl']
+    pool_size, pool_seed = 7, 0
+    ctrl_pool = get_ctrl_pool(adata_ctrl, pool_size, pool_seed)
+
+    expected_preds = {perturbation: pred_perturb_per_cell(model, ctrl_pool, perturbation, gene_names, gene_ids)
+                      for perturbation in perturbations}
+    for perturbation, expected_pred in expected_preds.items():
+        if return_mean:
+            expected_pred = np.mean(expected_pred, axis = 0)
+        for batch_size in [1, 3, 8]:
+            pred = model.pred_perturb_from_ctrl(adata_ctrl, perturbation, gene_names, 'cpu', gene_ids, amp = False,
+                                                pool_size = pool_size, return_mean = return_mean, batch_size = batch_size,
+                                                pool_seed = pool_seed)
+            assert(pred.shape == expected_pred.shape)
+            assert(np.allclose(pred, expected_pred, atol = 1e-5))
+
+    # pred_perturb_many packs (control cell, perturbation) pairs into batches and returns the mean predictions
+    if return_mean:
+        for batch_size in [1, 4, 64]:
+            preds = model.pred_perturb_many(adata_ctrl, perturbations, gene_names, 'cpu', gene_ids, amp = False,
+                                            batch_size = batch_size, ctrl_pool = ctrl_pool)
+            assert(preds.shape == (len(perturbations), n_genes))
+            for pred, perturbation in zip(preds, perturbations):
+                assert(np.allclose(pred, expected_preds[perturbation].mean(axis = (0, 1)), atol = 1e-5))
@@ -0,0 +1,59 @@
+import anndata
+import numpy as np
+import torch
+from utils.prediction_cache import *
+
+class CountingModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.weight = torch.nn.Parameter(torch.ones(1))
+        self.n_calls = 0
+
+    def pred_perturb_from_ctrl(self, adata_ctrl, perturbation, gene_names, device, gene_ids = None, amp = True,
+                               pool_size = None, return_mean = True, batch_size = 8, pool_seed = None):
+        self.n_calls += 1
+        return np.full((1, len(gene_names)), self.n_calls, dtype=np.float32)
+
+def test_prediction_cache(tmp_path):
+    """
+    Tests that predictions are served from memory and from disk, that they are invalidated when the checkpoint or the
+    control cells change and that the least recently used predictions are evicted beyond the size limits
+    """
+    checkpoint_location = tmp_path / 'best_model.pt'
+    checkpoint_location.write_bytes(b'weights')
+    model, genes = CountingModel(), ['A', 'B', 'C']
+    adata_ctrl = anndata.AnnData(np.zeros((10, 3), dtype=np.float32))
+    adata_ctrl.obs_names = [f'cell_{i}' for i in range(10)]
+    cache = PredictionCache(tmp_path / 'cache')
+    predict = lambda cache, perturbation, pool_seed = 0, adata_ctrl = adata_ctrl: cache.pred_perturb_from_ctrl(
+        model, checkpoint_location, adata_ctrl, perturbation, genes, 'cpu', pool_size = 5, pool_seed = pool_seed)
+
+    assert(predict(cache, 'A+ctrl')[0, 0] == 1)
+    assert(predict(cache, 'A+ctrl')[0, 0] == 1)
+    assert(predict(cache, 'A+ctrl', pool_seed = 1)[0, 0] == 2)
+    assert(cache.stats()['hits'] == 1 and cache.stats()['misses'] == 2)
+
+    disk_cache = PredictionCache(tmp_path / 'cache')
+    assert(predict(disk_cache, 'A+ctrl')[0, 0] == 1)
+    assert(disk_cache.stats()['disk_hits'] == 1 and model.n_calls == 2)
+
+    checkpoint_location.write_bytes(b'new weights')
+    assert(predict(cache, 'A+ctrl')[0, 0] == 3)
+
+    # the same pool size and seed sample other cells from another control sample
+    assert(predict(cache, 'A+ctrl', adata_ctrl = adata_ctrl[1:])[0, 0] == 4)
+
+    # rewriting an entry doesn't count its size twice
+    key = cache.get_key('hash', 'A+ctrl', 'ctrl_hash', 5, 0, 'float32', 'genes_hash', True)
+    disk_bytes = cache.stats()['disk_bytes']
+    cache.put(key, np.zeros((1, 3)))
+    entry_bytes = cache.stats()['disk_bytes'] - disk_bytes
+    cache.put(key, np.ones((1, 3)))
+    assert(cache.stats()['disk_bytes'] == disk_bytes + entry_bytes)
+
+    small_cache = PredictionCache(tmp_path / 'small_cache', max_memory_bytes = 24, max_disk_bytes = 300)
+    for perturbation in ['A+ctrl', 'B+ctrl', 'C+ctrl']:
+        predict(small_cache, perturbation)
+    assert(small_cache.stats()['memory_entries'] == 2)
+    assert(small_cache.stats()['disk_bytes'] <= 300)
+    assert(len(list((tmp_path / 'small_cache').glob('*.npy'))) < 3)
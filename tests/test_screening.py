@@ -0,0 +1,63 @@
+from utils.screening import *
+
+def test_get_candidate_perturbations():
+    """
+    Tests that all gene pairs, and optionally all single gene perturbations, get screened
+    """
+    genes = ['A', 'B', 'C']
+    assert(get_candidate_perturbations(genes) == ['A+B', 'A+C', 'B+C'])
+    assert(get_candidate_perturbations(genes, include_singles = True) == ['A+ctrl', 'B+ctrl', 'C+ctrl', 'A+B', 'A+C', 'B+C'])
+
+def test_shard_perturbations():
+    """
+    Tests that shards are contiguous, deterministic and cover all perturbations
+    """
+    perturbations = [f'G{i}+ctrl' for i in range(10)]
+    shards = shard_perturbations(perturbations, 4)
+    assert([len(shard) for shard in shards] == [4, 4, 2])
+    assert(sum(shards, []) == perturbations)
+
+def test_resumed_screen_ctrl_pool(tmp_path):
+    """
+    Tests that a resumed screen samples the same control pool whatever the state of the global numpy RNG, and that
+    resuming with a different control pool is refused
+    """
+    import anndata
+    import pytest
+    import scipy.sparse as sp
+    adata_ctrl = anndata.AnnData(sp.csr_matrix(np.random.default_rng(0).random((20, 4)).astype(np.float32)))
+    adata_ctrl.obs_names = [f'cell_{i}' for i in range(20)]
+    perturbations = ['A+ctrl', 'B+ctrl']
+    
+    np.random.seed(0)
+    ctrl_pool, ctrl_pool_hash = get_screen_ctrl_pool(adata_ctrl, 8, 42)
+    init_screen_outputs(tmp_path, perturbations, 1, 4, {"pool_size": 8, "rnd_seed": 42, "ctrl_pool_sha256": ctrl_pool_hash})
+    np.random.seed(1)
+    resumed_ctrl_pool, resumed_ctrl_pool_hash = get_screen_ctrl_pool(adata_ctrl, 8, 42)
+    assert(torch.equal(ctrl_pool, resumed_ctrl_pool))
+    init_screen_outputs(tmp_path, perturbations, 1, 4, {"pool_size": 8, "rnd_seed": 42, "ctrl_pool_sha256": resumed_ctrl_pool_hash})
+    
+    _, other_ctrl_pool_hash = get_screen_ctrl_pool(adata_ctrl, 8, 43)
+    with pytest.raises(ValueError):
+        init_screen_outputs(tmp_path, perturbations, 1, 4, {"pool_size": 8, "rnd_seed": 42, "ctrl_pool_sha256": other_ctrl_pool_hash})
+
+def test_load_screen_results(tmp_path):
+    """
+    Tests that the predictions of a screen are read from the memory-mapped shards of the indexed perturbations only
+    """
+    perturbations = [f'G{i}+ctrl' for i in range(10)]
+    preds = np.random.default_rng(0).random((10, 3)).astype(np.float32)
+    init_screen_outputs(tmp_path, perturbations, 4, 3, {})
+    for shard_id, start in enumerate(range(0, 10, 4)):
+        preds_location, done_location = get_shard_location(tmp_path, shard_id)
+        np.save(preds_location, preds[start:start + 4])
+        done_location.touch()
+    
+    loaded_perturbations, loaded_preds = load_screen_results(tmp_path)
+    assert(loaded_perturbations == perturbations)
+    assert(loaded_preds.shape == (10, 3) and len(loaded_preds) == 10)
+    assert(all(isinstance(shard, np.memmap) for _, shard in loaded_preds.iter_shards()))
+    assert(np.array_equal(loaded_preds[5], preds[5]) and np.array_equal(loaded_preds[-1], preds[-1]))
+    assert(np.array_equal(loaded_preds[2:9], preds[2:9]))
+    assert(np.array_equal(loaded_preds[[9, 0, 4, 4]], preds[[9, 0, 4, 4]]))
+    assert(np.array_equal(np.concatenate([shard for _, shard in loaded_preds.iter_shards()]), preds))
@@ -0,0 +1,40 @@
+import sys
+from utils.sweep import *
+
+def test_get_sweep_configs():
+    """
+    Tests that the grid is fully expanded, with the _no_attention variants of the model types
+    """
+    configs = get_sweep_configs(['scgpt', 'scgenept_go_c_gpt_concat'], [1e-4, 1e-3], [0.2], [42, 23], no_attention_variants = True)
+    assert(len(configs) == 4 * 2 * 2)
+    assert(sorted(set(config['model_type'] for config in configs)) == 
+           ['scgenept_go_c_gpt_concat', 'scgenept_go_c_gpt_concat_no_attention', 'scgpt', 'scgpt_no_attention'])
+    assert(get_config_outputs_dir('outputs/sweep/', configs[0]) == 'outputs/sweep/lr_0.0001_dropout_0.2/')
+
+def test_run_jobs(tmp_path):
+    """
+    Tests that every job runs pinned to the cores of a slot, with as many threads as its slot has cores
+    """
+    core_slots = get_core_slots(1, max_jobs = 2)
+    commands = [[sys.executable, '-c', f'import os; print(os.environ["OMP_NUM_THREADS"], sorted(os.sched_getaffinity(0))); exit({i % 2})']
+                for i in range(3)]
+    log_locations = [tmp_path / f'job_{i}.log' for i in range(3)]
+    assert(run_jobs(commands, core_slots, log_locations = log_locations, poll_interval = 0.01) == [0, 1, 0])
+    for log_location in log_locations:
+        n_threads, cores = log_location.read_text().split(' ', 1)
+        assert(n_threads == '1' and cores.strip() in [str(cores) for cores in core_slots])
+
+def test_get_core_slots(monkeypatch):
+    """
+    Tests that the cores are split into disjoint slots, limited by max_jobs and by the physical memory
+    """
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: set(range(8)))
+    # 10 GB of physical memory
+    monkeypatch.setattr(os, 'sysconf', lambda name: {'SC_PAGE_SIZE': 4096, 'SC_PHYS_PAGES': 10 * 1024**3 // 4096}[name])
+    assert(get_core_slots(2) == [[0, 1], [2, 3], [4, 5], [6, 7]])
+    assert(get_core_slots(3) == [[0, 1, 2], [3, 4, 5]])
+    assert(get_core_slots(2, memory_per_job_gb = 3) == [[0, 1], [2, 3], [4, 5]])
+    assert(get_core_slots(2, max_jobs = 2, memory_per_job_gb = 3) == [[0, 1], [2, 3]])
+    # a job whose memory limit doesn't fit in the physical memory still gets a slot
+    assert(get_core_slots(2, memory_per_job_gb = 16) == [[0, 1]])
+    assert(get_core_slots(16) == [list(range(8))])
@@ -0,0 +1,115 @@
+# with --concurrent-seeds, the seeds are trained in forked processes, see utils/numba_threading.py
+import utils.numba_threading
+
+from train import *
+import multiprocessing as mp
+import multiprocessing.connection
+
+# Shared assets of the seeds trained concurrently; set before forking the seed processes, so that they inherit them
+_assets = None
+
+
+def get_args():
+    """
+    Parses command line arguments
+
+    Returns:
+        list of args
+    """
+    parser = get_arg_parser(description='Arguments for training a model with several random seeds, sharing the data and pretrained assets across seeds ...')
+    parser.add_argument(
+        '--seeds',
+        type=int,
+        nargs='+',
+        help='random seeds to train the model with; each seed is saved under outputs_dir/dataset/model_type/seed_<seed>/',
+        default = [42, 23, 89, 30, 12]
+    )
+    parser.add_argument(
+        '--concurrent-seeds',
+        type=int,
+        help='number of seeds trained at the same time, each in a process forked after loading the shared assets and using an equal share of the cores; seeds are trained one after the other if 1',
+        default = 1
+    )
+    args = parser.parse_args()
+    return args
+
+
+def train_seed_with_log(args, assets, rnd_seed, device):
+    """
+    Trains a model with a random seed, logging to the run.log of the seed, see train_seed
+    """
+    save_dir = get_save_dir(args.outputs_dir, args.dataset, args.model_type, rnd_seed)
+    make_output_dirs(save_dir)
+    logger = scg.logger
+    scg.utils.add_file_handler(logger, save_dir / "run.log")
+    file_handler = logger.handlers[-1]
+    try:
+        return train_seed(args, assets, rnd_seed, device, logger)
+    finally:
+        logger.removeHandler(file_handler)
+        file_handler.close()
+
+
+def _train_forked_seed(args, rnd_seed, device, num_threads):
+    """
+    Trains a seed in a forked process, with the shared assets inherited from the parent process
+    """
+    torch.set_num_threads(num_threads)
+    train_seed_with_log(args, _assets, rnd_seed, device)
+
+
+def train_concurrent_seeds(args, seeds, device, concurrent_seeds, logger):
+    """
+    Trains the seeds in processes forked from the main thread after loading the shared assets, with at most
+    concurrent_seeds processes at a time, each using an equal share of the cores. Forked processes share the memory
+    pages of the assets with the parent process instead of copying them.
+    
+    Args:
+        args: command line arguments, see get_args
+        seeds: random seeds to train the model with
+        device: device to train on
+        concurrent_seeds: max number of seeds trained at the same time
+        logger: logger
+    """
+    num_threads = max(1, os.cpu_count() // concurrent_seeds)
+    ctx = mp.get_context('fork')
+    pending_seeds = list(seeds)
+    running = {}
+    failed_seeds = []
+    while pending_seeds or running:
+        while pending_seeds and len(running) < concurrent_seeds:
+            rnd_seed = pending_seeds.pop(0)
+            process = ctx.Process(target=_train_forked_seed, args=(args, rnd_seed, device, num_threads))
+            process.start()
+            running[process.sentinel] = (rnd_seed, process)
+        for sentinel in mp.connection.wait(list(running)):
+            rnd_seed, process = running.pop(sentinel)
+            process.join()
+            if process.exitcode != 0:
+                failed_seeds.append(rnd_seed)
+            logger.info(f"Finished training seed {rnd_seed} with exit code {process.exitcode}")
+    if failed_seeds:
+        raise RuntimeError(f"Training failed for seeds {failed_seeds}")
+
+
+if __name__ == "__main__":
+
+    args = get_args()
+    set_seed(args.rnd_seed)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    device = args.device
+    logger = scg.logger
+
+    # Data, vocab, gene embeddings and pretrained scGPT weights are loaded once for all seeds
+    start_time = time.time()
+    _assets = load_shared_assets(args, logger)
+    logger.info(f"Loaded the shared assets in {time.time() - start_time:.1f}s")
+
+    if args.concurrent_seeds <= 1:
+        for rnd_seed in args.seeds:
+            train_seed_with_log(args, _assets, rnd_seed, device)
+    else:
+        # CUDA can't be used in forked processes if it has been initialized in the parent process, which is why the
+        # assets are loaded on CPU
+        train_concurrent_seeds(args, args.seeds, device, args.concurrent_seeds, logger)
@@ -2,7 +2,14 @@ from utils.data_loading import *
 from utils.scgpt_config import *
 
 from models.scGenePT import *
+from utils.pert_data_cache import load_pert_data
+from utils.checkpoint import save_scgenept_checkpoint
+from utils.evaluation import compute_test_metrics
+from utils.length_bucketing import get_length_bucketed_dataloader
+from utils.distributed import *
 import argparse
+import copy
+import logging
 import random
 import numpy as np
 import os
@@ -40,34 +47,36 @@ def make_output_dirs(save_dir):
     print(f"saving to {save_dir}")
 
     
-def load_dataloader(dataset_name, batch_size, val_batch_size, split = 'simulation'):
+def load_dataloader(dataset_name, batch_size, val_batch_size, split = 'simulation', dense_dataset_layout = None):
     """
     Loads data in a PertData format. Uses GEARS dataloaders implementation as described under https://github.com/snap-stanford/GEARS
+    The prepared split and dataloader datasets are cached under data/, so that only the first run prepares them (see utils/pert_data_cache.py).
     
     Args:
         dataset_name: name of the dataset to load. Example: 'adamson', 'norman'.
         batch_size: batch_size for the train datalaoder
-        val_batch_size: batch_size for the validation dataloader
+        val_batch_size: batch_size for the validation dataloader; note that GEARS uses batch_size for all dataloaders of a split
         split: split to use; tested with 'simulation'
+        dense_dataset_layout: if not None, the GEARS dataloaders are replaced by DenseDataLoaders over dense datasets 
+            with this layout, one of 'csr', 'dense' (see utils/dense_dataset.py)
         
     Returns:
         pert_data: PertData object
     """
-    pert_data = PertData("data/")
-    pert_data.load(data_name=dataset_name)
-    pert_data.prepare_split(split=split, seed=1)
-    pert_data.get_dataloader(batch_size=batch_size, test_batch_size=val_batch_size)
-    return pert_data
+    return load_pert_data(dataset_name, batch_size, split = split, seed = 1, dense_dataset_layout = dense_dataset_layout)
 
     
-def get_args():
+def get_arg_parser(description = 'Arguments for training ...'):
     """
-    Parses command line arguments
+    Creates the parser of the training command line arguments
+    
+    Args:
+        description: description of the script
     
     Returns:
-        list of args
+        argparse.ArgumentParser
     """
-    parser = argparse.ArgumentParser(description='Arguments for training ...')
+    parser = argparse.ArgumentParser(description=description)
     parser.add_argument(
         '--num-epochs', 
         type=int, 
@@ -158,28 +167,204 @@ def get_args():
         help='directory where model outputs and metrics are saved', 
         default = 'outputs/'
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        '--compact-gene-embs', 
+        action='store_true', 
+        help='only keep the dataset genes in the genePT/GO embedding tables instead of the full scGPT vocab; reduces memory'
+    )
+    parser.add_argument(
+        '--gene-embs-dtype', 
+        type=str, 
+        help='dtype of the genePT/GO embedding tables; float16 is only recommended for inference', 
+        choices = ['float64', 'float32', 'float16'],
+        default = 'float64'
+    )
+    parser.add_argument(
+        '--checkpoint-format', 
+        type=str, 
+        help='format the best model is saved in; state_dict saves a plain state dict with the config in a separate json file, scgenept saves a self-describing checkpoint holding the model config and the dataset genes, which is memory-mapped on load (see utils/checkpoint.py)', 
+        choices = ['scgenept', 'state_dict'],
+        default = 'state_dict'
+    )
+    parser.add_argument(
+        '--checkpoint-dtype', 
+        type=str, 
+        help='dtype the floating point weights of scgenept checkpoints are stored in, eg float16 to halve the checkpoint size; by default, weights are stored in their own dtype', 
+        choices = ['float32', 'float16'],
+        default = None
+    )
+    parser.add_argument(
+        '--prefetch-batches', 
+        type=int, 
+        help='number of training batches prepared ahead in a background thread while the model trains; 0 disables prefetching', 
+        default = 0
+    )
+    parser.add_argument(
+        '--micro-batch-size', 
+        type=str, 
+        help='number of cells run through the model at once; the gradients of each --batch-size batch are accumulated over micro-batches before the optimizer step, so the optimization is the same as without micro-batches. Either a number of cells or auto, which estimates it from --memory-budget-gb. Defaults to --batch-size', 
+        default = None
+    )
+    parser.add_argument(
+        '--memory-budget-gb', 
+        type=float, 
+        help='memory available for training, in GB; used by --micro-batch-size=auto', 
+        default = None
+    )
+    parser.add_argument(
+        '--checkpoint-every-k-layers', 
+        type=int, 
+        help='checkpoint the activations of every k-th transformer layer to train with longer --max-seq-len in less memory, at the cost of recomputing these layers in the backward pass; 1 checkpoints every layer, 0 disables checkpointing', 
+        default = 0
+    )
+    parser.add_argument(
+        '--include-zero-gene', 
+        type=str, 
+        help='genes input to the model: all genes, the genes that are nonzero in any cell of the batch (batch-wise) or the nonzero and perturbed genes of each cell, padded to the longest cell of the batch (row-wise)', 
+        choices = ['all', 'batch-wise', 'row-wise'],
+        default = INCLUDE_ZERO_GENE
+    )
+    parser.add_argument(
+        '--length-bucketing', 
+        action='store_true', 
+        help='batch the train and val cells by their number of nonzero genes, so that row-wise batches need less padding (see utils/length_bucketing.py)'
+    )
+    parser.add_argument(
+        '--dist-backend', 
+        type=str, 
+        help='backend of distributed data-parallel training, when run with torchrun, eg torchrun --nproc-per-node=8 train.py --device=cpu ...; gloo trains on CPU, with the cores of each node split across its processes, nccl on GPUs. Defaults to nccl if CUDA is available and gloo otherwise', 
+        choices = ['gloo', 'nccl'],
+        default = None
+    )
+    parser.add_argument(
+        '--num-threads', 
+        type=int, 
+        help='number of threads torch uses on CPU; defaults to the torch default', 
+        default = None
+    )
+    parser.add_argument(
+        '--dense-datasets', 
+        type=str, 
+        help='if set, the dataloaders read the cells from dense datasets with this layout instead of collating GEARS cell graphs; the dense datasets are materialized under data/ on first use (see utils/dense_dataset.py)', 
+        choices = ['csr', 'dense'],
+        default = None
+    )
+    return parser
+
+def get_args():
+    """
+    Parses command line arguments
+    
+    Returns:
+        list of args
+    """
+    args = get_arg_parser().parse_args()
     return args
 
-if __name__ == "__main__":    
-       
-    args = get_args()    
-    set_seed(args.rnd_seed)
-    device = args.device
-    dataset_name = args.dataset
-    model_type = args.model_type
-    use_fast_transformer = True  # whether to use fast transformer
-    amp = True
+def get_save_dir(outputs_dir, dataset_name, model_type, rnd_seed):
+    """
+    Returns the directory the outputs of a training run are saved to, eg outputs/norman/scgenept_go_c_gpt_concat/seed_42/
+    """
+    return Path(outputs_dir + dataset_name + "/" + model_type + "/seed_" + str(rnd_seed) + "/")
+
+
+def load_shared_assets(args, logger, rank = 0, world_size = 1):
+    """
+    Loads everything the training of a model depends on that isn't modified by training, so that it can be shared by
+    the training runs of several seeds: the dataloaders, the scGPT vocab and dataset genes, the genePT/GO embeddings
+    and the pretrained scGPT weights.
     
+    Args:
+        args: command line arguments, see get_args
+        logger: logger
+        rank: rank of the process in distributed training
+        world_size: number of processes in distributed training; if > 1, the train and val dataloaders are sharded
+        
+    Returns:
+        assets: dict with the shared assets
+    """
     # Location of pretrained scGPT model
     scgpt_pretrained_model_location = args.pretrained_model_dir + 'pretrained/scgpt'
     
-    # Location where the model outputs will be saved to 
-    save_dir = Path(args.outputs_dir + dataset_name + "/" + model_type + "/seed_" + str(args.rnd_seed) + "/")
-    make_output_dirs(save_dir)
+    # Load data; the main process prepares the split and dataset caches first, so that the other processes read them
+    if not is_main_process():
+        barrier()
+    pert_data = load_dataloader(args.dataset, args.batch_size, args.eval_batch_size, split = 'simulation', dense_dataset_layout = args.dense_datasets)
+    if is_main_process():
+        barrier()
+    if args.length_bucketing:
+        for loader_name in ['train_loader', 'val_loader']:
+            pert_data.dataloader[loader_name] = get_length_bucketed_dataloader(pert_data.dataloader[loader_name])
+    if world_size > 1:
+        # each process trains and validates on its shard of every batch
+        for loader_name in ['train_loader', 'val_loader']:
+            pert_data.dataloader[loader_name] = get_distributed_dataloader(pert_data.dataloader[loader_name], world_size, rank, args.rnd_seed)
     
-    logger = scg.logger
-    scg.utils.add_file_handler(logger, save_dir / "run.log")
+    # Get the embedding types to include in the model training 
+    embs_to_include = get_embs_to_include(args.model_type)
+    
+    # Get gene vocab and IDs
+    vocab_file = Path(scgpt_pretrained_model_location) / "vocab.json"
+    vocab, gene_ids, dataset_genes, gene2idx = match_genes_to_scgpt_vocab(vocab_file, pert_data, logger, SPECIAL_TOKENS)
+    
+    # If using compact gene embeddings, only the dataset genes get a row in the GenePT/GO embedding tables
+    compact_gene_ids = get_compact_gene_ids(gene_ids, vocab) if args.compact_gene_embs else None
+    gene_embs_dtype = np.dtype(args.gene_embs_dtype)
+    
+    # Get GenePT embeddings to include
+    genept_embs, genept_emb_type, genept_emb_dim, found_genes_genept = initialize_genept_embeddings(embs_to_include, dataset_genes, vocab, args.model_type, args.pretrained_model_dir, 
+                                                                                                    compact_gene_ids, gene_embs_dtype)
+    
+    # Get GO embeddings to include
+    go_embs_to_include, go_emb_type, go_emb_dim, found_genes_go = initialize_go_embeddings(embs_to_include, dataset_genes, vocab, args.model_type, args.pretrained_model_dir, 
+                                                                                           compact_gene_ids, gene_embs_dtype)
+    
+    # Pretrained scGPT weights, loaded on CPU so that they can be shared by processes forked after loading them
+    pretrained_params = torch.load(Path(scgpt_pretrained_model_location) / "best_model.pt", map_location='cpu')
+    
+    return {
+        'pert_data': pert_data,
+        'embs_to_include': embs_to_include,
+        'vocab': vocab,
+        'gene_ids': gene_ids,
+        'dataset_genes': dataset_genes,
+        'gene2idx': gene2idx,
+        'compact_gene_ids': compact_gene_ids,
+        'genept_embs': genept_embs,
+        'genept_emb_type': genept_emb_type,
+        'genept_emb_dim': genept_emb_dim,
+        'go_embs_to_include': go_embs_to_include,
+        'go_emb_type': go_emb_type,
+        'go_emb_dim': go_emb_dim,
+        'pretrained_params': pretrained_params,
+    }
+
+
+def train_seed(args, assets, rnd_seed, device, logger, world_size = 1, local_rank = 0):
+    """
+    Trains a model with a random seed on the shared assets, then saves the best model and its test metrics under 
+    get_save_dir(args.outputs_dir, args.dataset, args.model_type, rnd_seed). The shared assets are not modified.
+    
+    Args:
+        args: command line arguments, see get_args
+        assets: shared assets, see load_shared_assets
+        rnd_seed: random seed of the run
+        device: device to train on
+        logger: logger
+        world_size: number of processes in distributed training; if > 1, the model is wrapped in DistributedDataParallel
+        local_rank: rank of the process on its node in distributed training
+        
+    Returns:
+        test_metrics: test metrics of the trained model; None in the processes that aren't the main process
+    """
+    set_seed(rnd_seed)
+    use_fast_transformer = True  # whether to use fast transformer
+    amp = True
+    save_dir = get_save_dir(args.outputs_dir, args.dataset, args.model_type, rnd_seed)
+    pert_data = assets['pert_data']
+    vocab = assets['vocab']
+    gene_ids = assets['gene_ids']
+    ntokens = len(vocab)  # size of vocabulary
     
     # Log running date
     logger.info(f"Running on {time.strftime('%Y-%m-%d %H:%M:%S')}")
@@ -191,22 +376,10 @@ if __name__ == "__main__":
         "transformer_encoder"
     ]
     
-    # Load data
-    pert_data = load_dataloader(args.dataset, args.batch_size, args.eval_batch_size, split = 'simulation')
-    
-    # Get the embedding types to include in the model training 
-    embs_to_include = get_embs_to_include(args.model_type)
-    
-    # Get gene vocab and IDs
-    vocab_file = Path(scgpt_pretrained_model_location) / "vocab.json"
-    vocab, gene_ids, dataset_genes, gene2idx = match_genes_to_scgpt_vocab(vocab_file, pert_data, logger, SPECIAL_TOKENS)
-    ntokens = len(vocab)  # size of vocabulary
-    
-    # Get GenePT embeddings to include
-    genept_embs, genept_emb_type, genept_emb_dim, found_genes_genept = initialize_genept_embeddings(embs_to_include, dataset_genes, vocab, args.model_type, args.pretrained_model_dir)
-    
-    # Get GO embeddings to include
-    go_embs_to_include, go_emb_type, go_emb_dim, found_genes_go = initialize_go_embeddings(embs_to_include, dataset_genes, vocab, args.model_type, args.pretrained_model_dir)
+    # The genePT/GO embedding layers share memory with the arrays they are initialized from and are updated in place by
+    # training, so each model gets its own copy of the shared embeddings
+    genept_embs = copy.deepcopy(assets['genept_embs'])
+    go_embs_to_include = copy.deepcopy(assets['go_embs_to_include'])
     
     model = scGenePT(
         ntoken=ntokens,
@@ -223,13 +396,14 @@ if __name__ == "__main__":
         pad_value=PAD_VALUE,
         pert_pad_id=PERT_PAD_ID,
         use_fast_transformer=use_fast_transformer,
-        embs_to_include = embs_to_include,
+        embs_to_include = assets['embs_to_include'],
         genept_embs = genept_embs, 
-        genept_emb_type = genept_emb_type, 
-        genept_emb_size = genept_emb_dim,
+        genept_emb_type = assets['genept_emb_type'], 
+        genept_emb_size = assets['genept_emb_dim'],
         go_embs_to_include = go_embs_to_include,
-        go_emb_type = go_emb_type,
-        go_emb_size = go_emb_dim
+        go_emb_type = assets['go_emb_type'],
+        go_emb_size = assets['go_emb_dim'],
+        compact_gene_ids = assets['compact_gene_ids']
     )
     
     # If we don't to include learned attention, it needs to be taken out of the weights that are being initialize
@@ -240,8 +414,26 @@ if __name__ == "__main__":
         ] 
         
     # Load weights from pretrained_model
-    model = load_pretrained_model(model, load_param_prefixs, False, Path(scgpt_pretrained_model_location) / "best_model.pt", device)  
+    model = load_pretrained_model(model, load_param_prefixs, False, assets['pretrained_params'], device)  
     model.to(device)
+    if args.checkpoint_every_k_layers > 0:
+        model.set_activation_checkpointing(args.checkpoint_every_k_layers)
+    
+    # Number of cells run through the model at once; gradients are accumulated over the micro-batches of each batch
+    micro_batch_size = args.micro_batch_size
+    if micro_batch_size == 'auto':
+        if args.memory_budget_gb is None:
+            raise ValueError("--micro-batch-size=auto requires --memory-budget-gb")
+        micro_batch_size = get_auto_micro_batch_size(model, min(len(gene_ids), args.max_seq_len), args.memory_budget_gb, amp)
+    if micro_batch_size is not None:
+        micro_batch_size = min(int(micro_batch_size), args.batch_size)
+        logger.info(f"Accumulating the gradients of batches of {args.batch_size} cells over micro-batches of {micro_batch_size} cells")
+    
+    # The parameters are broadcast from the main process; the cls decoder isn't used by the perturbation objective
+    scgenept_model = model
+    if world_size > 1:
+        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[local_rank] if device.startswith('cuda') else None, 
+                                                          find_unused_parameters=True, broadcast_buffers=False)
     
     # Lr functions
     loss_fn = masked_mse_loss
@@ -251,14 +443,54 @@ if __name__ == "__main__":
     
     # Train model
     save_models_each_epoch = False
-    best_model = train_model(model, pert_data, args.num_epochs, loss_fn, optimizer, scheduler, scaler, device, gene_ids, logger, INCLUDE_ZERO_GENE, amp, dataset_name, args.model_type, args.rnd_seed, args.max_seq_len, args.log_interval, args.early_stop, gene2idx, save_models_each_epoch, save_dir)
+    best_model = train_model(model, pert_data, args.num_epochs, loss_fn, optimizer, scheduler, scaler, device, gene_ids, logger, args.include_zero_gene, amp, args.dataset, args.model_type, rnd_seed, args.max_seq_len, args.log_interval, args.early_stop, assets['gene2idx'], save_models_each_epoch, save_dir, 
+                             prefetch_batches = args.prefetch_batches, micro_batch_size = micro_batch_size)
+    if not is_main_process():
+        return None
     
-    # Save best model under model output directory
+    # Save best model under model output directory, together with the model config, so the model can be rebuilt 
+    # for inference without the pre-computed embeddings
     print(f"Saving best model under {save_dir}/models/best_model.pt")
-    torch.save(best_model.state_dict(), save_dir / "models/best_model.pt")
+    config = get_scgenept_config(args.model_type, ntokens, vocab[PAD_TOKEN], gene_ids, assets['dataset_genes'], assets['genept_emb_dim'], 
+                                 assets['go_emb_type'], assets['go_emb_dim'], assets['compact_gene_ids'])
+    if args.checkpoint_format == 'scgenept':
+        save_scgenept_checkpoint(save_dir / "models/best_model.pt", best_model.state_dict(), config, 
+                                 getattr(torch, args.checkpoint_dtype) if args.checkpoint_dtype is not None else None)
+    else:
+        torch.save(best_model.state_dict(), save_dir / "models/best_model.pt")
+        save_scgenept_config(get_config_location(save_dir / "models/best_model.pt"), config)
     
     # Evaluate best model on test data  
     print(f"Evaluating best model on test data:")
-    test_metrics = compute_test_metrics(pert_data, model, 'test', save_dir, device, INCLUDE_ZERO_GENE, gene_ids)
+    test_metrics = compute_test_metrics(pert_data, scgenept_model, 'test', save_dir, device, args.include_zero_gene, gene_ids)
     with open(save_dir / "metrics/test/test_metrics_detailed.json", "w") as outfile:
-        outfile.write(json.dumps(test_metrics))
\ No newline at end of file
+        outfile.write(json.dumps(test_metrics))
+    return test_metrics
+
+
+if __name__ == "__main__":    
+       
+    args = get_args()    
+    set_seed(args.rnd_seed)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    # Distributed data-parallel training when run with torchrun; a single process otherwise
+    rank, world_size, local_rank = init_distributed(args.dist_backend)
+    device = args.device
+    if world_size > 1 and device.startswith('cuda'):
+        device = f'cuda:{local_rank}'
+        torch.cuda.set_device(device)
+    
+    # Location where the model outputs will be saved to 
+    save_dir = get_save_dir(args.outputs_dir, args.dataset, args.model_type, args.rnd_seed)
+    logger = scg.logger
+    if is_main_process():
+        make_output_dirs(save_dir)
+        scg.utils.add_file_handler(logger, save_dir / "run.log")
+    else:
+        # only the main process logs and saves outputs
+        logger.setLevel(logging.WARNING)
+    
+    assets = load_shared_assets(args, logger, rank, world_size)
+    train_seed(args, assets, args.rnd_seed, device, logger, world_size, local_rank)
+    destroy_distributed()
@@ -0,0 +1,95 @@
+import queue
+import threading
+
+import torch
+
+# Marks the end of the batches in the prefetch queue
+_END_OF_BATCHES = object()
+
+
+class BatchPrefetcher:
+    """
+    Prepares the batches of a dataloader in a background thread, so that batch N+1 is decoded and moved to the device
+    while the model trains on batch N. At most num_prefetch prepared batches are kept in memory.
+
+    The first batch is fetched in the calling thread, so that the shuffling of the dataloader draws from the global
+    torch RNG in the same order as without prefetching; prepare_fn should not use the global torch RNG, eg it should
+    sample genes with a dedicated torch.Generator instead.
+    """
+    def __init__(self, loader, prepare_fn, num_prefetch = 2, device = None):
+        """
+        Args:
+            loader: dataloader to prefetch batches from
+            prepare_fn: function mapping a batch of the dataloader to the prepared batch, eg a tuple of tensors on the device
+            num_prefetch: max number of prepared batches waiting in the queue
+            device: device prepare_fn moves the batches to; on CUDA devices, batches are prepared on a separate stream
+        """
+        self.loader = loader
+        self.prepare_fn = prepare_fn
+        self.num_prefetch = num_prefetch
+        self.device = torch.device(device) if device is not None else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _put(self, batch_queue, stop, item):
+        """
+        Puts an item in the queue, waiting for a free slot until the consumer stops; returns False if it stopped
+        """
+        while not stop.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _prefetch(self, batches, batch_queue, stop, stream):
+        """
+        Prepares the batches and puts them in the queue until the end of the batches or until the consumer stops
+        """
+        try:
+            # torch.cuda.stream(None) is a no-op, also on CPU-only hosts
+            with torch.cuda.stream(stream):
+                for batch in batches:
+                    prepared_batch = self.prepare_fn(batch)
+                    if stream is not None:
+                        stream.synchronize()
+                    if not self._put(batch_queue, stop, prepared_batch):
+                        return
+        except Exception as e:
+            self._put(batch_queue, stop, e)
+            return
+        self._put(batch_queue, stop, _END_OF_BATCHES)
+
+    def __iter__(self):
+        batches = iter(self.loader)
+        try:
+            first_batch = next(batches)
+        except StopIteration:
+            return
+        yield self.prepare_fn(first_batch)
+
+        stream = None
+        if self.device is not None and self.device.type == "cuda":
+            stream = torch.cuda.Stream(self.device)
+        batch_queue = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._prefetch, args=(batches, batch_queue, stop, stream), daemon=True)
+        thread.start()
+        try:
+            while True:
+                prepared_batch = batch_queue.get()
+                if prepared_batch is _END_OF_BATCHES:
+                    break
+                if isinstance(prepared_batch, Exception):
+                    raise prepared_batch
+                if stream is not None:
+                    # the tensors were allocated on the prefetch stream but are used on the current stream
+                    for t in prepared_batch:
+                        if isinstance(t, torch.Tensor):
+                            t.record_stream(torch.cuda.current_stream(self.device))
+                yield prepared_batch
+        finally:
+            stop.set()
+            thread.join()
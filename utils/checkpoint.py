@@ -0,0 +1,318 @@
+import argparse
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# Name and version of the self-describing scGenePT checkpoint format
+CHECKPOINT_FORMAT = "scgenept"
+CHECKPOINT_VERSION = 1
+
+# Key layouts of the transformer attention weights; flash-attn layers store the fused input projection under
+# Wqkv., the PyTorch layers under in_proj_
+ATTENTION_LAYOUT2KEY = {
+    "flash": "Wqkv.",
+    "pytorch": "in_proj_",
+}
+
+# Encoders holding the genePT/GO embedding tables
+GENE_EMBEDDING_ENCODERS = ["genept_encoder", "gopt_encoder_c", "gopt_encoder_f", "gopt_encoder_p"]
+
+
+def get_attention_layout(state_dict):
+    """
+    Returns the key layout of the attention weights in a state dict, one of 'flash', 'pytorch'
+    """
+    if any(ATTENTION_LAYOUT2KEY["flash"] in k for k in state_dict):
+        return "flash"
+    return "pytorch"
+
+
+def convert_attention_layout(state_dict, attention_layout):
+    """
+    Converts the keys of the attention weights in a state dict to a given layout. The fused input projection weights
+    have the same shape in both layouts, so only the keys are renamed.
+
+    Args:
+        state_dict: model state dict
+        attention_layout: layout to convert to, one of 'flash', 'pytorch'
+
+    Returns:
+        state_dict: state dict with the attention weights in attention_layout
+    """
+    if attention_layout not in ATTENTION_LAYOUT2KEY:
+        raise ValueError(f"Unknown attention layout: {attention_layout}; expected one of {list(ATTENTION_LAYOUT2KEY)}")
+    source_layout = get_attention_layout(state_dict)
+    if source_layout == attention_layout:
+        return state_dict
+    source_key, target_key = ATTENTION_LAYOUT2KEY[source_layout], ATTENTION_LAYOUT2KEY[attention_layout]
+    return {k.replace(source_key, target_key): v for k, v in state_dict.items()}
+
+
+def get_checkpoint_hash(checkpoint_location, chunk_size = 2 ** 20):
+    """
+    Returns the sha256 hash of the contents of a checkpoint file, read in chunks of chunk_size bytes
+    """
+    checkpoint_hash = hashlib.sha256()
+    with open(checkpoint_location, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            checkpoint_hash.update(chunk)
+    return checkpoint_hash.hexdigest()
+
+
+def get_checkpoint_hash_location(checkpoint_location):
+    """
+    Returns the location of the sidecar file memoising the content hash of a checkpoint, 
+    eg best_model.pt -> best_model.pt.sha256.json
+    """
+    return f"{checkpoint_location}.sha256.json"
+
+
+def get_memoised_checkpoint_hash(checkpoint_location):
+    """
+    Returns the content hash of a checkpoint, see get_checkpoint_hash, memoised in a sidecar file next to the checkpoint
+    keyed by the size and modification time of the checkpoint file, so that the checkpoint is only read again when it
+    changes. Failing to write the sidecar file, eg in a read-only directory, is not an error.
+    """
+    checkpoint_stat = os.stat(checkpoint_location)
+    checkpoint_version = {"size": checkpoint_stat.st_size, "mtime_ns": checkpoint_stat.st_mtime_ns}
+    hash_location = get_checkpoint_hash_location(checkpoint_location)
+    try:
+        with open(hash_location) as f:
+            memoised_hash = json.load(f)
+        if memoised_hash["version"] == checkpoint_version:
+            return memoised_hash["sha256"]
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    checkpoint_hash = get_checkpoint_hash(checkpoint_location)
+    tmp_location = f"{hash_location}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_location, "w") as f:
+            json.dump({"version": checkpoint_version, "sha256": checkpoint_hash}, f)
+        os.replace(tmp_location, hash_location)
+    except OSError as e:
+        print(f"Could not memoise the hash of {checkpoint_location} under {hash_location}: {e}")
+        if os.path.exists(tmp_location):
+            os.remove(tmp_location)
+    return checkpoint_hash
+
+
+def get_converted_checkpoint_location(checkpoint_location, attention_layout, checkpoint_hash):
+    """
+    Returns the location of the cached conversion of a checkpoint to attention_layout, next to the original checkpoint,
+    eg best_model.pt -> best_model.pytorch-<checkpoint_hash[:16]>.pt. Keying on the content hash means that the cache
+    is never stale when the original checkpoint is overwritten.
+    """
+    checkpoint_location = Path(checkpoint_location)
+    return str(checkpoint_location.with_name(f"{checkpoint_location.stem}.{attention_layout}-{checkpoint_hash[:16]}.pt"))
+
+
+def compact_gene_embeddings(state_dict, compact_gene_ids):
+    """
+    Only keeps the rows of compact_gene_ids in the full-vocab genePT/GO embedding tables of a state dict,
+    converting them to the layout of CompactGeneEmbedding. Tables that are already compact are left unchanged.
+
+    Args:
+        state_dict: model state dict
+        compact_gene_ids: sorted vocab indices of the rows to keep (see utils.data_loading.get_compact_gene_ids)
+
+    Returns:
+        state_dict: state dict with compact genePT/GO embedding tables
+    """
+    state_dict = dict(state_dict)
+    compact_gene_ids = torch.as_tensor(np.asarray(compact_gene_ids)).long()
+    for encoder in GENE_EMBEDDING_ENCODERS:
+        weight_key = f"{encoder}.embedding.weight"
+        compact_gene_ids_key = f"{encoder}.embedding.compact_gene_ids"
+        if weight_key not in state_dict or compact_gene_ids_key in state_dict:
+            continue
+        weight = state_dict[weight_key]
+        state_dict[weight_key] = weight[compact_gene_ids.to(weight.device)].contiguous()
+        state_dict[compact_gene_ids_key] = compact_gene_ids
+    return state_dict
+
+
+def save_scgenept_checkpoint(checkpoint_location, state_dict, config, dtype = None, compact_gene_embs = False):
+    """
+    Saves a trained model in the self-describing scGenePT checkpoint format: a single file holding the model config
+    (see utils.data_loading.get_scgenept_config), including the dataset genes, the key layout of the attention weights
+    and the weights. Checkpoints are read back with load_scgenept_checkpoint, which memory-maps the weights.
+
+    Args:
+        checkpoint_location: location of the checkpoint to save
+        state_dict: model state dict
+        config: model config, as created by utils.data_loading.get_scgenept_config
+        dtype: if not None, floating point weights are stored in this dtype, eg torch.float16 to halve the checkpoint size;
+            they are cast back to their original dtype on load
+        compact_gene_embs: if True, the genePT/GO embedding tables only keep the rows of the dataset genes and the pad 
+            token, dropping the other vocab rows; by default, the tables are saved in the layout of state_dict
+    """
+    config = dict(config)
+    if compact_gene_embs and config["compact_gene_ids"] is None:
+        compact_gene_ids = np.unique(np.concatenate([config["gene_ids"], [config["pad_token_id"]]]))
+        state_dict = compact_gene_embeddings(state_dict, compact_gene_ids)
+        config["compact_gene_ids"] = compact_gene_ids.tolist()
+
+    stored_dtypes = {}
+    tensors = {}
+    for k, v in state_dict.items():
+        v = v.detach().cpu()
+        if dtype is not None and v.is_floating_point() and v.dtype != dtype:
+            stored_dtypes[k] = str(v.dtype).replace("torch.", "")
+            v = v.to(dtype)
+        tensors[k] = v.contiguous()
+
+    checkpoint = {
+        "format": CHECKPOINT_FORMAT,
+        "version": CHECKPOINT_VERSION,
+        "config": config,
+        "attention_layout": get_attention_layout(tensors),
+        "dtype": None if dtype is None else str(dtype).replace("torch.", ""),
+        "stored_dtypes": stored_dtypes,
+        "state_dict": tensors,
+    }
+    torch.save(checkpoint, checkpoint_location)
+
+
+def is_scgenept_checkpoint(checkpoint):
+    """
+    Returns True if a loaded checkpoint is in the self-describing scGenePT checkpoint format
+    """
+    return isinstance(checkpoint, dict) and checkpoint.get("format") == CHECKPOINT_FORMAT
+
+
+def _load_checkpoint(checkpoint_location, map_location, mmap):
+    """
+    Loads a checkpoint file as it was saved
+    """
+    try:
+        return torch.load(str(checkpoint_location), map_location=map_location, weights_only=True, mmap=mmap)
+    except RuntimeError:
+        if not mmap:
+            raise
+        # legacy torch checkpoints can't be memory-mapped
+        return torch.load(checkpoint_location, map_location=map_location, weights_only=True)
+
+
+def _convert_checkpoint_attention_layout(checkpoint, attention_layout):
+    """
+    Converts the attention weights of a checkpoint, as it was saved, to attention_layout
+    """
+    if not is_scgenept_checkpoint(checkpoint):
+        return convert_attention_layout(checkpoint, attention_layout)
+    source_key = ATTENTION_LAYOUT2KEY[get_attention_layout(checkpoint["state_dict"])]
+    target_key = ATTENTION_LAYOUT2KEY[attention_layout]
+    return {**checkpoint, "attention_layout": attention_layout, 
+            "state_dict": convert_attention_layout(checkpoint["state_dict"], attention_layout),
+            "stored_dtypes": {k.replace(source_key, target_key): v for k, v in checkpoint["stored_dtypes"].items()}}
+
+
+def _save_converted_checkpoint(checkpoint, converted_location):
+    """
+    Saves a converted checkpoint to the cache; failing to write the cache, eg in a read-only directory, is not an error
+    """
+    tmp_location = f"{converted_location}.{os.getpid()}.tmp"
+    try:
+        torch.save(checkpoint, tmp_location)
+        # concurrent loads might convert the same checkpoint; the rename makes sure they never read a partial file
+        os.replace(tmp_location, converted_location)
+    except OSError as e:
+        print(f"Could not cache the converted checkpoint under {converted_location}: {e}")
+        if os.path.exists(tmp_location):
+            os.remove(tmp_location)
+
+
+def load_scgenept_checkpoint(checkpoint_location, map_location = "cpu", mmap = True, attention_layout = None, 
+                             cache_converted = True):
+    """
+    Loads a checkpoint saved either with save_scgenept_checkpoint or as a plain state dict. The weights are memory-mapped
+    instead of being read into memory, so loading is zero-copy and models loaded from the same file share pages.
+    Weights stored in a lower precision are cast back to their original dtype, which copies them.
+    
+    If attention_layout is set, the attention weights are converted to it, eg 'pytorch' to run checkpoints trained with
+    flash-attn on the PyTorch transformer encoder. The conversion is cached next to the checkpoint, keyed by the content
+    hash of the checkpoint, so later loads read the converted checkpoint directly; the hash is memoised next to the
+    checkpoint too (see get_memoised_checkpoint_hash), so later loads don't read the whole checkpoint to compute it.
+
+    Args:
+        checkpoint_location: location of the checkpoint
+        map_location: device the weights are loaded on
+        mmap: if True, memory-maps the weights; checkpoints saved in the legacy (non-zip) torch format are always read
+        attention_layout: if not None, layout the attention weights are converted to, one of 'flash', 'pytorch'
+        cache_converted: if True, caches conversions to attention_layout next to the checkpoint
+
+    Returns:
+        state_dict: model state dict
+        checkpoint_info: dict with the format, version, config, attention_layout and dtype of the checkpoint;
+            None for plain state dicts
+    """
+    checkpoint = _load_checkpoint(checkpoint_location, map_location, mmap)
+    state_dict = checkpoint["state_dict"] if is_scgenept_checkpoint(checkpoint) else checkpoint
+    
+    if attention_layout is not None and get_attention_layout(state_dict) != attention_layout:
+        if cache_converted:
+            converted_location = get_converted_checkpoint_location(checkpoint_location, attention_layout, 
+                                                                   get_memoised_checkpoint_hash(checkpoint_location))
+            if os.path.exists(converted_location):
+                return load_scgenept_checkpoint(converted_location, map_location, mmap)
+            checkpoint = _convert_checkpoint_attention_layout(checkpoint, attention_layout)
+            _save_converted_checkpoint(checkpoint, converted_location)
+        else:
+            checkpoint = _convert_checkpoint_attention_layout(checkpoint, attention_layout)
+
+    if not is_scgenept_checkpoint(checkpoint):
+        return checkpoint, None
+
+    if checkpoint["version"] > CHECKPOINT_VERSION:
+        raise ValueError(f"Checkpoint version {checkpoint['version']} of {checkpoint_location} is not supported; "
+                         f"latest supported version is {CHECKPOINT_VERSION}")
+    checkpoint = dict(checkpoint)
+    state_dict = dict(checkpoint.pop("state_dict"))
+    for k, stored_dtype in checkpoint["stored_dtypes"].items():
+        state_dict[k] = state_dict[k].to(getattr(torch, stored_dtype))
+    return state_dict, checkpoint
+
+
+def get_args():
+    """
+    Parses command line arguments
+    
+    Returns:
+        list of args
+    """
+    parser = argparse.ArgumentParser(description='Converts trained scGenePT checkpoints')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    
+    format_parser = subparsers.add_parser('format', help='converts a trained model saved as a state dict to the self-describing scGenePT checkpoint format')
+    format_parser.add_argument('model_location', type=str, help='location of the trained model state dict')
+    format_parser.add_argument('config_location', type=str, help='location of the model config saved by train.py, eg best_model.config.json')
+    format_parser.add_argument('checkpoint_location', type=str, help='location of the checkpoint to create')
+    format_parser.add_argument('--dtype', type=str, choices=['float32', 'float16'], default=None, help='dtype the weights are stored in')
+    format_parser.add_argument('--compact-gene-embs', action='store_true', help='only keep the rows of the dataset genes in the genePT/GO embedding tables, dropping the other vocab rows')
+    
+    layout_parser = subparsers.add_parser('attention-layout', help='converts the attention weights of a checkpoint to the flash-attn or the PyTorch layout')
+    layout_parser.add_argument('checkpoint_location', type=str, help='location of the checkpoint')
+    layout_parser.add_argument('--layout', type=str, choices=list(ATTENTION_LAYOUT2KEY), default='pytorch', help='layout to convert to')
+    layout_parser.add_argument('--output', type=str, default=None, help='location of the converted checkpoint; by default, the conversion is cached next to the checkpoint, where the model loaders pick it up')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.command == 'format':
+        state_dict, _ = load_scgenept_checkpoint(args.model_location)
+        with open(args.config_location) as f:
+            config = json.load(f)
+        dtype = None if args.dtype is None else getattr(torch, args.dtype)
+        save_scgenept_checkpoint(args.checkpoint_location, state_dict, config, dtype, args.compact_gene_embs)
+        print(f"Converted {args.model_location} to {args.checkpoint_location}")
+    elif args.output is not None:
+        checkpoint = _load_checkpoint(args.checkpoint_location, "cpu", True)
+        torch.save(_convert_checkpoint_attention_layout(checkpoint, args.layout), args.output)
+        print(f"Converted {args.checkpoint_location} to the {args.layout} attention layout under {args.output}")
+    else:
+        load_scgenept_checkpoint(args.checkpoint_location, attention_layout=args.layout)
+        print(f"Cached the {args.layout} attention layout of {args.checkpoint_location}")
@@ -0,0 +1,94 @@
+import numpy as np
+import torch
+
+# Methods to rank the genes of a dataset by how informative they are as context genes
+CONTEXT_GENE_METHODS = ["hvg", "correlation"]
+
+
+def rank_context_genes(adata, method = "hvg", max_cells = 20000, seed = 0, conditions = None):
+    """
+    Ranks the genes of a dataset by how informative they are as context for the perturbation prediction, so that the
+    top ranked genes can fill the context of a ContextBudget. The genes should be ranked on the cells of the train
+    split only, eg with conditions=pert_data.set2conditions['train'] (which includes the control cells), so that the
+    context isn't chosen with the responses to the perturbations it is evaluated on.
+
+    Args:
+        adata: AnnData of the dataset, eg pert_data.adata; its expression values are expected to be log-normalized
+        method: 'hvg' ranks the genes by their variance across cells (highly variable genes), 'correlation' ranks the
+            genes by their mean absolute correlation with the other genes (most correlated genes)
+        max_cells: max number of cells the ranking is computed on; larger datasets are subsampled
+        seed: seed used to subsample the cells
+        conditions: if not None, only the cells of these conditions (adata.obs.condition) are used; all cells are used
+            otherwise
+
+    Returns:
+        ranked_genes: indices of the genes in adata.var, from the most to the least informative
+    """
+    if method not in CONTEXT_GENE_METHODS:
+        raise ValueError(f"Unknown context gene method {method}; expected one of {CONTEXT_GENE_METHODS}")
+    cell_idx = np.arange(adata.n_obs)
+    if conditions is not None:
+        cell_idx = np.where(adata.obs['condition'].isin(list(conditions)))[0]
+        if len(cell_idx) == 0:
+            raise ValueError("No cells of the given conditions to rank the context genes on")
+    if len(cell_idx) > max_cells:
+        cell_idx = np.sort(np.random.default_rng(seed).choice(cell_idx, max_cells, replace=False))
+    X = adata.X[cell_idx]
+    X = np.asarray(X.toarray() if hasattr(X, "toarray") else X, dtype=np.float32)
+
+    X = X - X.mean(0)
+    std = X.std(0)
+    if method == "hvg":
+        scores = std
+    else:
+        Z = X / np.where(std > 0, std, 1)
+        corr = np.abs(Z.T @ Z) / len(Z)
+        np.fill_diagonal(corr, 0)
+        scores = corr.mean(1)
+    return np.argsort(-scores, kind="stable")
+
+
+class ContextBudget:
+    """
+    Limits the genes input to the transformer at inference to a budget of context genes, instead of all the dataset genes.
+    The context of a batch holds the perturbed genes of the batch, the readout genes and the top ranked informative genes
+    up to the budget. The perturbed and readout genes are always in the context, even if they exceed the budget.
+    Genes outside of the context are not predicted by the model and keep their control value.
+    """
+    def __init__(self, ranked_genes, budget, readout_gene_ids = None):
+        """
+        Args:
+            ranked_genes: gene indices in the sequence ranked from the most to the least informative, see rank_context_genes
+            budget: number of genes in the context
+            readout_gene_ids: indices of the genes in the sequence that are always in the context, eg genes to read out
+        """
+        self.ranked_genes = torch.as_tensor(np.asarray(ranked_genes)).long()
+        self.budget = budget
+        self.readout_gene_ids = None
+        if readout_gene_ids is not None:
+            self.readout_gene_ids = torch.as_tensor(np.asarray(readout_gene_ids)).long()
+
+    def get_context_gene_ids(self, pert_flags):
+        """
+        Returns the context of a batch, shared by all its cells
+
+        Args:
+            pert_flags: perturbation flags of the batch, shape [batch_size, n_genes]
+
+        Returns:
+            input_gene_ids: sorted indices of the context genes in the sequence
+        """
+        device = pert_flags.device
+        if self.ranked_genes.device != device:
+            self.ranked_genes = self.ranked_genes.to(device)
+            if self.readout_gene_ids is not None:
+                self.readout_gene_ids = self.readout_gene_ids.to(device)
+
+        required_gene_ids = (pert_flags == 1).any(0).nonzero()[:, 0]
+        if self.readout_gene_ids is not None:
+            required_gene_ids = torch.cat([required_gene_ids, self.readout_gene_ids]).unique()
+        n_fill = self.budget - len(required_gene_ids)
+        if n_fill > 0:
+            fill_gene_ids = self.ranked_genes[~torch.isin(self.ranked_genes, required_gene_ids)][:n_fill]
+            required_gene_ids = torch.cat([required_gene_ids, fill_gene_ids])
+        return required_gene_ids.sort()[0]
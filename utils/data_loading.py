@@ -1,3 +1,6 @@
+import json
+import os
+from collections.abc import Mapping
 from pathlib import Path
 from scgpt.tokenizer.gene_tokenizer import GeneVocab
 import numpy as np
@@ -5,6 +8,8 @@ import pickle as pkl
 from scgpt.utils import load_pretrained
 import torch
 from utils.scgpt_config import *
+from utils.embedding_store import get_store_location, is_store, load_gene_embeddings_from_store
+from utils.checkpoint import load_scgenept_checkpoint
 from models.scGenePT import *
 
 # Dimension of GPT-3.5 ada embeddings
@@ -34,6 +39,9 @@ def get_embs_to_include(model_type):
     """
     # GenePT Gene embeddings - either NCBI gene summaries or NCBI gene + UniProt protein summaries computed with GPT-3.5
     print(f"scGenePT model-type: {model_type}")
+    # The _no_attention variant of a model type includes the same embeddings as the model type
+    if model_type.endswith('_no_attention'):
+        model_type = model_type[:-len('_no_attention')]
     if model_type in ['genept_ncbi_gpt', 
                       'genept_ncbi+uniprot_gpt', 
                       'genept_ncbi+uniprot_gpt_no_attention', 
@@ -104,6 +112,30 @@ def get_embs_to_include(model_type):
     return embs_to_include
 
 
+def get_gene_embeddings_locations(model_type, pretrained_model_dir):
+    """
+    Returns the locations of the pickled GenePT/GO gene embeddings a model type is trained with, following
+    initialize_genept_embeddings and initialize_go_embeddings
+
+    Args:
+        model_type: name of model, see get_embs_to_include
+        pretrained_model_dir: directory the gene embeddings are in
+
+    Returns:
+        list of locations of gene embeddings
+    """
+    embs_to_include = get_embs_to_include(model_type)
+    emb_model_types = []
+    if 'genePT_token_embs_gpt' in embs_to_include:
+        emb_model_types.append(model_type.split('_')[1] + '_gpt')
+    go_emb_type = model_type.split('go_')[1].split('_')[0] if 'go_' in model_type else None
+    if 'GO_token_embs_gpt_avg' in embs_to_include:
+        emb_model_types.append(f'go_{go_emb_type}_gpt_avg')
+    elif 'GO_token_embs_gpt_concat' in embs_to_include:
+        emb_model_types.append(f'go_{go_emb_type}_gpt_concat')
+    return [pretrained_model_dir + GENE_EMBED_TYPE2LOCATION[emb_model_type] for emb_model_type in emb_model_types]
+
+
 def match_genes_to_scgpt_vocab(vocab_file, pert_data, logger, special_tokens):
     """
     Parses a pre-trained scGPT model vocab and matches genes in a given pert_data corresponding to dataloaders from
@@ -206,42 +238,70 @@ def match_genes_to_scgpt_vocab_from_adata(vocab_file, pert_adata, special_tokens
         gene2idx[g] = i
     return vocab, dataset_gene_ids, dataset_genes, gene2idx
 
-def create_embs_w(genes, vocab, precomputed_embs_location, embed_dim, init_value = 0.1):
+def get_compact_gene_ids(gene_ids, vocab):
+    """
+    Returns the vocab indices to keep in compact genePT/GO embedding tables: the dataset genes and the pad token.
+    
+    Args:
+        gene_ids: vocab indices of genes in dataset
+        vocab: scGPT vocab
+        
+    Returns:
+        compact_gene_ids: sorted, unique vocab indices
+    """
+    return np.unique(np.concatenate([np.asarray(gene_ids, dtype=int), [vocab[PAD_TOKEN]]]))
+
+
+def create_embs_w(genes, vocab, precomputed_embs_location, embed_dim, init_value = 0.1, compact_gene_ids = None, dtype = np.float64):
     """
     Creates an embedding matrix for a given list of genes, where each gene gets an embedding either from precomputed
-    embeddings located at embedding_location, or by randomly initializing a vector with init_value.
+    embeddings located at embedding_location, or by randomly initializing a vector with init_value. If the precomputed 
+    embeddings have been converted to a gene embedding store (see utils/embedding_store.py), only the rows of the 
+    requested genes are read from it.
     
     Args:
         genes: genes to compute the embedding matrix for
         vocab: vocab mapping gene2index; needed to map correctly to the scGPT model architecture
         precomputed_embeddings_location: location of precomputed embeddings
         embed_dim: dimension of the precomputed embeddings, and consequently created embedding matrix 
+        compact_gene_ids: if not None, the matrix only has rows for these vocab indices (see get_compact_gene_ids) 
+            instead of one row per vocab gene
+        dtype: dtype of the embedding matrix
         
     Returns:
         embeds_m: embedding matrix created for the list of genes
         mapped_genes: list of mapped genes
     """
-    with open(precomputed_embs_location, "rb") as fp:
-        gene_embeddings = pkl.load(fp)
-            
-    embeds_m = np.random.uniform(-init_value, init_value, (len(vocab), embed_dim))
-    mapped_genes = []
-    mapped_genes_embeds_m = []
-    count_missing = 0
-    for i, gene in enumerate(genes):
-        if gene in gene_embeddings:
-            embed = gene_embeddings[gene]
-            mapped_genes_embeds_m.append(embed)
-            mapped_genes.append(gene)
-        else:
-            count_missing+=1
+    n_rows = len(vocab) if compact_gene_ids is None else len(compact_gene_ids)
+    embeds_m = np.random.uniform(-init_value, init_value, (n_rows, embed_dim)).astype(dtype)
+    
+    # Read only the rows of the requested genes if the embeddings have been converted to a gene embedding store
+    store_location = get_store_location(precomputed_embs_location)
+    if is_store(store_location):
+        mapped_genes_embeds_m, mapped_genes = load_gene_embeddings_from_store(store_location, genes)
+        count_missing = len(genes) - len(mapped_genes)
+    else:
+        with open(precomputed_embs_location, "rb") as fp:
+            gene_embeddings = pkl.load(fp)
+        mapped_genes = []
+        mapped_genes_embeds_m = []
+        count_missing = 0
+        for i, gene in enumerate(genes):
+            if gene in gene_embeddings:
+                embed = gene_embeddings[gene]
+                mapped_genes_embeds_m.append(embed)
+                mapped_genes.append(gene)
+            else:
+                count_missing+=1
             
     print(f"Matched {len(genes) - count_missing} out of {len(genes)} genes in the GenePT-w embedding")
     gene_indices = vocab.lookup_indices(mapped_genes)
+    if compact_gene_ids is not None:
+        gene_indices = np.searchsorted(compact_gene_ids, gene_indices)
     embeds_m[gene_indices] = mapped_genes_embeds_m
     return embeds_m, mapped_genes
 
-def initialize_genept_embeddings(embs_to_include, genes, vocab, model_type, pretrained_model_dir):
+def initialize_genept_embeddings(embs_to_include, genes, vocab, model_type, pretrained_model_dir, compact_gene_ids = None, dtype = np.float64):
     """
     Initializes genept embeddings for a given set of genes, given that genePT embs should be included in the 
     list of gene representations.
@@ -251,6 +311,8 @@ def initialize_genept_embeddings(embs_to_include, genes, vocab, model_type, pret
         genes: set of genes to map to genePT embeddings
         vocab: scGPT vocabulary
         model_type: model-type; determines the embeddings that get initialized
+        compact_gene_ids: if not None, only the rows of these vocab indices are created (see get_compact_gene_ids)
+        dtype: dtype of the created embeddings
         
     Returns:
         embeds: created embeddings
@@ -271,7 +333,7 @@ def initialize_genept_embeddings(embs_to_include, genes, vocab, model_type, pret
                 
         embed_dim = GPT_ADA_002_EMBED_DIM
         embeddings_location = pretrained_model_dir + GENE_EMBED_TYPE2LOCATION[emb_model_type]
-        embeds, mapped_genes = create_embs_w(genes, vocab, embeddings_location, embed_dim)       
+        embeds, mapped_genes = create_embs_w(genes, vocab, embeddings_location, embed_dim, compact_gene_ids = compact_gene_ids, dtype = dtype)       
     else:
         embeds = []
         emb_info_type = None
@@ -280,7 +342,7 @@ def initialize_genept_embeddings(embs_to_include, genes, vocab, model_type, pret
     return embeds, emb_info_type, embed_dim, mapped_genes
 
 
-def initialize_go_embeddings(embs_to_include, genes, vocab, model_type, pretrained_model_dir):
+def initialize_go_embeddings(embs_to_include, genes, vocab, model_type, pretrained_model_dir, compact_gene_ids = None, dtype = np.float64):
     """
     Initializes GO (Gene Ontology) Annotations embeddings for a given set of genes, given that GO embs should be included in the list of gene representations.
     
@@ -289,6 +351,8 @@ def initialize_go_embeddings(embs_to_include, genes, vocab, model_type, pretrain
         genes: set of genes to map to genePT embeddings
         vocab: scGPT vocabulary
         model_type: model-type; determines the embeddings that get initialized
+        compact_gene_ids: if not None, only the rows of these vocab indices are created (see get_compact_gene_ids)
+        dtype: dtype of the created embeddings
     
     Returns:
         embeds: created embeddings
@@ -310,7 +374,7 @@ def initialize_go_embeddings(embs_to_include, genes, vocab, model_type, pretrain
         
         embed_dim = GPT_ADA_002_EMBED_DIM
         embeddings_location = pretrained_model_dir + GENE_EMBED_TYPE2LOCATION[emb_model_type]
-        embeds, mapped_genes = create_embs_w(genes, vocab, embeddings_location, embed_dim)
+        embeds, mapped_genes = create_embs_w(genes, vocab, embeddings_location, embed_dim, compact_gene_ids = compact_gene_ids, dtype = dtype)
         go_embs_to_include[go_emb_type] = embeds
             
     else:
@@ -329,22 +393,47 @@ def load_pretrained_model(model, load_param_prefixs, verbose, model_file, device
         model: model instance to load
         load_param_prefixs: list of parameter prefixes to load
         verbose: True if verbose
-        model_file: location of trained model
+        model_file: location of trained model, or its state dict if it has already been loaded
         device: device to load the model on
         
     Returns:
         model with load_param_prefixs initialized
     """
-    model = load_pretrained(model, torch.load(model_file, map_location=device), verbose=verbose, prefix=load_param_prefixs)
+    pretrained_params = model_file if isinstance(model_file, Mapping) else torch.load(model_file, map_location=device)
+    model = load_pretrained(model, pretrained_params, verbose=verbose, prefix=load_param_prefixs)
     return model
 
-def load_trained_scgenept_model(adata, model_type, models_dir, model_location, device, verbose = False):
+def load_trained_scgenept_model(adata, model_type, models_dir, model_location, device, verbose = False, fuse_gene_embs = False, 
+                                compact_gene_embs = False, gene_embs_dtype = np.float64):
+    """
+    Loads a trained scGenePT model for inference.
+    
+    Args:
+        adata: AnnData file containing the data the model will be used on; its genes are matched to the scGPT vocab
+        model_type: model-type; determines the embeddings that get initialized
+        models_dir: directory the pretrained scGPT model and gene embeddings are in
+        model_location: location of the trained model weights
+        device: device to load the model on
+        verbose: True if verbose
+        fuse_gene_embs: if True, precomputes the gene identity embeddings for the dataset genes into a single lookup table
+            (see scGenePT.freeze_gene_embeddings), which speeds up inference
+        compact_gene_embs: if True, the genePT/GO embedding tables only hold the dataset genes; works with checkpoints 
+            saved in either the full-vocab or the compact layout
+        gene_embs_dtype: dtype of the genePT/GO embedding tables
+        
+    Returns:
+        model: loaded model, in eval mode
+        gene_ids: vocab indices of genes in the dataset
+    """
     embs_to_include = get_embs_to_include(model_type)
     vocab_file = models_dir + 'pretrained/scgpt/vocab.json'
     vocab, gene_ids, dataset_genes, gene2idx = match_genes_to_scgpt_vocab_from_adata(vocab_file, adata, SPECIAL_TOKENS)
     ntokens = len(vocab)  # size of vocabulary
-    genept_embs, genept_emb_type, genept_emb_dim, found_genes_genept = initialize_genept_embeddings(embs_to_include, dataset_genes, vocab, model_type, models_dir)
-    go_embs_to_include, go_emb_type, go_emb_dim, found_genes_go = initialize_go_embeddings(embs_to_include, dataset_genes, vocab, model_type, models_dir)
+    compact_gene_ids = get_compact_gene_ids(gene_ids, vocab) if compact_gene_embs else None
+    genept_embs, genept_emb_type, genept_emb_dim, found_genes_genept = initialize_genept_embeddings(embs_to_include, dataset_genes, vocab, model_type, models_dir, 
+                                                                                                    compact_gene_ids, gene_embs_dtype)
+    go_embs_to_include, go_emb_type, go_emb_dim, found_genes_go = initialize_go_embeddings(embs_to_include, dataset_genes, vocab, model_type, models_dir, 
+                                                                                           compact_gene_ids, gene_embs_dtype)
 
     # we disable flash attention for inference for simplicity
     use_fast_transformer = False
@@ -370,22 +459,207 @@ def load_trained_scgenept_model(adata, model_type, models_dir, model_location, d
         genept_emb_size = genept_emb_dim,
         go_embs_to_include = go_embs_to_include,
         go_emb_type = go_emb_type,
-        go_emb_size = go_emb_dim
+        go_emb_size = go_emb_dim,
+        compact_gene_ids = compact_gene_ids
     )
 
-    pretrained_params = torch.load(model_location, weights_only=True, map_location = device)
-    if not use_fast_transformer:
-        pretrained_params = {
-            k.replace("Wqkv.", "in_proj_"): v for k, v in pretrained_params.items()
-        }
+    attention_layout = 'flash' if use_fast_transformer else 'pytorch'
+    pretrained_params, checkpoint_info = load_scgenept_checkpoint(model_location, map_location = device, attention_layout = attention_layout)
 
     model.load_state_dict(pretrained_params)
 
     if verbose:
         print(model)
     model.to(device)
+    model.eval()
+    if fuse_gene_embs:
+        model.freeze_gene_embeddings(gene_ids)
     return model, gene_ids
 
 
 
     
+
+def get_config_location(model_location):
+    """
+    Returns the location of the config saved next to a trained model, eg best_model.pt -> best_model.config.json
+    """
+    return str(Path(model_location).with_suffix('.config.json'))
+
+
+def get_scgenept_config(model_type, ntokens, pad_token_id, gene_ids, dataset_genes, genept_emb_dim = None, 
+                        go_emb_type = None, go_emb_dim = None, compact_gene_ids = None):
+    """
+    Creates the config needed to rebuild a trained scGenePT model without the scGPT vocab or the pre-computed gene embeddings.
+    
+    Args:
+        model_type: model-type; determines the embeddings that get included
+        ntokens: size of the scGPT vocabulary
+        pad_token_id: vocab index of the pad token
+        gene_ids: vocab indices of genes in dataset
+        dataset_genes: gene names present in dataset
+        genept_emb_dim: dimension of the genePT embeddings, if used
+        go_emb_type: type of GO embeddings, if used; one of 'c', 'f', 'p', 'all'
+        go_emb_dim: dimension of the GO embeddings, if used
+        compact_gene_ids: vocab indices kept in compact genePT/GO embedding tables, if used
+        
+    Returns:
+        config: json-serializable dict
+    """
+    return {
+        "model_type": model_type,
+        "embs_to_include": get_embs_to_include(model_type),
+        "ntokens": int(ntokens),
+        "pad_token_id": int(pad_token_id),
+        "d_model": EMBSIZE,
+        "nhead": NHEAD,
+        "d_hid": D_HID,
+        "nlayers": NLAYERS,
+        "nlayers_cls": N_LAYERS_CLS,
+        "n_cls": N_CLS,
+        "genept_emb_size": genept_emb_dim,
+        "go_emb_type": go_emb_type,
+        "go_emb_size": go_emb_dim,
+        "compact_gene_ids": None if compact_gene_ids is None else np.asarray(compact_gene_ids).tolist(),
+        "gene_ids": np.asarray(gene_ids).tolist(),
+        "genes": list(dataset_genes),
+    }
+
+
+def save_scgenept_config(config_location, config):
+    """
+    Saves a config created with get_scgenept_config
+    """
+    with open(config_location, "w") as f:
+        json.dump(config, f)
+
+
+def infer_scgenept_config(adata, model_type, models_dir, pretrained_params):
+    """
+    Infers the config of a trained model that was saved without one. Only the scGPT vocab is parsed; the embedding 
+    sizes are read from the shapes of the trained weights, so the pre-computed gene embeddings are not loaded.
+    
+    Args:
+        adata: AnnData file containing the data the model will be used on; its genes are matched to the scGPT vocab
+        model_type: model-type; determines the embeddings that get included
+        models_dir: directory the pretrained scGPT model is in
+        pretrained_params: state dict of the trained model
+        
+    Returns:
+        config: dict, as created by get_scgenept_config
+    """
+    embs_to_include = get_embs_to_include(model_type)
+    vocab_file = models_dir + 'pretrained/scgpt/vocab.json'
+    vocab, gene_ids, dataset_genes, gene2idx = match_genes_to_scgpt_vocab_from_adata(vocab_file, adata, SPECIAL_TOKENS)
+    
+    genept_emb_dim = None
+    compact_gene_ids = None
+    if 'genePT_token_embs_gpt' in embs_to_include:
+        genept_emb_dim = pretrained_params['genept_encoder.embedding.weight'].shape[1]
+        compact_gene_ids = pretrained_params.get('genept_encoder.embedding.compact_gene_ids', None)
+    go_emb_type = None
+    go_emb_dim = None
+    if 'GO_token_embs_gpt_concat' in embs_to_include or 'GO_token_embs_gpt_avg' in embs_to_include:
+        go_emb_type = model_type.split('go_')[1].split('_')[0]
+        go_encoder = 'gopt_encoder_f' if go_emb_type == 'all' else f'gopt_encoder_{go_emb_type}'
+        go_emb_dim = pretrained_params[f'{go_encoder}.embedding.weight'].shape[1]
+        compact_gene_ids = pretrained_params.get(f'{go_encoder}.embedding.compact_gene_ids', compact_gene_ids)
+    if compact_gene_ids is not None:
+        compact_gene_ids = compact_gene_ids.cpu().numpy()
+    return get_scgenept_config(model_type, len(vocab), vocab[PAD_TOKEN], gene_ids, dataset_genes, 
+                               genept_emb_dim, go_emb_type, go_emb_dim, compact_gene_ids)
+
+
+def build_scgenept_from_config(config, use_fast_transformer = False, dropout = 0.0):
+    """
+    Builds an scGenePT model from a config on the meta device, ie without allocating or initializing any weights. 
+    The weights have to be materialized with model.load_state_dict(pretrained_params, assign=True).
+    
+    Args:
+        config: dict, as created by get_scgenept_config
+        use_fast_transformer: whether to use flash attention
+        dropout: dropout value
+        
+    Returns:
+        model: scGenePT model with parameters on the meta device
+    """
+    go_emb_type = config["go_emb_type"]
+    with torch.device("meta"):
+        model = scGenePT(
+            ntoken=config["ntokens"],
+            d_model=config["d_model"],
+            nhead=config["nhead"],
+            d_hid=config["d_hid"],
+            nlayers=config["nlayers"],
+            nlayers_cls=config["nlayers_cls"],
+            n_cls=config["n_cls"],
+            vocab={PAD_TOKEN: config["pad_token_id"]},
+            n_perturbagens=2,
+            dropout=dropout,
+            pad_token=PAD_TOKEN,
+            pad_value=PAD_VALUE,
+            pert_pad_id=PERT_PAD_ID,
+            use_fast_transformer=use_fast_transformer,
+            embs_to_include = config["embs_to_include"],
+            genept_embs = None,
+            genept_emb_size = config["genept_emb_size"],
+            go_embs_to_include = {go_emb_type: None} if go_emb_type is not None else {},
+            go_emb_type = go_emb_type,
+            go_emb_size = config["go_emb_size"],
+            compact_gene_ids = config["compact_gene_ids"]
+        )
+    return model
+
+
+def load_trained_scgenept_model_from_config(model_location, device, adata = None, model_type = None, models_dir = 'models/', 
+                                            verbose = False, fuse_gene_embs = False):
+    """
+    Loads a trained scGenePT model for inference without parsing or allocating the pre-computed gene embeddings. 
+    The model is built on the meta device from the config stored in the checkpoint (see utils.checkpoint) or saved next 
+    to it (see get_config_location) and its weights are materialized directly from the memory-mapped checkpoint, 
+    so loading is bounded by reading the weights. For plain state dicts saved without a config, the config is 
+    inferred from adata, model_type and the checkpoint.
+    
+    Args:
+        model_location: location of the trained model weights
+        device: device to load the model on
+        adata: AnnData file containing the data the model will be used on; only needed if there is no saved config
+        model_type: model-type; only needed if there is no saved config
+        models_dir: directory the pretrained scGPT model is in; only needed if there is no saved config
+        verbose: True if verbose
+        fuse_gene_embs: if True, precomputes the gene identity embeddings for the dataset genes into a single lookup table
+        
+    Returns:
+        model: loaded model, in eval mode
+        gene_ids: vocab indices of genes in dataset
+    """
+    # we disable flash attention for inference for simplicity
+    use_fast_transformer = False
+    
+    # the weights are memory-mapped and assigned to the model as they are, so CPU models share their weights with the page cache;
+    # checkpoints trained with flash-attn are converted to the PyTorch attention layout once and cached (see utils.checkpoint)
+    attention_layout = 'flash' if use_fast_transformer else 'pytorch'
+    pretrained_params, checkpoint_info = load_scgenept_checkpoint(model_location, attention_layout = attention_layout)
+    
+    config_location = get_config_location(model_location)
+    if checkpoint_info is not None:
+        config = checkpoint_info["config"]
+    elif os.path.exists(config_location):
+        with open(config_location) as f:
+            config = json.load(f)
+    else:
+        if adata is None or model_type is None:
+            raise ValueError(f"No config found at {config_location}; adata and model_type are needed to infer it")
+        config = infer_scgenept_config(adata, model_type, models_dir, pretrained_params)
+        
+    model = build_scgenept_from_config(config, use_fast_transformer)
+    model.load_state_dict(pretrained_params, assign=True)
+    
+    if verbose:
+        print(model)
+    model.to(device)
+    model.eval()
+    gene_ids = np.array(config["gene_ids"], dtype=int)
+    if fuse_gene_embs:
+        model.freeze_gene_embeddings(gene_ids)
+    return model, gene_ids
@@ -0,0 +1,305 @@
+import json
+import math
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# Version of the on-disk layout of dense datasets
+DENSE_DATASET_VERSION = 1
+
+# Per-cell arrays of a dense dataset that hold one value per gene
+GENE_ARRAYS = ["ctrl", "pert_flags", "y"]
+GENE_ARRAY2DTYPE = {"ctrl": np.float32, "pert_flags": np.int8, "y": np.float32}
+
+
+def get_dense_dataset_location(data_dir, dataset_name, split, seed, loader_type):
+    """
+    Returns the location of the dense dataset of a dataloader, keyed by dataset, split and split seed,
+    eg data/norman/dense_datasets/simulation_seed_1/train
+    """
+    return str(Path(data_dir) / dataset_name / "dense_datasets" / f"{split}_seed_{seed}" / loader_type)
+
+
+def get_dense_dataset_locations(data_dir, dataset_name, split, seed):
+    """
+    Returns a dict mapping the types of the dataloaders of a split to the locations of their dense datasets
+    """
+    loader_types = ["train", "val"] if split == "no_test" else ["train", "val", "test"]
+    return {loader_type: get_dense_dataset_location(data_dir, dataset_name, split, seed, loader_type) for loader_type in loader_types}
+
+
+def is_dense_dataset(dense_dataset_location, source_inputs = None):
+    """
+    Returns True if dense_dataset_location is a complete dense dataset and, if source_inputs is not None, if it was
+    materialized from source_inputs with the current version of the layout.
+    """
+    meta_location = os.path.join(dense_dataset_location, "meta.json")
+    if not os.path.isfile(meta_location):
+        return False
+    if source_inputs is None:
+        return True
+    with open(meta_location) as f:
+        meta = json.load(f)
+    return meta["version"] == DENSE_DATASET_VERSION and meta.get("source_inputs") == source_inputs
+
+
+def _get_gene_array_row(cell, name):
+    """
+    Returns the values of one of GENE_ARRAYS for a GEARS cell graph
+    """
+    if name == "ctrl":
+        return cell.x[:, 0].numpy()
+    elif name == "pert_flags":
+        return cell.x[:, 1].numpy()
+    return cell.y.numpy().reshape(-1)
+
+
+def materialize_dense_dataset(cells, dense_dataset_location, layout = "csr", source_inputs = None):
+    """
+    Materializes the GEARS cell graphs of a dataloader into a dense dataset: a directory holding, for all cells,
+        - ctrl: control expression, [n_cells, n_genes]
+        - pert_flags: perturbation flags, [n_cells, n_genes]
+        - y: post-perturbation expression, [n_cells, n_genes]
+        - de_idx.npy: indices of the differentially expressed genes, [n_cells, n_de_genes]
+        - perts.npy: perturbation names, [n_cells]
+        - meta.json: metadata header with the number of cells and genes, the layout and the source inputs
+    The per-gene arrays are stored either as dense [n_cells, n_genes] matrices (layout 'dense') or as CSR matrices
+    (layout 'csr'; <name>.data.npy, <name>.indices.npy, <name>.indptr.npy), and are read through memory maps.
+    The cells are stored in the order of the dataloader.
+
+    Args:
+        cells: list of GEARS cell graphs, eg pert_data.dataloader['train_loader'].dataset
+        dense_dataset_location: location of the dense dataset to create
+        layout: one of 'csr', 'dense'; csr is smaller for sparse expression data
+        source_inputs: json-serializable inputs the cells were created from, eg the dataset files and GEARS version 
+            (see utils.pert_data_cache.get_pert_data_cache_inputs); checked by is_dense_dataset
+
+    Returns:
+        dense_dataset_location: location of the created dense dataset
+    """
+    if layout not in ["csr", "dense"]:
+        raise ValueError(f"Unknown dense dataset layout: {layout}; expected one of ['csr', 'dense']")
+    n_cells = len(cells)
+    n_genes = cells[0].x.shape[0]
+    de_idx = [np.asarray(cell.de_idx).reshape(-1) for cell in cells]
+    if len(set(len(idx) for idx in de_idx)) > 1:
+        raise ValueError("All cells need the same number of differentially expressed genes")
+
+    dense_dataset_location = Path(dense_dataset_location)
+    if dense_dataset_location.exists():
+        # a stale dense dataset is replaced, including the arrays of another layout
+        shutil.rmtree(dense_dataset_location)
+    dense_dataset_location.mkdir(parents=True)
+    np.save(dense_dataset_location / "de_idx.npy", np.stack(de_idx).astype(np.int64))
+    np.save(dense_dataset_location / "perts.npy", np.array([cell.pert for cell in cells]))
+
+    for name in GENE_ARRAYS:
+        dtype = GENE_ARRAY2DTYPE[name]
+        if layout == "dense":
+            values_m = np.lib.format.open_memmap(dense_dataset_location / f"{name}.npy", mode="w+", dtype=dtype, shape=(n_cells, n_genes))
+            for i, cell in enumerate(cells):
+                values_m[i] = _get_gene_array_row(cell, name)
+            values_m.flush()
+            del values_m
+        else:
+            # the number of non-zero values is counted first, so that the CSR arrays can be written through memory maps
+            indptr = np.zeros(n_cells + 1, dtype=np.int64)
+            for i, cell in enumerate(cells):
+                indptr[i + 1] = indptr[i] + np.count_nonzero(_get_gene_array_row(cell, name))
+            data_m = np.lib.format.open_memmap(dense_dataset_location / f"{name}.data.npy", mode="w+", dtype=dtype, shape=(indptr[-1],))
+            indices_m = np.lib.format.open_memmap(dense_dataset_location / f"{name}.indices.npy", mode="w+", dtype=np.int32, shape=(indptr[-1],))
+            for i, cell in enumerate(cells):
+                row = _get_gene_array_row(cell, name)
+                row_indices = np.flatnonzero(row)
+                data_m[indptr[i]:indptr[i + 1]] = row[row_indices]
+                indices_m[indptr[i]:indptr[i + 1]] = row_indices
+            data_m.flush()
+            indices_m.flush()
+            del data_m, indices_m
+            np.save(dense_dataset_location / f"{name}.indptr.npy", indptr)
+
+    # the metadata header is written last, so that a dense dataset without it is incomplete
+    meta = {
+        "version": DENSE_DATASET_VERSION,
+        "n_cells": n_cells,
+        "n_genes": n_genes,
+        "n_de_genes": len(de_idx[0]),
+        "layout": layout,
+        "source_inputs": source_inputs,
+    }
+    with open(dense_dataset_location / "meta.json", "w") as f:
+        json.dump(meta, f, indent=2)
+    print(f"Materialized {n_cells} cells with {n_genes} genes under {dense_dataset_location}")
+    return str(dense_dataset_location)
+
+
+def _get_csr_rows(data, indices, indptr, rows, n_cols):
+    """
+    Gathers rows of a CSR matrix into a dense float32 matrix; only the non-zero values of the rows are read from the memory maps
+    """
+    starts = indptr[rows]
+    lengths = indptr[np.asarray(rows) + 1] - starts
+    row_ids = np.repeat(np.arange(len(starts)), lengths)
+    # positions of the non-zero values of all rows in data and indices
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    positions = np.repeat(starts, lengths) + offsets
+    values = np.zeros((len(starts), n_cols), dtype=np.float32)
+    values[row_ids, indices[positions]] = data[positions]
+    return values
+
+
+class DenseBatch:
+    """
+    Batch of cells read from a dense dataset. Holds the same data as a batch of GEARS cell graphs, but as
+    [batch_size, n_genes] matrices instead of a (batch_size * n_genes, 2) node tensor.
+
+    Attributes:
+        ctrl: control expression, [batch_size, n_genes]
+        pert_flags: perturbation flags, [batch_size, n_genes]
+        y: post-perturbation expression, [batch_size, n_genes]
+        de_idx: indices of the differentially expressed genes, numpy array of shape [batch_size, n_de_genes]
+        pert: list of perturbation names
+    """
+    def __init__(self, ctrl, pert_flags, y, de_idx, pert):
+        self.ctrl = ctrl
+        self.pert_flags = pert_flags
+        self.y = y
+        self.de_idx = de_idx
+        self.pert = pert
+
+    def __len__(self):
+        return len(self.pert)
+
+    def to(self, device):
+        """
+        Moves the batch to device in place, like torch_geometric batches
+        """
+        self.ctrl = self.ctrl.to(device)
+        self.pert_flags = self.pert_flags.to(device)
+        self.y = self.y.to(device)
+        return self
+
+
+class DenseDataset:
+    """
+    Dense dataset created with materialize_dense_dataset, read through memory maps.
+    """
+    def __init__(self, dense_dataset_location):
+        if not is_dense_dataset(dense_dataset_location):
+            raise ValueError(f"{dense_dataset_location} is not a complete dense dataset")
+        dense_dataset_location = Path(dense_dataset_location)
+        with open(dense_dataset_location / "meta.json") as f:
+            self.meta = json.load(f)
+        if self.meta["version"] > DENSE_DATASET_VERSION:
+            raise ValueError(f"Dense dataset version {self.meta['version']} of {dense_dataset_location} is not supported")
+        self.n_genes = self.meta["n_genes"]
+        self.de_idx = np.load(dense_dataset_location / "de_idx.npy")
+        self.perts = np.load(dense_dataset_location / "perts.npy")
+
+        self.gene_arrays = {}
+        for name in GENE_ARRAYS:
+            if self.meta["layout"] == "dense":
+                self.gene_arrays[name] = np.load(dense_dataset_location / f"{name}.npy", mmap_mode="r")
+            else:
+                self.gene_arrays[name] = (np.load(dense_dataset_location / f"{name}.data.npy", mmap_mode="r"),
+                                          np.load(dense_dataset_location / f"{name}.indices.npy", mmap_mode="r"),
+                                          np.load(dense_dataset_location / f"{name}.indptr.npy"))
+
+    def __len__(self):
+        return self.meta["n_cells"]
+
+    def get_batch(self, cell_idx):
+        """
+        Reads the cells with indices cell_idx into a DenseBatch
+        """
+        gene_arrays = {}
+        for name, values in self.gene_arrays.items():
+            if self.meta["layout"] == "dense":
+                values = np.asarray(values[cell_idx], dtype=np.float32)
+            else:
+                values = _get_csr_rows(*values, cell_idx, self.n_genes)
+            gene_arrays[name] = torch.from_numpy(values)
+        return DenseBatch(gene_arrays["ctrl"], gene_arrays["pert_flags"].long(), gene_arrays["y"],
+                          self.de_idx[cell_idx], self.perts[cell_idx].tolist())
+
+
+class DenseDataLoader:
+    """
+    Lightweight dataloader over a DenseDataset; each batch is read with a single gather of its cells, without any collation.
+    If batch_sampler is set, eg to a LengthBucketBatchSampler (see utils/length_bucketing.py), it yields the cell indices
+    of each batch instead, and shuffle and drop_last are ignored.
+    """
+    def __init__(self, dataset, batch_size, shuffle = False, drop_last = False, generator = None, batch_sampler = None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+        self.batch_sampler = batch_sampler
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+    def __iter__(self):
+        if self.batch_sampler is not None:
+            for batch_idx in self.batch_sampler:
+                yield self.dataset.get_batch(np.sort(batch_idx))
+            return
+        if self.shuffle:
+            cell_idx = torch.randperm(len(self.dataset), generator=self.generator).numpy()
+        else:
+            cell_idx = np.arange(len(self.dataset))
+        for batch in range(len(self)):
+            batch_idx = cell_idx[batch * self.batch_size:(batch + 1) * self.batch_size]
+            if self.shuffle:
+                # reading the cells in order makes the gather sequential on disk
+                batch_idx = np.sort(batch_idx)
+            yield self.dataset.get_batch(batch_idx)
+
+
+def get_dense_dataloaders(pert_data, dataset_name, split, seed, batch_size, data_dir = "data/", layout = "csr", 
+                          source_inputs = None):
+    """
+    Creates DenseDataLoaders for a PertData object, with the same batches as the GEARS dataloaders created by
+    pert_data.get_dataloader(batch_size). The dense datasets are materialized from the GEARS dataloaders on first use,
+    creating them if pert_data.dataloader isn't set yet, and read from disk afterwards, in which case the GEARS dataloaders
+    aren't needed. Dense datasets materialized from other source_inputs, eg after the dataset files or the GEARS version
+    changed, are materialized again.
+
+    Args:
+        pert_data: PertData object, with the split prepared
+        dataset_name: name of the dataset; used to key the dense datasets
+        split: split used to prepare pert_data; used to key the dense datasets
+        seed: seed used to prepare the split; used to key the dense datasets
+        batch_size: batch size of the dataloaders
+        data_dir: directory the dense datasets are saved under
+        layout: layout of the per-gene arrays of newly materialized dense datasets, one of 'csr', 'dense'
+        source_inputs: inputs the cells of pert_data were created from, see materialize_dense_dataset
+
+    Returns:
+        dataloaders: dict mapping loader_type + '_loader' to DenseDataLoaders
+    """
+    dense_dataset_locations = get_dense_dataset_locations(data_dir, dataset_name, split, seed)
+    if not all(is_dense_dataset(location, source_inputs) for location in dense_dataset_locations.values()):
+        if not hasattr(pert_data, "dataloader"):
+            pert_data.get_dataloader(batch_size=batch_size)
+        for loader_type, location in dense_dataset_locations.items():
+            materialize_dense_dataset(pert_data.dataloader[loader_type + "_loader"].dataset, location, layout, source_inputs)
+
+    dataloaders = {}
+    for loader_type, location in dense_dataset_locations.items():
+        dense_dataset = DenseDataset(location)
+        if dense_dataset.n_genes != pert_data.adata.n_vars:
+            raise ValueError(f"Dense dataset {location} has {dense_dataset.n_genes} genes; expected {pert_data.adata.n_vars}")
+        # same settings as the GEARS dataloaders; note that GEARS also uses batch_size for the test dataloader
+        dataloaders[loader_type + "_loader"] = DenseDataLoader(dense_dataset, batch_size, 
+                                                               shuffle=loader_type in ["train", "val"], 
+                                                               drop_last=loader_type == "train")
+    return dataloaders
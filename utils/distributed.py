@@ -0,0 +1,160 @@
+import os
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import BatchSampler, RandomSampler, SequentialSampler
+from torch_geometric.loader import DataLoader
+
+from utils.dense_dataset import DenseDataLoader
+from utils.length_bucketing import LengthBucketBatchSampler
+
+
+def init_distributed(backend = None):
+    """
+    Initializes the default process group from the environment variables set by torchrun, eg
+    torchrun --nproc-per-node=4 train.py ...; does nothing if the script isn't run with more than one process.
+    With the gloo backend, each process gets an equal share of the cores of its node.
+
+    Args:
+        backend: 'gloo' for CPU training or 'nccl' for GPU training; if None, nccl is used if CUDA is available
+
+    Returns:
+        rank: rank of the process
+        world_size: number of processes
+        local_rank: rank of the process on its node
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size == 1:
+        return 0, 1, 0
+    rank = int(os.environ["RANK"])
+    local_rank = int(os.environ.get("LOCAL_RANK", 0))
+    if backend is None:
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+    dist.init_process_group(backend=backend, rank=rank, world_size=world_size)
+    if backend == "gloo":
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+        torch.set_num_threads(max(1, os.cpu_count() // local_world_size))
+    return rank, world_size, local_rank
+
+
+def destroy_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce_sum(values, device = "cpu"):
+    """
+    Sums a list of numbers across processes
+
+    Args:
+        values: list of numbers
+        device: device of the process group tensors; cpu for gloo, the GPU of the process for nccl
+
+    Returns:
+        list of the summed numbers
+    """
+    if not is_distributed():
+        return values
+    values = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(values)
+    return values.tolist()
+
+
+class ShardedBatchSampler:
+    """
+    Shards the batches of a batch sampler across processes: every process draws the same global batches, seeded with
+    seed + epoch, and keeps every world_size-th cell of each batch. The global batches, including their length
+    bucketing, are the same as in a single process with the same generator, and all processes run the same number of
+    steps. Global batches with less cells than processes are skipped, so that no process gets an empty batch.
+    """
+    def __init__(self, batch_sampler, generator, num_replicas, rank, seed = 0):
+        """
+        Args:
+            batch_sampler: sampler of the global batches, drawing from generator
+            generator: torch.Generator the batch_sampler shuffles with
+            num_replicas: number of processes
+            rank: rank of the process
+            seed: seed of the shuffling, shared by all processes
+        """
+        self.batch_sampler = batch_sampler
+        self.generator = generator
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        n_batches = len(self.batch_sampler)
+        if not self.batch_sampler.drop_last:
+            # the last global batch is skipped if it has less cells than processes
+            if hasattr(self.batch_sampler, "sampler"):
+                n_cells = len(self.batch_sampler.sampler)
+            else:
+                n_cells = len(self.batch_sampler.lengths)
+            if 0 < n_cells % self.batch_sampler.batch_size < self.num_replicas:
+                n_batches -= 1
+        return n_batches
+
+    def __iter__(self):
+        self.generator.manual_seed(self.seed + self.epoch)
+        for batch in self.batch_sampler:
+            if len(batch) < self.num_replicas:
+                continue
+            yield list(batch)[self.rank::self.num_replicas]
+
+
+def get_distributed_dataloader(loader, num_replicas, rank, seed = 0):
+    """
+    Creates a dataloader with the same dataset, batch size, shuffling, drop_last and length bucketing settings as a GEARS
+    dataloader or a DenseDataLoader, whose batches are sharded across processes with a ShardedBatchSampler; each process
+    gets batch_size / num_replicas cells per batch. Call loader.batch_sampler.set_epoch(epoch) at each epoch to reshuffle.
+
+    Args:
+        loader: GEARS dataloader, DenseDataLoader or length-bucketed dataloader (see utils/length_bucketing.py)
+        num_replicas: number of processes
+        rank: rank of the process
+        seed: seed of the shuffling, shared by all processes
+
+    Returns:
+        dataloader of the same type as loader
+    """
+    generator = torch.Generator()
+    if isinstance(loader, DenseDataLoader):
+        batch_sampler, shuffle, drop_last = loader.batch_sampler, loader.shuffle, loader.drop_last
+    else:
+        batch_sampler, shuffle, drop_last = loader.batch_sampler, isinstance(loader.sampler, RandomSampler), loader.drop_last
+    if isinstance(batch_sampler, LengthBucketBatchSampler):
+        batch_sampler.generator = generator
+    else:
+        cell_idx = range(len(loader.dataset))
+        sampler = RandomSampler(cell_idx, generator=generator) if shuffle else SequentialSampler(cell_idx)
+        batch_sampler = BatchSampler(sampler, loader.batch_size, drop_last)
+
+    sharded_batch_sampler = ShardedBatchSampler(batch_sampler, generator, num_replicas, rank, seed)
+    if isinstance(loader, DenseDataLoader):
+        return DenseDataLoader(loader.dataset, loader.batch_size, batch_sampler=sharded_batch_sampler)
+    return DataLoader(loader.dataset, batch_sampler=sharded_batch_sampler)
@@ -0,0 +1,118 @@
+import argparse
+import json
+import os
+import pickle as pkl
+from pathlib import Path
+
+import numpy as np
+
+# Version of the on-disk layout of gene embedding stores
+EMBEDDING_STORE_VERSION = 1
+
+
+def get_store_location(precomputed_embs_location):
+    """
+    Returns the location of the gene embedding store corresponding to a pickled gene embeddings file, 
+    eg gene_embeddings/GO_C_gene_embeddings-gpt3.5-ada-concat.pickle -> gene_embeddings/GO_C_gene_embeddings-gpt3.5-ada-concat.store
+    """
+    return str(Path(precomputed_embs_location).with_suffix('.store'))
+
+
+def convert_gene_embeddings_to_store(precomputed_embs_location, store_location = None, dtype = np.float64):
+    """
+    Converts a pickled {gene: embedding} dictionary into a gene embedding store: a directory holding
+        - embeddings.npy: contiguous [n_genes, embed_dim] matrix, with rows sorted by gene name
+        - genes.npy: sorted gene names, used as the index of the rows of embeddings.npy
+        - meta.json: metadata header with the embedding dimension, dtype, number of genes and source file
+    The store is read through a memory map, so that only the rows of the requested genes are loaded.
+    
+    Args:
+        precomputed_embs_location: location of the pickled gene embeddings
+        store_location: location of the store to create; defaults to get_store_location(precomputed_embs_location)
+        dtype: dtype of the stored embeddings
+        
+    Returns:
+        store_location: location of the created store
+    """
+    if store_location is None:
+        store_location = get_store_location(precomputed_embs_location)
+    with open(precomputed_embs_location, "rb") as fp:
+        gene_embeddings = pkl.load(fp)
+        
+    genes = np.array(sorted(gene_embeddings.keys()))
+    embed_dim = len(np.asarray(gene_embeddings[genes[0]]).reshape(-1))
+    
+    store_location = Path(store_location)
+    store_location.mkdir(parents=True, exist_ok=True)
+    embeds_m = np.lib.format.open_memmap(store_location / "embeddings.npy", mode="w+", dtype=dtype, shape=(len(genes), embed_dim))
+    for i, gene in enumerate(genes):
+        embeds_m[i] = np.asarray(gene_embeddings[gene]).reshape(-1)
+    embeds_m.flush()
+    del embeds_m
+    np.save(store_location / "genes.npy", genes)
+    
+    # the metadata header is written last, so that a store without it is incomplete
+    meta = {
+        "version": EMBEDDING_STORE_VERSION,
+        "n_genes": len(genes),
+        "embed_dim": embed_dim,
+        "dtype": np.dtype(dtype).name,
+        "source": os.path.basename(precomputed_embs_location),
+    }
+    with open(store_location / "meta.json", "w") as f:
+        json.dump(meta, f, indent=2)
+    print(f"Converted {len(genes)} gene embeddings of dimension {embed_dim} from {precomputed_embs_location} to {store_location}")
+    return str(store_location)
+
+
+def is_store(store_location):
+    """
+    Returns True if store_location is a complete gene embedding store.
+    """
+    return os.path.isfile(os.path.join(store_location, "meta.json"))
+
+
+def load_gene_embeddings_from_store(store_location, genes):
+    """
+    Loads the embeddings of a list of genes from a gene embedding store. Only the rows of the requested genes are read.
+    
+    Args:
+        store_location: location of the gene embedding store
+        genes: genes to load the embeddings for
+        
+    Returns:
+        embeds: array of shape [len(mapped_genes), embed_dim] with the embeddings of the genes found in the store
+        mapped_genes: genes found in the store, in the order of genes
+    """
+    with open(os.path.join(store_location, "meta.json")) as f:
+        meta = json.load(f)
+    if meta["version"] != EMBEDDING_STORE_VERSION:
+        raise ValueError(f"Gene embedding store {store_location} has version {meta['version']}, expected {EMBEDDING_STORE_VERSION}")
+    store_genes = np.load(os.path.join(store_location, "genes.npy"))
+    embeds_m = np.load(os.path.join(store_location, "embeddings.npy"), mmap_mode="r")
+    
+    genes = np.asarray(genes, dtype=str)
+    rows = np.minimum(np.searchsorted(store_genes, genes), len(store_genes) - 1)
+    found = store_genes[rows] == genes
+    embeds = np.asarray(embeds_m[rows[found]])
+    return embeds, genes[found].tolist()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Converts pickled gene embeddings to memory-mapped gene embedding stores ...')
+    parser.add_argument(
+        'precomputed_embs_locations', 
+        type=str, 
+        nargs='+',
+        help='locations of the pickled gene embeddings to convert, eg models/gene_embeddings/*.pickle'
+    )
+    parser.add_argument(
+        '--dtype', 
+        type=str, 
+        help='dtype of the stored embeddings', 
+        choices = ['float64', 'float32', 'float16'],
+        default = 'float64'
+    )
+    args = parser.parse_args()
+    for precomputed_embs_location in args.precomputed_embs_locations:
+        convert_gene_embeddings_to_store(precomputed_embs_location, dtype = np.dtype(args.dtype))
@@ -1,19 +1,34 @@
 from torch import nn, Tensor
+from torch.utils.data import BatchSampler, SequentialSampler
 from torch_geometric.loader import DataLoader
 from typing import Iterable, List, Tuple, Dict, Union, Optional
+import multiprocessing as mp
+import os
+import pickle
+import traceback
 import torch
 import numpy as np
 from gears.inference import compute_metrics, deeper_analysis, non_dropout_analysis
 import json
 import matplotlib.pyplot as plt
+import pandas as pd
 from gears.utils import create_cell_graph_dataset_for_prediction
 
-def compute_test_metrics(pert_data, best_model, loader_type, save_dir, device, include_zero_gene, gene_ids, epoch = 'best'):
-    test_loader = pert_data.dataloader[loader_type + "_loader"]
-    print("Loaded dataloader!")
-    test_res = eval_perturb(test_loader, best_model, device, include_zero_gene, gene_ids)
+from models.scGenePT import get_ctrl_pool
+from utils.dense_dataset import DenseDataLoader
+
+def compute_test_metrics(pert_data, best_model, loader_type, save_dir, device, include_zero_gene, gene_ids, epoch = 'best',
+                         streaming_metrics = None):
+    """
+    Evaluates best_model on a dataloader of pert_data and saves the metrics under save_dir/metrics/loader_type/;
+    if streaming_metrics is set, eg by eval_perturb_sharded, the metrics are computed from it and best_model isn't used
+    """
+    if streaming_metrics is None:
+        test_loader = pert_data.dataloader[loader_type + "_loader"]
+        print("Loaded dataloader!")
+        streaming_metrics = eval_perturb_streaming(test_loader, best_model, device, include_zero_gene, gene_ids)
     print('Finished eval perturb')
-    test_metrics, test_pert_res = compute_metrics(test_res)
+    test_metrics, test_pert_res = streaming_metrics.compute_metrics()
     new_test_metrics = {}
     for k, v in test_metrics.items():
         print(loader_type + "_" + k + ": " + str(v))
@@ -25,77 +40,86 @@ def compute_test_metrics(pert_data, best_model, loader_type, save_dir, device, i
     with open(f"{save_dir}/metrics/{loader_type}/pert_res_epoch_{epoch}.json", "w") as f:
         json.dump(test_pert_res, f)
 
-    deeper_res = deeper_analysis(pert_data.adata, test_res)
-    non_dropout_res = non_dropout_analysis(pert_data.adata, test_res)
-
-    metrics = ["pearson_delta", "pearson_delta_de"]
-    metrics_non_dropout = [
+    # the delta metrics of GEARS deeper_analysis and non_dropout_analysis, averaged over the perturbations of each subgroup
+    delta_metrics = streaming_metrics.compute_delta_metrics(pert_data.adata)
+    metrics = [
+        "pearson_delta", 
+        "pearson_delta_de",
         "pearson_delta_top20_de_non_dropout",
         "pearson_top20_de_non_dropout",
     ]
-    subgroup_analysis = {}
-    for name in pert_data.subgroup[loader_type + "_subgroup"].keys():
-        subgroup_analysis[name] = {}
-        for m in metrics:
-            subgroup_analysis[name][m] = []
-
-        for m in metrics_non_dropout:
-            subgroup_analysis[name][m] = []
-
     for name, pert_list in pert_data.subgroup[loader_type + "_subgroup"].items():
-        for pert in pert_list:
-            for m in metrics:
-                subgroup_analysis[name][m].append(deeper_res[pert][m])
-
-            for m in metrics_non_dropout:
-                subgroup_analysis[name][m].append(non_dropout_res[pert][m])
-
-    for name, result in subgroup_analysis.items():
-        for m in result.keys():
-            subgroup_analysis[name][m] = np.mean(subgroup_analysis[name][m])
+        subgroup_metrics = np.mean(delta_metrics.loc[list(pert_list), metrics].to_numpy(), axis = 0)
+        for m, m_value in zip(metrics, subgroup_metrics):
             m_type = loader_type + "_" + name + "_" + m
-            m_value = subgroup_analysis[name][m]
             if m_value == m_value:
                 print(m_type + ": " + str(m_value))
                 new_test_metrics[m_type] = str(m_value)
     return new_test_metrics
 
 
-def eval_perturb(
-    loader: DataLoader, model, device, include_zero_gene, gene_ids
-) -> Dict:
+def iter_eval_batches(loader, model, device, include_zero_gene, gene_ids, context_budget = None):
     """
-    Run model in inference mode using a given data loader
+    Runs model in inference mode on the batches of a data loader
+    
+    Args:
+        context_budget: if not None, a ContextBudget limiting the genes input to the model (see utils/context_genes.py)
+        
+    Yields:
+        pert_cat: perturbations of the cells of the batch
+        pred: predicted expression of the cells, shape [batch_size, n_genes]
+        truth: ground truth expression of the cells, shape [batch_size, n_genes]
+        pred_de: predicted expression of the DE genes of the cells, shape [batch_size, n_de_genes]
+        truth_de: ground truth expression of the DE genes of the cells, shape [batch_size, n_de_genes]
     """
-
     model.eval()
     model.to(device)
-    pert_cat = []
-    pred = []
-    truth = []
-    pred_de = []
-    truth_de = []
-    results = {}
-    logvar = []
-
     print(len(loader))
-    for itr, batch in enumerate(loader):
+    for batch in loader:
         batch.to(device)
-        pert_cat.extend(batch.pert)
         with torch.no_grad():
             p = model.pred_perturb(
                 batch,
                 include_zero_gene=include_zero_gene,
                 gene_ids=gene_ids,
+                context_budget=context_budget,
             )
             t = batch.y
-            pred.extend(p.cpu())
-            truth.extend(t.cpu())
 
-            # Differentially expressed genes
-            for itr, de_idx in enumerate(batch.de_idx):
-                pred_de.append(p[itr, de_idx])
-                truth_de.append(t[itr, de_idx])
+            de_idx = _get_de_idx(batch, t)
+            yield batch.pert, p, t, p.gather(1, de_idx), t.gather(1, de_idx)
+
+
+def _get_de_idx(batch, truth):
+    """
+    Returns the indices of the differentially expressed genes of the cells of a batch, shape [batch_size, n_de_genes], 
+    to gather the DE genes of all cells at once; the -1 indices of control cells index the last gene
+    """
+    return torch.as_tensor(np.asarray(batch.de_idx, dtype=np.int64).reshape(len(truth), -1), device=truth.device) % truth.shape[1]
+
+
+def eval_perturb(
+    loader: DataLoader, model, device, include_zero_gene, gene_ids, context_budget = None
+) -> Dict:
+    """
+    Run model in inference mode using a given data loader
+    
+    Args:
+        context_budget: if not None, a ContextBudget limiting the genes input to the model (see utils/context_genes.py)
+    """
+    pert_cat = []
+    pred = []
+    truth = []
+    pred_de = []
+    truth_de = []
+    results = {}
+
+    for batch_pert_cat, p, t, p_de, t_de in iter_eval_batches(loader, model, device, include_zero_gene, gene_ids, context_budget):
+        pert_cat.extend(batch_pert_cat)
+        pred.extend(p.cpu())
+        truth.extend(t.cpu())
+        pred_de.extend(p_de)
+        truth_de.extend(t_de)
 
     # all genes
     results["pert_cat"] = np.array(pert_cat)
@@ -109,4 +133,349 @@ def eval_perturb(
     results["pred_de"] = pred_de.detach().cpu().numpy().astype(np.float64)
     results["truth_de"] = truth_de.detach().cpu().numpy().astype(np.float64)
 
-    return results
\ No newline at end of file
+    return results
+
+
+def eval_perturb_streaming(loader, model, device, include_zero_gene, gene_ids, context_budget = None):
+    """
+    Runs model in inference mode using a given data loader, accumulating the predictions per perturbation instead of
+    keeping the predictions of every cell as eval_perturb does
+    
+    Args:
+        context_budget: if not None, a ContextBudget limiting the genes input to the model (see utils/context_genes.py)
+        
+    Returns:
+        StreamingPerturbationMetrics with the predictions and ground truth of the loader
+    """
+    streaming_metrics = None
+    for pert_cat, p, t, p_de, t_de in iter_eval_batches(loader, model, device, include_zero_gene, gene_ids, context_budget):
+        if streaming_metrics is None:
+            streaming_metrics = StreamingPerturbationMetrics(p.shape[1], p_de.shape[1])
+        streaming_metrics.update(pert_cat, p, t, p_de, t_de)
+    return streaming_metrics
+
+
+def eval_perturb_streaming_many(loader, models, device, include_zero_gene, context_budget = None):
+    """
+    Runs several models in inference mode on the same data loader, reading each batch once and feeding it to every 
+    model, and accumulates the predictions of each model per perturbation as eval_perturb_streaming does
+    
+    Args:
+        models: dict mapping model names to (model, gene_ids) tuples
+        context_budget: if not None, a ContextBudget limiting the genes input to the models (see utils/context_genes.py)
+        
+    Returns:
+        dict mapping model names to StreamingPerturbationMetrics with the predictions of each model
+    """
+    for model, _ in models.values():
+        model.eval()
+        model.to(device)
+    streaming_metrics = {name: None for name in models}
+    for batch in loader:
+        batch.to(device)
+        t = batch.y
+        de_idx = _get_de_idx(batch, t)
+        t_de = t.gather(1, de_idx)
+        for name, (model, gene_ids) in models.items():
+            with torch.no_grad():
+                p = model.pred_perturb(
+                    batch,
+                    include_zero_gene=include_zero_gene,
+                    gene_ids=gene_ids,
+                    context_budget=context_budget,
+                )
+            if streaming_metrics[name] is None:
+                streaming_metrics[name] = StreamingPerturbationMetrics(p.shape[1], de_idx.shape[1])
+            streaming_metrics[name].update(batch.pert, p, t, p.gather(1, de_idx), t_de)
+    return streaming_metrics
+
+
+def pred_perturb_many_models(models, adata_ctrl, perturbations, gene_names, device, amp = True, pool_size = None, 
+                             batch_size = 8, ctrl_pool = None):
+    """
+    Mean perturbation predictions of several models over one shared control pool, see scGenePT.pred_perturb_many; the
+    control pool is sampled and densified once, and every model predicts from the same control cells, so that the
+    predictions of the models can be compared without the noise of sampling a different pool for each model
+    
+    Args:
+        models: dict mapping model names to (model, gene_ids) tuples
+        adata_ctrl: adata control sample to predict from; ignored if ctrl_pool is given
+        perturbations: list of perturbations, in str form; eg ['FOSB+ctrl', 'SAMD1+ZBTB1']
+        gene_names: list of gene names in the dataset the models have been trained on
+        pool_size: number of control samples to predict for; if None, predicts over all; otherwise, samples randomly for pool_size
+        batch_size: number of (control cell, perturbation) pairs to run through a model at once
+        ctrl_pool: optional pre-built control pool tensor of shape [pool_size, n_genes], eg from get_ctrl_pool
+        
+    Returns:
+        dict mapping model names to arrays of shape [len(perturbations), n_genes] with the mean prediction of each model
+    """
+    if ctrl_pool is None:
+        ctrl_pool = get_ctrl_pool(adata_ctrl, pool_size)
+    ctrl_pool = ctrl_pool.to(device)
+    return {name: model.pred_perturb_many(adata_ctrl, perturbations, gene_names, device, gene_ids, amp, 
+                                          batch_size = batch_size, ctrl_pool = ctrl_pool)
+            for name, (model, gene_ids) in models.items()}
+
+
+def get_shard_dataloader(loader, num_shards, rank):
+    """
+    Creates a dataloader over every num_shards-th batch of a non-shuffled GEARS dataloader or DenseDataLoader, starting
+    at batch rank, with the same cells in each batch as loader; the shards of all ranks cover the batches of loader once.
+
+    Args:
+        loader: non-shuffled GEARS dataloader or DenseDataLoader, eg the test dataloader
+        num_shards: number of shards
+        rank: shard to create the dataloader of
+
+    Returns:
+        dataloader of the same type as loader
+    """
+    batch_sampler = loader.batch_sampler
+    if batch_sampler is None:
+        batch_sampler = BatchSampler(SequentialSampler(range(len(loader.dataset))), loader.batch_size, loader.drop_last)
+    shard_batches = [list(batch) for batch in batch_sampler][rank::num_shards]
+    if isinstance(loader, DenseDataLoader):
+        return DenseDataLoader(loader.dataset, loader.batch_size, batch_sampler=shard_batches)
+    return DataLoader(loader.dataset, batch_sampler=shard_batches)
+
+
+def _eval_shard(loader, load_models, device, include_zero_gene, num_workers, rank, num_threads, connection, context_budget):
+    """
+    Evaluates a shard of loader in a forked worker process and sends the StreamingPerturbationMetrics of its models, or
+    the traceback of the error it failed with, to the parent process. The result is sent with the standard pickle, which
+    copies the tensors, instead of the multiprocessing pickler, which shares them through file descriptors that are
+    closed when the worker exits.
+    """
+    try:
+        torch.set_num_threads(num_threads)
+        models = load_models()
+        shard_loader = get_shard_dataloader(loader, num_workers, rank)
+        result = ("ok", eval_perturb_streaming_many(shard_loader, models, device, include_zero_gene, context_budget))
+    except BaseException:
+        result = ("error", traceback.format_exc())
+    try:
+        connection.send_bytes(pickle.dumps(result))
+    finally:
+        connection.close()
+
+
+def eval_perturb_sharded(loader, load_models, device, include_zero_gene, num_workers, context_budget = None):
+    """
+    Runs eval_perturb_streaming_many with the batches of loader sharded across num_workers processes forked from the
+    main thread, each loading its own model replicas with load_models and using an equal share of the cores, and merges
+    the StreamingPerturbationMetrics of the shards in shard order, so that the merged running sums don't depend on which
+    worker finishes first. Every batch has the same cells as in a single process, so the merged sums only differ from
+    the sums of eval_perturb_streaming by the order in which the float64 per-cell predictions are added, ie by a relative
+    error of ~1e-15, well below the float32 precision of the predictions; the predictions themselves can differ by the
+    float32 rounding of the matrix products if the number of threads per worker changes their blocking.
+    CUDA can't be used in forked processes if it has been initialized in the parent process, so load_models should be
+    the first use of the device.
+
+    Args:
+        loader: non-shuffled GEARS dataloader or DenseDataLoader, eg the test dataloader
+        load_models: function returning a dict mapping model names to (model, gene_ids) tuples; called in each worker,
+            so it needn't be picklable
+        device: device of the models
+        include_zero_gene: see eval_perturb
+        num_workers: number of worker processes; at most one per batch is used
+        context_budget: if not None, a ContextBudget limiting the genes input to the models (see utils/context_genes.py)
+
+    Returns:
+        dict mapping model names to StreamingPerturbationMetrics with the predictions and ground truth of the loader
+    """
+    num_workers = max(1, min(num_workers, len(loader)))
+    num_threads = max(1, os.cpu_count() // num_workers)
+    ctx = mp.get_context('fork')
+    workers = []
+    for rank in range(num_workers):
+        parent_connection, child_connection = ctx.Pipe(duplex=False)
+        process = ctx.Process(target=_eval_shard, args=(loader, load_models, device, include_zero_gene, num_workers, rank,
+                                                        num_threads, child_connection, context_budget))
+        process.start()
+        child_connection.close()
+        workers.append((process, parent_connection))
+
+    streaming_metrics, errors = None, []
+    for rank, (process, parent_connection) in enumerate(workers):
+        try:
+            status, result = pickle.loads(parent_connection.recv_bytes())
+        except EOFError:
+            status, result = "error", "worker exited without sending its metrics"
+        process.join()
+        if status != "ok":
+            errors.append(f"shard {rank}: {result}")
+        elif streaming_metrics is None:
+            streaming_metrics = result
+        else:
+            for name, shard_metrics in result.items():
+                streaming_metrics[name].merge(shard_metrics)
+    if errors:
+        raise RuntimeError("Evaluation failed for " + "\n".join(errors))
+    return streaming_metrics
+
+
+class StreamingPerturbationMetrics:
+    """
+    Accumulates the predicted and ground truth expression of cells into running sums per perturbation, over all genes
+    and over the DE genes, so that the memory used by the evaluation is bounded by n_perts x n_genes instead of 
+    n_cells x n_genes. The Pearson/MSE metrics of GEARS compute_metrics, and the delta metrics of deeper_analysis 
+    and non_dropout_analysis reported by compute_test_metrics, only depend on the mean expression of each 
+    perturbation, and are computed from the running sums.
+    """
+    def __init__(self, n_genes, n_de_genes = 20):
+        """
+        Args:
+            n_genes: number of genes
+            n_de_genes: number of DE genes of each cell
+        """
+        self.pert_cat = []
+        self.pert2idx = {}
+        self.n_cells = torch.zeros(0, dtype=torch.float64)
+        self.pred_sum = torch.zeros(0, n_genes, dtype=torch.float64)
+        self.truth_sum = torch.zeros(0, n_genes, dtype=torch.float64)
+        self.pred_de_sum = torch.zeros(0, n_de_genes, dtype=torch.float64)
+        self.truth_de_sum = torch.zeros(0, n_de_genes, dtype=torch.float64)
+
+    def _get_pert_idx(self, pert_cat):
+        """
+        Returns the indices of the perturbations in the running sums, adding rows for new perturbations
+        """
+        for pert in pert_cat:
+            if pert not in self.pert2idx:
+                self.pert2idx[pert] = len(self.pert_cat)
+                self.pert_cat.append(pert)
+        n_new_perts = len(self.pert_cat) - len(self.n_cells)
+        if n_new_perts > 0:
+            self.n_cells = torch.cat([self.n_cells, torch.zeros(n_new_perts, dtype=torch.float64)])
+            for name in ['pred_sum', 'truth_sum', 'pred_de_sum', 'truth_de_sum']:
+                running_sum = getattr(self, name)
+                setattr(self, name, torch.cat([running_sum, running_sum.new_zeros(n_new_perts, running_sum.shape[1])]))
+        return torch.tensor([self.pert2idx[pert] for pert in pert_cat])
+
+    def update(self, pert_cat, pred, truth, pred_de, truth_de):
+        """
+        Adds a batch of cells to the running sums
+        
+        Args:
+            pert_cat: perturbations of the cells
+            pred: predicted expression of the cells, shape [batch_size, n_genes]
+            truth: ground truth expression of the cells, shape [batch_size, n_genes]
+            pred_de: predicted expression of the DE genes of the cells, shape [batch_size, n_de_genes]
+            truth_de: ground truth expression of the DE genes of the cells, shape [batch_size, n_de_genes]
+        """
+        pert_idx = self._get_pert_idx(pert_cat)
+        self.n_cells.index_add_(0, pert_idx, torch.ones(len(pert_idx), dtype=torch.float64))
+        self.pred_sum.index_add_(0, pert_idx, pred.detach().cpu().double())
+        self.truth_sum.index_add_(0, pert_idx, truth.detach().cpu().double())
+        self.pred_de_sum.index_add_(0, pert_idx, pred_de.detach().cpu().double())
+        self.truth_de_sum.index_add_(0, pert_idx, truth_de.detach().cpu().double())
+
+    def merge(self, other):
+        """
+        Adds the running sums of another StreamingPerturbationMetrics, eg of another shard of the same dataloader
+        """
+        pert_idx = self._get_pert_idx(other.pert_cat)
+        self.n_cells.index_add_(0, pert_idx, other.n_cells)
+        self.pred_sum.index_add_(0, pert_idx, other.pred_sum)
+        self.truth_sum.index_add_(0, pert_idx, other.truth_sum)
+        self.pred_de_sum.index_add_(0, pert_idx, other.pred_de_sum)
+        self.truth_de_sum.index_add_(0, pert_idx, other.truth_de_sum)
+
+    def get_mean_results(self):
+        """
+        Returns the mean expression of each perturbation, sorted by perturbation, in the format of the results of 
+        eval_perturb with one row per perturbation instead of one row per cell
+        """
+        order = np.argsort(self.pert_cat)
+        n_cells = self.n_cells[order, None]
+        return {
+            "pert_cat": np.array(self.pert_cat)[order],
+            "pred": (self.pred_sum[order] / n_cells).numpy(),
+            "truth": (self.truth_sum[order] / n_cells).numpy(),
+            "pred_de": (self.pred_de_sum[order] / n_cells).numpy(),
+            "truth_de": (self.truth_de_sum[order] / n_cells).numpy(),
+        }
+
+    def compute_metrics(self):
+        """
+        Computes the metrics of GEARS compute_metrics: the MSE and Pearson correlation between the predicted and ground
+        truth mean expression of each perturbation, over all genes and over the DE genes, and their mean over perturbations
+        
+        Returns:
+            metrics: mean of each metric over perturbations
+            metrics_pert: dict mapping each perturbation to its metrics
+        """
+        mean_results = self.get_mean_results()
+        pert_cat = mean_results["pert_cat"]
+        pert_metrics = {
+            'mse': _rowwise_mse(mean_results["pred"], mean_results["truth"]),
+            'pearson': _rowwise_pearson(mean_results["pred"], mean_results["truth"]),
+            'mse_de': _rowwise_mse(mean_results["pred_de"], mean_results["truth_de"]),
+            'pearson_de': _rowwise_pearson(mean_results["pred_de"], mean_results["truth_de"]),
+        }
+        # the DE metrics of the control cells are 0 and are not included in the mean DE metrics
+        is_pert = pert_cat != 'ctrl'
+        metrics = {m: np.mean(pert_metrics[m][is_pert] if m.endswith('_de') else pert_metrics[m]) 
+                   for m in ['mse', 'mse_de', 'pearson', 'pearson_de']}
+        metrics_pert = {}
+        for i, pert in enumerate(pert_cat):
+            metrics_pert[pert] = {m: pert_metrics[m][i] if is_pert[i] or not m.endswith('_de') else 0 
+                                  for m in ['mse', 'pearson', 'mse_de', 'pearson_de']}
+        return metrics, metrics_pert
+
+    def compute_delta_metrics(self, adata):
+        """
+        Computes the Pearson correlations between the predicted and ground truth change of the mean expression of each
+        perturbation from the mean control expression, reported by compute_test_metrics: pearson_delta and 
+        pearson_delta_de of GEARS deeper_analysis, pearson_delta_top20_de_non_dropout and pearson_top20_de_non_dropout 
+        of GEARS non_dropout_analysis
+        
+        Args:
+            adata: AnnData of the dataset, eg pert_data.adata
+        
+        Returns:
+            pd.DataFrame with the metrics of each perturbation, indexed by perturbation
+        """
+        mean_results = self.get_mean_results()
+        pert_cat = mean_results["pert_cat"]
+        pert2pert_full_id = dict(adata.obs[['condition', 'condition_name']].values)
+        geneid2idx = dict(zip(adata.var.index.values, range(len(adata.var.index.values))))
+        ctrl = np.asarray(np.mean(adata.X[np.where(adata.obs.condition == 'ctrl')[0]], axis = 0)).reshape(1, -1)
+        
+        # top 20 DE genes and top 20 non-dropout DE genes of each perturbation, shape [n_perts, 20]
+        pert_full_ids = [pert2pert_full_id[pert] for pert in pert_cat]
+        de_idx = np.array([[geneid2idx[gene] for gene in adata.uns['rank_genes_groups_cov_all'][pert_full_id][:20]] 
+                           for pert_full_id in pert_full_ids]).reshape(len(pert_cat), -1)
+        non_dropout_de_idx = np.array([[geneid2idx[gene] for gene in adata.uns['top_non_dropout_de_20'][pert_full_id]] 
+                                       for pert_full_id in pert_full_ids]).reshape(len(pert_cat), -1)
+        
+        pred_delta = mean_results["pred"] - ctrl
+        truth_delta = mean_results["truth"] - ctrl
+        return pd.DataFrame({
+            'pearson_delta': _rowwise_pearson(pred_delta, truth_delta),
+            'pearson_delta_de': _rowwise_pearson(np.take_along_axis(pred_delta, de_idx, 1), 
+                                                 np.take_along_axis(truth_delta, de_idx, 1)),
+            'pearson_delta_top20_de_non_dropout': _rowwise_pearson(np.take_along_axis(pred_delta, non_dropout_de_idx, 1), 
+                                                                   np.take_along_axis(truth_delta, non_dropout_de_idx, 1)),
+            'pearson_top20_de_non_dropout': _rowwise_pearson(np.take_along_axis(mean_results["pred"], non_dropout_de_idx, 1), 
+                                                             np.take_along_axis(mean_results["truth"], non_dropout_de_idx, 1)),
+        }, index = pert_cat)
+
+
+def _rowwise_mse(x, y):
+    """
+    Mean squared error between each row of x and the same row of y
+    """
+    return ((x - y) ** 2).mean(1)
+
+
+def _rowwise_pearson(x, y):
+    """
+    Pearson correlation between each row of x and the same row of y, computed as scipy.stats.pearsonr, with NaN 
+    correlations (eg of constant rows) replaced by 0 as in GEARS
+    """
+    xm = x - x.mean(1, keepdims = True)
+    ym = y - y.mean(1, keepdims = True)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        r = (xm * ym).sum(1) / (np.linalg.norm(xm, axis = 1) * np.linalg.norm(ym, axis = 1))
+    return np.nan_to_num(np.clip(r, -1, 1), nan = 0.0)
@@ -0,0 +1,100 @@
+import math
+
+import numpy as np
+import torch
+from torch_geometric.loader import DataLoader
+
+from utils.dense_dataset import DenseDataLoader, DenseDataset
+
+
+def get_cell_lengths(dataset, chunk_size = 4096):
+    """
+    Returns the number of genes each cell of a dataset has in the "row-wise" include_zero_gene mode, ie its nonzero
+    and perturbed genes (see get_row_wise_gene_ids in models/scGenePT.py).
+
+    Args:
+        dataset: list of GEARS cell graphs or DenseDataset
+        chunk_size: number of cells of a DenseDataset read at once
+
+    Returns:
+        lengths: int array of shape [n_cells]
+    """
+    if isinstance(dataset, DenseDataset):
+        lengths = []
+        for start in range(0, len(dataset), chunk_size):
+            batch = dataset.get_batch(np.arange(start, min(start + chunk_size, len(dataset))))
+            lengths.append(((batch.ctrl != 0) | (batch.pert_flags == 1)).sum(1).numpy())
+        return np.concatenate(lengths) if len(lengths) > 0 else np.zeros(0, dtype=np.int64)
+    return np.array([int(((cell.x[:, 0] != 0) | (cell.x[:, 1] == 1)).sum()) for cell in dataset], dtype=np.int64)
+
+
+class LengthBucketBatchSampler:
+    """
+    Batch sampler grouping cells with similar lengths, so that "row-wise" batches are padded to a length close to the
+    length of each of their cells. The cells are shuffled, split into buckets of batches_per_bucket batches, sorted by
+    length within each bucket and split into batches; the order of the batches is then shuffled. Larger buckets give
+    batches with more similar lengths but less random batches.
+    """
+    def __init__(self, lengths, batch_size, shuffle = True, drop_last = False, batches_per_bucket = 50, generator = None):
+        """
+        Args:
+            lengths: length of each cell, see get_cell_lengths
+            batch_size: number of cells per batch
+            shuffle: if True, the cells are shuffled before bucketing and the batches are shuffled after
+            drop_last: if True, the last batch is dropped if it has less than batch_size cells
+            batches_per_bucket: number of batches per bucket
+            generator: torch.Generator used to shuffle; if None, the global torch RNG is used
+        """
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.batches_per_bucket = batches_per_bucket
+        self.generator = generator
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+    def __iter__(self):
+        if self.shuffle:
+            cell_idx = torch.randperm(len(self.lengths), generator=self.generator).numpy()
+        else:
+            cell_idx = np.arange(len(self.lengths))
+        bucket_size = self.batch_size * self.batches_per_bucket
+        batches = []
+        for start in range(0, len(cell_idx), bucket_size):
+            bucket = cell_idx[start:start + bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=self.generator).tolist()]
+        for batch in batches:
+            yield batch.tolist()
+
+
+def get_length_bucketed_dataloader(loader, batches_per_bucket = 50, generator = None):
+    """
+    Creates a dataloader with the same dataset, batch size, shuffling and drop_last settings as a GEARS dataloader or a
+    DenseDataLoader, whose batches are sampled with a LengthBucketBatchSampler.
+
+    Args:
+        loader: GEARS dataloader or DenseDataLoader
+        batches_per_bucket: number of batches per bucket, see LengthBucketBatchSampler
+        generator: torch.Generator used to shuffle; if None, the global torch RNG is used
+
+    Returns:
+        dataloader of the same type as loader
+    """
+    if isinstance(loader, DenseDataLoader):
+        shuffle, drop_last = loader.shuffle, loader.drop_last
+    else:
+        shuffle, drop_last = isinstance(loader.sampler, torch.utils.data.RandomSampler), loader.drop_last
+    batch_sampler = LengthBucketBatchSampler(get_cell_lengths(loader.dataset), loader.batch_size, shuffle, drop_last,
+                                             batches_per_bucket, generator)
+    if isinstance(loader, DenseDataLoader):
+        return DenseDataLoader(loader.dataset, loader.batch_size, batch_sampler=batch_sampler)
+    return DataLoader(loader.dataset, batch_sampler=batch_sampler)
@@ -0,0 +1,11 @@
+"""
+Makes numba use its workqueue threading layer instead of its default TBB threading layer. numba is imported by GEARS,
+through dcor, and with the TBB threading layer a process that forks after importing it hangs at exit, after its children
+have finished. This includes starting a subprocess.Popen with a preexec_fn, which forks the process instead of spawning
+the subprocess with vfork/posix_spawn.
+
+The threading layer is read when numba is imported, so scripts that fork import this module before anything else.
+"""
+import os
+
+os.environ.setdefault("NUMBA_THREADING_LAYER", "workqueue")
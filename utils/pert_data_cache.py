@@ -0,0 +1,173 @@
+import hashlib
+import importlib.metadata
+import json
+import os
+import pickle as pkl
+import shutil
+from pathlib import Path
+
+import numpy as np
+import scanpy as sc
+from gears import PertData
+
+from utils.dense_dataset import get_dense_dataloaders, get_dense_dataset_locations, is_dense_dataset
+
+# Version of the on-disk layout of the PertData cache; bumping it invalidates all caches
+PERT_DATA_CACHE_VERSION = 2
+
+# Files of a GEARS dataset the prepared split is derived from
+PERT_DATA_SOURCE_FILES = ["perturb_processed.h5ad", "data_pyg/cell_graphs.pkl"]
+
+# PertData attributes that are not cached; adata is read from the dataset h5ad file instead
+PERT_DATA_UNCACHED_ATTRIBUTES = ["adata", "ctrl_adata", "dataset_processed", "dataloader"]
+
+
+def get_pert_data_cache_inputs(data_dir, dataset_name, split, seed):
+    """
+    Returns everything a prepared PertData split depends on: the dataset, split and seed, the GEARS version and the
+    size and modification time of the dataset files.
+    """
+    source_files = {}
+    for source_file in PERT_DATA_SOURCE_FILES:
+        source_location = os.path.join(data_dir, dataset_name, source_file)
+        if os.path.exists(source_location):
+            source_stat = os.stat(source_location)
+            source_files[source_file] = [source_stat.st_size, source_stat.st_mtime_ns]
+    return {
+        "dataset_name": dataset_name,
+        "split": split,
+        "seed": seed,
+        "gears_version": importlib.metadata.version("cell-gears"),
+        "cache_version": PERT_DATA_CACHE_VERSION,
+        "source_files": source_files,
+    }
+
+
+def get_pert_data_cache_location(data_dir, dataset_name, cache_inputs):
+    """
+    Returns the location of the PertData cache for cache_inputs, addressed by their hash,
+    eg data/norman/pert_data_cache/<hash>
+    """
+    cache_key = hashlib.sha256(json.dumps(cache_inputs, sort_keys=True).encode()).hexdigest()[:16]
+    return str(Path(data_dir) / dataset_name / "pert_data_cache" / cache_key)
+
+
+def save_pert_data_cache(pert_data, cache_location, cache_inputs, rng_state):
+    """
+    Saves a PertData object with a prepared split to a cache directory holding
+        - pert_data.pkl: the PertData attributes, eg set2conditions and subgroup, without adata and the cell graphs, 
+          which are read from the GEARS dataset files instead, and the state of the global numpy RNG after the split
+          was prepared
+        - meta.json: the cache inputs, written last so that a cache without it is incomplete
+
+    Args:
+        pert_data: PertData object with a prepared split
+        cache_location: location of the cache
+        cache_inputs: inputs the cache is keyed by, see get_pert_data_cache_inputs
+        rng_state: state of the global numpy RNG after the split was prepared, see np.random.get_state
+    """
+    cache_location = Path(cache_location)
+    if cache_location.exists():
+        shutil.rmtree(cache_location)
+    cache_location.mkdir(parents=True)
+    pert_data_state = {k: v for k, v in pert_data.__dict__.items() if k not in PERT_DATA_UNCACHED_ATTRIBUTES}
+    with open(cache_location / "pert_data.pkl", "wb") as f:
+        pkl.dump({"pert_data": pert_data_state, "rng_state": rng_state}, f, protocol=pkl.HIGHEST_PROTOCOL)
+    with open(cache_location / "meta.json", "w") as f:
+        json.dump({"inputs": cache_inputs}, f, indent=2)
+
+
+def load_pert_data_cache(cache_location, cache_inputs, load_cell_graphs = True):
+    """
+    Loads a PertData object saved with save_pert_data_cache, after checking that the cache is complete and that it was
+    created from cache_inputs.
+
+    Args:
+        cache_location: location of the cache
+        cache_inputs: inputs the cache is expected to be keyed by, see get_pert_data_cache_inputs
+        load_cell_graphs: if True, also loads the cell graphs of the dataset from the GEARS cell_graphs.pkl file 
+            under pert_data.dataset_processed, for PertData.get_dataloader
+
+    Returns:
+        pert_data: PertData object with the split prepared
+        rng_state: state of the global numpy RNG after the split was prepared
+    """
+    cache_location = Path(cache_location)
+    with open(cache_location / "meta.json") as f:
+        meta = json.load(f)
+    if meta["inputs"] != cache_inputs:
+        raise ValueError(f"PertData cache {cache_location} was created from different inputs")
+
+    with open(cache_location / "pert_data.pkl", "rb") as f:
+        cache = pkl.load(f)
+    pert_data = PertData(cache["pert_data"]["data_path"])
+    pert_data.__dict__.update(cache["pert_data"])
+    pert_data.adata = sc.read_h5ad(os.path.join(pert_data.dataset_path, "perturb_processed.h5ad"))
+    pert_data.ctrl_adata = pert_data.adata[pert_data.adata.obs['condition'] == 'ctrl']
+    if load_cell_graphs:
+        with open(os.path.join(pert_data.dataset_path, "data_pyg", "cell_graphs.pkl"), "rb") as f:
+            pert_data.dataset_processed = pkl.load(f)
+    return pert_data, cache["rng_state"]
+
+
+def load_pert_data(dataset_name, batch_size, split = 'simulation', seed = 1, data_dir = 'data/',
+                   dense_dataset_layout = None, use_cache = True):
+    """
+    Loads a dataset in a PertData format, prepares its split and creates its dataloaders, caching the prepared split
+    and subgroups on disk; the dataloaders are created from the GEARS cell graphs file, as with PertData. The cache is 
+    addressed by the dataset name, split, seed, GEARS version and dataset files, so only the first run pays the 
+    preparation cost; an invalid cache is rebuilt.
+    GEARS reseeds the global numpy RNG when it creates a split, which the cache skips, so the state of the global numpy
+    RNG after the split was prepared is cached too and restored on a cache hit: what is drawn from it afterwards is 
+    the same as when the split is prepared.
+
+    Args:
+        dataset_name: name of the dataset to load. Example: 'adamson', 'norman'.
+        batch_size: batch_size of the dataloaders
+        split: split to use; tested with 'simulation'
+        seed: seed of the split
+        data_dir: directory the GEARS datasets are in
+        dense_dataset_layout: if not None, the dataloaders are DenseDataLoaders over dense datasets with this layout
+            (see utils/dense_dataset.py); once the dense datasets exist, the cell graphs are not loaded; dense datasets
+            materialized from other dataset files or with another GEARS version are materialized again
+        use_cache: if False, the split is prepared from scratch and not cached
+
+    Returns:
+        pert_data: PertData object, with the dataloaders under pert_data.dataloader
+    """
+    # the dense datasets are checked against the same inputs as the cache, so that stale dense datasets are rebuilt
+    use_dense_datasets = dense_dataset_layout is not None and all(
+        is_dense_dataset(location, get_pert_data_cache_inputs(data_dir, dataset_name, split, seed)) 
+        for location in get_dense_dataset_locations(data_dir, dataset_name, split, seed).values())
+
+    pert_data = None
+    if use_cache and split != 'no_split':
+        cache_inputs = get_pert_data_cache_inputs(data_dir, dataset_name, split, seed)
+        cache_location = get_pert_data_cache_location(data_dir, dataset_name, cache_inputs)
+        if os.path.exists(os.path.join(cache_location, "meta.json")):
+            try:
+                pert_data, rng_state = load_pert_data_cache(cache_location, cache_inputs, load_cell_graphs=not use_dense_datasets)
+                np.random.set_state(rng_state)
+                print(f"Loaded prepared {split} split of {dataset_name} from {cache_location}")
+            except Exception as e:
+                print(f"Could not load the PertData cache under {cache_location}, rebuilding it: {e}")
+                pert_data = None
+
+    if pert_data is None:
+        pert_data = PertData(data_dir)
+        pert_data.load(data_name=dataset_name)
+        pert_data.prepare_split(split=split, seed=seed)
+        # GEARS only sets ctrl_adata when it creates the cell graphs
+        pert_data.ctrl_adata = pert_data.adata[pert_data.adata.obs['condition'] == 'ctrl']
+        if use_cache and split != 'no_split':
+            # the dataset files might have just been downloaded
+            cache_inputs = get_pert_data_cache_inputs(data_dir, dataset_name, split, seed)
+            cache_location = get_pert_data_cache_location(data_dir, dataset_name, cache_inputs)
+            save_pert_data_cache(pert_data, cache_location, cache_inputs, np.random.get_state())
+    if not use_dense_datasets:
+        pert_data.get_dataloader(batch_size=batch_size)
+
+    if dense_dataset_layout is not None:
+        pert_data.dataloader = get_dense_dataloaders(pert_data, dataset_name, split, seed, batch_size, data_dir, dense_dataset_layout, 
+                                                     get_pert_data_cache_inputs(data_dir, dataset_name, split, seed))
+    return pert_data
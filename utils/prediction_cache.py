@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from utils.checkpoint import get_checkpoint_hash
+
+# Version of the on-disk layout of prediction caches; bumping it invalidates all cached predictions
+PREDICTION_CACHE_VERSION = 1
+
+
+class PredictionCache:
+    """
+    Two-tier cache of the predictions of scGenePT.pred_perturb_from_ctrl: an in-memory LRU of at most max_memory_bytes,
+    backed by an optional on-disk store under cache_dir of at most max_disk_bytes, from which the least recently used
+    predictions are evicted first. Predictions are keyed by the content hash of the model checkpoint, the perturbation,
+    the control cells, the control pool size and seed, the precision and the dataset genes, so that a prediction is 
+    never served for a changed checkpoint or another control sample. The checkpoint hash is only recomputed when the size or modification time of the checkpoint file
+    changes, so that a cached prediction is returned without reading the checkpoint or running the model.
+    Cached predictions are returned as read-only arrays shared by all the calls that hit them.
+    """
+    def __init__(self, cache_dir = None, max_memory_bytes = 256 * 2 ** 20, max_disk_bytes = 4 * 2 ** 30):
+        """
+        Args:
+            cache_dir: directory of the on-disk store; predictions are only cached in memory if None
+            max_memory_bytes: max total size of the predictions cached in memory
+            max_disk_bytes: max total size of the predictions cached on disk
+        """
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_entries = OrderedDict()
+        self.memory_bytes = 0
+        self.checkpoint_hashes = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self.disk_bytes = sum(entry.stat().st_size for entry in self.cache_dir.glob("*.npy"))
+
+    def get_checkpoint_hash(self, checkpoint_location):
+        """
+        Returns the content hash of a checkpoint, recomputed only if the size or modification time of the file changed
+        """
+        checkpoint_location = os.path.abspath(checkpoint_location)
+        checkpoint_stat = os.stat(checkpoint_location)
+        checkpoint_version = (checkpoint_stat.st_size, checkpoint_stat.st_mtime_ns)
+        cached_version, checkpoint_hash = self.checkpoint_hashes.get(checkpoint_location, (None, None))
+        if cached_version != checkpoint_version:
+            checkpoint_hash = get_checkpoint_hash(checkpoint_location)
+            self.checkpoint_hashes[checkpoint_location] = (checkpoint_version, checkpoint_hash)
+        return checkpoint_hash
+
+    def get_key(self, checkpoint_hash, perturbation, ctrl_hash, pool_size, pool_seed, precision, genes_hash, return_mean):
+        """
+        Returns the key of a prediction, the hash of everything the prediction depends on
+        """
+        key_inputs = {
+            "checkpoint_hash": checkpoint_hash,
+            "perturbation": perturbation,
+            "ctrl_hash": ctrl_hash,
+            "pool_size": pool_size,
+            "pool_seed": pool_seed,
+            "precision": precision,
+            "genes_hash": genes_hash,
+            "return_mean": return_mean,
+            "cache_version": PREDICTION_CACHE_VERSION,
+        }
+        return hashlib.sha256(json.dumps(key_inputs, sort_keys=True).encode()).hexdigest()[:32]
+
+    def get(self, key):
+        """
+        Returns the prediction cached under key, from memory or else from disk, or None if it isn't cached
+        """
+        if key in self.memory_entries:
+            self.memory_entries.move_to_end(key)
+            self.hits += 1
+            return self.memory_entries[key]
+        if self.cache_dir is not None:
+            entry_location = self.cache_dir / f"{key}.npy"
+            try:
+                prediction = np.load(entry_location)
+            except (FileNotFoundError, ValueError):
+                prediction = None
+            if prediction is not None:
+                # the modification time of the entries orders them for the eviction of the least recently used
+                os.utime(entry_location)
+                self.disk_hits += 1
+                return self._put_memory(key, prediction)
+        self.misses += 1
+        return None
+
+    def put(self, key, prediction):
+        """
+        Caches a prediction under key, in memory and on disk
+
+        Returns:
+            the cached, read-only prediction
+        """
+        prediction = self._put_memory(key, np.array(prediction))
+        if self.cache_dir is not None:
+            entry_location = self.cache_dir / f"{key}.npy"
+            # written to a temporary file first, so that concurrent readers never read a partial entry
+            tmp_location = self.cache_dir / f"{key}.{os.getpid()}.tmp"
+            with open(tmp_location, "wb") as f:
+                np.save(f, prediction)
+            try:
+                self.disk_bytes -= entry_location.stat().st_size
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_location, entry_location)
+            self.disk_bytes += entry_location.stat().st_size
+            if self.disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+        return prediction
+
+    def _put_memory(self, key, prediction):
+        """
+        Caches a prediction in memory, evicting the least recently used predictions beyond max_memory_bytes
+        """
+        prediction.flags.writeable = False
+        if prediction.nbytes > self.max_memory_bytes:
+            return prediction
+        if key in self.memory_entries:
+            self.memory_bytes -= self.memory_entries.pop(key).nbytes
+        self.memory_entries[key] = prediction
+        self.memory_bytes += prediction.nbytes
+        while self.memory_bytes > self.max_memory_bytes:
+            _, evicted = self.memory_entries.popitem(last=False)
+            self.memory_bytes -= evicted.nbytes
+        return prediction
+
+    def _evict_disk(self):
+        """
+        Deletes the least recently used predictions on disk until they fit in max_disk_bytes; the total size is
+        recomputed from the directory, as other processes can share the store
+        """
+        entries = []
+        for entry_location in self.cache_dir.glob("*.npy"):
+            try:
+                entry_stat = entry_location.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((entry_stat.st_mtime_ns, entry_stat.st_size, entry_location))
+        entries.sort()
+        self.disk_bytes = sum(size for _, size, _ in entries)
+        for _, size, entry_location in entries:
+            if self.disk_bytes <= self.max_disk_bytes:
+                break
+            entry_location.unlink(missing_ok=True)
+            self.disk_bytes -= size
+
+    def clear(self):
+        """
+        Deletes all the cached predictions, in memory and on disk
+        """
+        self.memory_entries.clear()
+        self.memory_bytes = 0
+        if self.cache_dir is not None:
+            for entry_location in self.cache_dir.glob("*.npy"):
+                entry_location.unlink(missing_ok=True)
+            self.disk_bytes = 0
+
+    def stats(self):
+        """
+        Returns the hit and miss counters and the size of the cache
+        """
+        n_queries = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / n_queries if n_queries else 0.0,
+            "memory_entries": len(self.memory_entries),
+            "memory_bytes": self.memory_bytes,
+            "disk_bytes": self.disk_bytes if self.cache_dir is not None else 0,
+        }
+
+    def pred_perturb_from_ctrl(self, model, checkpoint_location, adata_ctrl, perturbation, gene_names, device, gene_ids = None,
+                               amp = True, pool_size = None, return_mean = True, batch_size = 8, pool_seed = 0):
+        """
+        Cached scGenePT.pred_perturb_from_ctrl: returns the cached prediction of the model for the perturbation if there
+        is one, and otherwise predicts it and caches it. The control pool is sampled with pool_seed, so that the
+        prediction is the same for the same pool size and seed.
+
+        Args:
+            model: scGenePT model loaded from checkpoint_location
+            checkpoint_location: location of the checkpoint of the model; its content hash keys the predictions
+            pool_seed: seed of the sampling of the control pool, see get_ctrl_pool in models/scGenePT.py
+            other args: see scGenePT.pred_perturb_from_ctrl
+
+        Returns:
+            read-only prediction, see scGenePT.pred_perturb_from_ctrl
+        """
+        precision = str(next(model.parameters()).dtype) + ("+amp" if amp else "")
+        genes_hash = hashlib.sha256("\n".join(gene_names).encode()).hexdigest()
+        # the pool indexes into the control cells, so the same pool size and seed sample different cells from a
+        # different control sample with the same genes
+        ctrl_hash = hashlib.sha256(("\n".join(adata_ctrl.obs_names) + f"\n{adata_ctrl.shape}").encode()).hexdigest()
+        pool_size = pool_size if pool_size is not None else len(adata_ctrl)
+        key = self.get_key(self.get_checkpoint_hash(checkpoint_location), perturbation, ctrl_hash, pool_size, pool_seed, 
+                           precision, genes_hash, return_mean)
+        prediction = self.get(key)
+        if prediction is None:
+            prediction = model.pred_perturb_from_ctrl(adata_ctrl, perturbation, gene_names, device, gene_ids, amp, pool_size,
+                                                      return_mean, batch_size, pool_seed)
+            prediction = self.put(key, prediction)
+        return prediction
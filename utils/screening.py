@@ -0,0 +1,265 @@
+import json
+import os
+import hashlib
+import itertools
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from models.scGenePT import get_ctrl_pool, get_ctrl_pool_idx
+from utils.data_loading import load_trained_scgenept_model_from_config
+
+# Worker state, set once per screen worker process by init_screen_worker
+_worker_state = {}
+
+
+def get_candidate_perturbations(gene_names, candidates_file = None, include_singles = False):
+    """
+    Builds the list of perturbations to screen. By default all gene pairs from gene_names are screened.
+    
+    Args:
+        gene_names: list of gene names in the dataset the model has been trained on
+        candidates_file: optional text file with one perturbation per line, eg 'FOSB+ctrl' or 'SAMD1+ZBTB1'; 
+            if given, only these perturbations are screened
+        include_singles: if True, single gene perturbations 'GENE+ctrl' are added to the gene pairs
+        
+    Returns:
+        perturbations: list of perturbations, in str form
+    """
+    if candidates_file is not None:
+        with open(candidates_file) as f:
+            perturbations = [line.strip() for line in f if line.strip()]
+        gene_names = set(gene_names)
+        for perturbation in perturbations:
+            for gene in perturbation.split('+'):
+                if gene != 'ctrl' and gene not in gene_names:
+                    raise ValueError(f"Gene {gene} from perturbation {perturbation} is not in the dataset genes")
+        return perturbations
+    
+    perturbations = []
+    if include_singles:
+        perturbations.extend([f'{gene}+ctrl' for gene in gene_names])
+    perturbations.extend([f'{g1}+{g2}' for g1, g2 in itertools.combinations(gene_names, 2)])
+    return perturbations
+
+
+def shard_perturbations(perturbations, shard_size):
+    """
+    Splits a list of perturbations into deterministic, contiguous shards of at most shard_size perturbations.
+    
+    Args:
+        perturbations: list of perturbations, in str form
+        shard_size: max number of perturbations per shard
+        
+    Returns:
+        shards: list of lists of perturbations
+    """
+    return [perturbations[i : i + shard_size] for i in range(0, len(perturbations), shard_size)]
+
+
+def get_shard_location(outputs_dir, shard_id):
+    """
+    Returns the location of the predictions array and the completion marker for a given shard.
+    """
+    shards_dir = Path(outputs_dir) / "shards"
+    return shards_dir / f"shard_{shard_id:06d}.npy", shards_dir / f"shard_{shard_id:06d}.done"
+
+
+def init_screen_outputs(outputs_dir, perturbations, shard_size, n_genes, metadata):
+    """
+    Creates the output directory of a screen, or validates it against the current screen when resuming.
+    
+    Args:
+        outputs_dir: directory the screen outputs are written to
+        perturbations: list of perturbations to screen
+        shard_size: max number of perturbations per shard
+        n_genes: number of genes predicted for each perturbation
+        metadata: dict with additional information about the screen (model, pool size, seed, ...)
+        
+    Returns:
+        manifest: dict describing the screen
+    """
+    outputs_dir = Path(outputs_dir)
+    (outputs_dir / "shards").mkdir(parents=True, exist_ok=True)
+    perturbations_hash = hashlib.sha256("\n".join(perturbations).encode()).hexdigest()
+    manifest = {
+        "n_perturbations": len(perturbations),
+        "n_shards": len(shard_perturbations(perturbations, shard_size)),
+        "shard_size": shard_size,
+        "n_genes": n_genes,
+        "perturbations_sha256": perturbations_hash,
+        **metadata
+    }
+    manifest_location = outputs_dir / "manifest.json"
+    if manifest_location.exists():
+        with open(manifest_location) as f:
+            existing_manifest = json.load(f)
+        if existing_manifest != manifest:
+            raise ValueError(
+                f"{outputs_dir} contains a different screen; use a new outputs directory or delete the old one. "
+                f"Found {existing_manifest}, expected {manifest}"
+            )
+    else:
+        with open(outputs_dir / "perturbations.txt", "w") as f:
+            f.write("\n".join(perturbations))
+        with open(manifest_location, "w") as f:
+            json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def get_screen_ctrl_pool(adata_ctrl, pool_size, pool_seed):
+    """
+    Samples the control pool of a screen with its own generator, so that a resumed screen scores its pending shards
+    against the same control cells as the shards that were completed before it was stopped, whatever the state of the 
+    global numpy RNG after loading the data.
+    
+    Args:
+        adata_ctrl: adata control sample to sample from
+        pool_size: number of control samples to sample; if None, samples len(adata_ctrl) cells
+        pool_seed: seed of the sampling
+        
+    Returns:
+        ctrl_pool: float32 tensor of shape [pool_size, n_genes]
+        ctrl_pool_hash: sha256 hash of the names of the sampled control cells, to be stored in the manifest
+    """
+    ctrl_pool = get_ctrl_pool(adata_ctrl, pool_size, pool_seed)
+    # the same seed samples the same indices as get_ctrl_pool
+    ctrl_idx = get_ctrl_pool_idx(len(adata_ctrl), pool_size, pool_seed)
+    ctrl_pool_hash = hashlib.sha256("\n".join(adata_ctrl.obs_names[ctrl_idx]).encode()).hexdigest()
+    return ctrl_pool, ctrl_pool_hash
+
+
+def get_pending_shards(outputs_dir, n_shards):
+    """
+    Returns the ids of the shards that have not been completed yet.
+    """
+    return [shard_id for shard_id in range(n_shards) if not get_shard_location(outputs_dir, shard_id)[1].exists()]
+
+
+def init_screen_worker(adata, model_type, models_dir, model_location, device, num_threads, 
+                       ctrl_pool, gene_names, batch_size, amp):
+    """
+    Initializes a screen worker process; each worker owns its own copy of the model and its own torch thread budget.
+    """
+    torch.set_num_threads(num_threads)
+    model, gene_ids = load_trained_scgenept_model_from_config(model_location, device, adata, model_type, models_dir)
+    _worker_state.update({
+        "model": model,
+        "gene_ids": gene_ids,
+        "device": device,
+        "ctrl_pool": ctrl_pool.to(device),
+        "gene_names": gene_names,
+        "batch_size": batch_size,
+        "amp": amp,
+    })
+
+
+def run_screen_shard(outputs_dir, shard_id, perturbations):
+    """
+    Predicts the mean response over the control pool for one shard of perturbations and streams it to disk. 
+    The shard is marked as completed only once its predictions have been flushed.
+    
+    Returns:
+        shard_id: id of the completed shard
+    """
+    state = _worker_state
+    preds_location, done_location = get_shard_location(outputs_dir, shard_id)
+    n_genes = state["ctrl_pool"].shape[1]
+    tmp_location = preds_location.with_suffix(".tmp")
+    preds = np.lib.format.open_memmap(tmp_location, mode="w+", dtype=np.float32, shape=(len(perturbations), n_genes))
+    state["model"].pred_perturb_many(
+        None,
+        perturbations,
+        state["gene_names"],
+        state["device"],
+        state["gene_ids"],
+        amp=state["amp"],
+        batch_size=state["batch_size"],
+        ctrl_pool=state["ctrl_pool"],
+        out=preds,
+    )
+    preds.flush()
+    del preds
+    os.replace(tmp_location, preds_location)
+    done_location.touch()
+    return shard_id
+
+
+def run_screen_shard_from_args(shard_args):
+    """
+    Unpacks the (outputs_dir, shard_id, perturbations) tuple for run_screen_shard; used with Pool.imap_unordered.
+    """
+    return run_screen_shard(*shard_args)
+
+
+class ScreenPredictions:
+    """
+    Read-only view of the predictions of a screen, stored as one memory-mapped array per shard. Indexing it with a row
+    index returns the memory-mapped row; indexing it with a slice or an array of row indices gathers these rows from 
+    their shards into a new array, so that only the indexed rows are read into memory. Use iter_shards to process all
+    the predictions one shard at a time.
+    """
+    def __init__(self, shards, shard_size):
+        """
+        Args:
+            shards: list of memory-mapped prediction arrays of shape [n_shard_perturbations, n_genes], in shard order
+            shard_size: number of perturbations of every shard but the last one
+        """
+        self.shards = shards
+        self.shard_size = shard_size
+        self.shape = (sum(len(shard) for shard in shards), shards[0].shape[1] if shards else 0)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            if not -len(self) <= idx < len(self):
+                raise IndexError(f"index {idx} is out of bounds for {len(self)} perturbations")
+            idx = idx % len(self)
+            return self.shards[idx // self.shard_size][idx % self.shard_size]
+        if isinstance(idx, slice):
+            rows = np.arange(*idx.indices(len(self)))
+        else:
+            rows = np.asarray(idx)
+            if rows.dtype == bool:
+                rows = np.flatnonzero(rows)
+            if ((rows < -len(self)) | (rows >= len(self))).any():
+                raise IndexError(f"indices are out of bounds for {len(self)} perturbations")
+            rows = rows % len(self)
+        preds = np.empty((len(rows), self.shape[1]), dtype=np.float32)
+        shard_ids = rows // self.shard_size
+        for shard_id in np.unique(shard_ids):
+            in_shard = shard_ids == shard_id
+            preds[in_shard] = self.shards[shard_id][rows[in_shard] - shard_id * self.shard_size]
+        return preds
+
+    def iter_shards(self):
+        """
+        Yields (start, shard_preds) for each shard, where start is the index of the first perturbation of the shard
+        and shard_preds is its memory-mapped predictions
+        """
+        for shard_id, shard in enumerate(self.shards):
+            yield shard_id * self.shard_size, shard
+
+
+def load_screen_results(outputs_dir):
+    """
+    Loads the results of a completed screen. The predictions are memory-mapped, shard by shard, and are not read into
+    memory until they are indexed.
+    
+    Returns:
+        perturbations: list of screened perturbations
+        preds: ScreenPredictions of shape [n_perturbations, n_genes] with the mean predictions for each perturbation
+    """
+    outputs_dir = Path(outputs_dir)
+    with open(outputs_dir / "manifest.json") as f:
+        manifest = json.load(f)
+    pending_shards = get_pending_shards(outputs_dir, manifest["n_shards"])
+    if len(pending_shards) > 0:
+        raise ValueError(f"Screen under {outputs_dir} is not complete; {len(pending_shards)} shards are pending")
+    with open(outputs_dir / "perturbations.txt") as f:
+        perturbations = f.read().split("\n")
+    shards = [np.load(get_shard_location(outputs_dir, shard_id)[0], mmap_mode="r") for shard_id in range(manifest["n_shards"])]
+    return perturbations, ScreenPredictions(shards, manifest["shard_size"])
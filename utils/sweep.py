@@ -0,0 +1,117 @@
+import itertools
+import os
+import resource
+import subprocess
+import time
+
+
+def get_sweep_configs(model_types, lrs, dropouts, seeds, no_attention_variants = False):
+    """
+    Expands a grid of training hyperparameters into the list of configs to train.
+
+    Args:
+        model_types: model types to train, see get_embs_to_include in utils/data_loading.py
+        lrs: learning rates
+        dropouts: dropout probabilities
+        seeds: random seeds
+        no_attention_variants: if True, the _no_attention variant of each model type is also trained
+
+    Returns:
+        configs: list of dicts with the model_type, lr, dropout and rnd_seed of each config
+    """
+    if no_attention_variants:
+        model_types = list(model_types) + [model_type + '_no_attention' for model_type in model_types
+                                           if not model_type.endswith('_no_attention')]
+    return [{'model_type': model_type, 'lr': lr, 'dropout': dropout, 'rnd_seed': rnd_seed}
+            for model_type, lr, dropout, rnd_seed in itertools.product(model_types, lrs, dropouts, seeds)]
+
+
+def get_config_outputs_dir(outputs_dir, config):
+    """
+    Returns the outputs directory of a config, so that configs differing only by their lr or dropout are saved apart,
+    eg outputs/sweep/lr_0.0001_dropout_0.2/
+    """
+    return os.path.join(outputs_dir, f"lr_{config['lr']}_dropout_{config['dropout']}", "")
+
+
+def get_core_slots(threads_per_job, max_jobs = None, memory_per_job_gb = None):
+    """
+    Partitions the cores available to the process into disjoint slots of threads_per_job cores, one per concurrent job,
+    so that jobs don't oversubscribe the cores. The number of slots is also limited by max_jobs and by the number of
+    jobs whose memory limit fits in the physical memory.
+
+    Args:
+        threads_per_job: number of cores of each job
+        max_jobs: max number of concurrent jobs
+        memory_per_job_gb: memory limit of each job, in GB
+
+    Returns:
+        core_slots: list of lists of core ids
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    n_slots = max(1, len(cores) // threads_per_job)
+    if max_jobs is not None:
+        n_slots = min(n_slots, max_jobs)
+    if memory_per_job_gb is not None:
+        memory_gb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024**3
+        n_slots = max(1, min(n_slots, int(memory_gb // memory_per_job_gb)))
+    return [cores[i * threads_per_job:(i + 1) * threads_per_job] or cores for i in range(n_slots)]
+
+
+def _limit_job_resources(cores, memory_per_job_gb):
+    """
+    Pins a job to its cores and limits its memory; runs in the job process before it starts.
+    The memory limit caps the virtual size of the data segment of the job (RLIMIT_DATA): its heap and its private 
+    writable mappings, counted when they are reserved rather than when they are used, eg the arenas malloc reserves 
+    per thread. It is not a limit on resident memory, and a job can fail to allocate memory well below its limit in 
+    resident memory, so leave some headroom. Files mapped read-only, such as gene embedding stores and dense datasets, 
+    don't count towards it, so they are shared by the jobs through the page cache.
+    """
+    os.sched_setaffinity(0, cores)
+    if memory_per_job_gb is not None:
+        memory_limit = int(memory_per_job_gb * 1024**3)
+        resource.setrlimit(resource.RLIMIT_DATA, (memory_limit, memory_limit))
+
+
+def run_jobs(commands, core_slots, memory_per_job_gb = None, log_locations = None, poll_interval = 1.0):
+    """
+    Runs commands as subprocesses, with at most one job per core slot at a time. Each job is pinned to the cores of its
+    slot, gets as many OpenMP/MKL threads as its slot has cores and its data segment is limited to memory_per_job_gb of 
+    virtual memory (see _limit_job_resources).
+
+    Args:
+        commands: list of commands, each a list of arguments for subprocess.Popen
+        core_slots: disjoint lists of core ids, see get_core_slots
+        memory_per_job_gb: limit of the virtual size of the data segment of each job, in GB; not limited if None
+        log_locations: optional list of files the stdout and stderr of each command are written to
+        poll_interval: seconds between checks for finished jobs
+
+    Returns:
+        returncodes: return code of each command
+    """
+    pending = list(range(len(commands)))
+    free_slots = list(range(len(core_slots)))
+    running = {}
+    returncodes = [None] * len(commands)
+    start_time = time.time()
+    while pending or running:
+        while pending and free_slots:
+            job_id, slot = pending.pop(0), free_slots.pop(0)
+            cores = core_slots[slot]
+            env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)), MKL_NUM_THREADS=str(len(cores)))
+            log_file = open(log_locations[job_id], 'w') if log_locations is not None else None
+            process = subprocess.Popen(commands[job_id], env=env, stdout=log_file, stderr=subprocess.STDOUT if log_file else None,
+                                       preexec_fn=lambda cores=cores: _limit_job_resources(cores, memory_per_job_gb))
+            running[job_id] = (process, slot, log_file)
+        time.sleep(poll_interval if running else 0)
+        for job_id, (process, slot, log_file) in list(running.items()):
+            if process.poll() is None:
+                continue
+            del running[job_id]
+            free_slots.append(slot)
+            if log_file is not None:
+                log_file.close()
+            returncodes[job_id] = process.returncode
+            n_done = sum(returncode is not None for returncode in returncodes)
+            print(f"Finished job {job_id} with return code {process.returncode} ({n_done}/{len(commands)}) | elapsed {time.time() - start_time:5.2f}s")
+    return returncodes